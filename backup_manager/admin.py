@@ -1,16 +1,45 @@
+from datetime import timedelta
+
+from celery.result import AsyncResult
 from django.contrib import admin
 from django import forms
 from django.utils import timezone
 from django_celery_beat.models import CrontabSchedule, PeriodicTask
 
-from backup_manager import tasks
+from backup_manager import progress, tasks
 from backup_manager.models import Environment, Project, Backup, Restore, Database, Host, STATUS, PeriodicDatabaseBackup, \
-    PeriodicEnvironmentBackup
+    PeriodicEnvironmentBackup, BaseBackup, PointInTimeRestore, PeriodicHostBackup, BackupPart, EnvironmentBackupRun, \
+    DatabaseCopy, BackupProfile
 
 
 # Register your models here.
 
 
+class RelatedAdmin(admin.ModelAdmin):
+    # The related objects shown in the list (and in the __str__ used by the autocompletes of other admins)
+    # are loaded in the same query, instead of one query per row
+    list_select_related = ()
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(*self.list_select_related)
+
+
+class TaskProgressMixin:
+    # Progress reported by the celery task of the running rows (read from the result backend, only for them)
+    @admin.display(description='Progress')
+    def progress(self, obj) -> str:
+        if not obj.is_running() or not obj.task_id:
+            return None
+
+        try:
+            result = AsyncResult(obj.task_id)
+            if result.state != 'PROGRESS' or not isinstance(result.info, dict):
+                return None
+            return progress.describe(result.info)
+        except Exception:
+            return None  # The result backend is unavailable
+
+
 class ProjectAdmin(admin.ModelAdmin):
     list_display = ('name',)
     search_fields = ('name',)
@@ -20,26 +49,37 @@ admin.site.register(Project, ProjectAdmin)
 
 
 class EnvironmentAdmin(admin.ModelAdmin):
-    list_display = ('name',)
-    search_fields = ('name', 'host_db')
+    list_display = ('name', 'storage', 's3_bucket')
+    list_filter = ('storage',)
+    search_fields = ('name',)
 
 
 admin.site.register(Environment, EnvironmentAdmin)
 
 
 class HostAdmin(admin.ModelAdmin):
-    list_display = ('name', 'ip', 'port')
+    list_display = ('name', 'ip', 'port', 'max_concurrent_backups', 'wal_archiving')
     search_fields = ('name', 'ip')
 
 
 admin.site.register(Host, HostAdmin)
 
 
-class DatabaseAdmin(admin.ModelAdmin):
-    list_display = ('name', 'host', 'project', 'environment')
+class BackupProfileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'schema_only')
+    search_fields = ('name',)
+
+
+admin.site.register(BackupProfile, BackupProfileAdmin)
+
+
+class DatabaseAdmin(RelatedAdmin):
+    list_select_related = ('host', 'project', 'environment', 'backup_profile')
+    list_display = ('name', 'host', 'project', 'environment', 'backup_format', 'backup_jobs', 'backup_shards', 'compression', 'backup_profile', 'skip_unchanged', 'keep_snapshot')
     search_fields = ('name', 'host__name', 'project__name', 'environment__name')
-    list_filter = ('host', 'project', 'environment')
-    autocomplete_fields = ('host', 'project', 'environment')
+    list_filter = ('host', 'project', 'environment', 'backup_format', 'backup_profile')
+    autocomplete_fields = ('host', 'project', 'environment', 'backup_profile')
+    readonly_fields = ('snapshot_backup',)
 
 
 admin.site.register(Database, DatabaseAdmin)
@@ -54,16 +94,32 @@ class BackupAdminForm(forms.ModelForm):
         fields = '__all__'
 
 
-class BackupAdmin(admin.ModelAdmin):
-    list_display = ('name', 'path', 'database', 'dt_create', 'dt_start', 'dt_end', 'status', 'description')
-    search_fields = ('name', 'path', 'database', 'dt_create', 'status')
-    list_filter = ('database', 'database__project', 'database__environment', 'status')
-    autocomplete_fields = ('database',)
+class BackupPartInline(admin.TabularInline):
+    # The parts are created and dumped by the backup itself
+    model = BackupPart
+    fields = ('number', 'section', 'path', 'estimated_size', 'size', 'dt_start', 'dt_end', 'status', 'description')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class BackupAdmin(TaskProgressMixin, RelatedAdmin):
+    list_select_related = ('database__project', 'database__environment')
+    list_display = ('name', 'path', 'database', 'format', 'jobs', 'shards', 'compression', 'size', 'dt_create', 'dt_start', 'dt_end', 'status', 'progress', 'description')
+    search_fields = ('name', 'path', 'database__name', 'dt_create', 'status')
+    list_filter = ('database', 'database__project', 'database__environment', 'format', 'encrypted', 'status')
+    autocomplete_fields = ('database', 'profile')
+
+    readonly_fields = ('environment_run', 'encrypted', 'encryption_key_id', 'fingerprint', 'unchanged_from')
 
     form = BackupAdminForm
+    inlines = (BackupPartInline,)
 
     def add_view(self, request, form_url='', extra_context=None):
-        self.exclude = ('task_id', 'path', 'dt_start', 'dt_end', 'status', 'description')
+        self.exclude = ('task_id', 'path', 'dt_start', 'dt_end', 'status', 'description', 'checksum', 'size', 'table_count', 'row_count', 'database_size', 'estimated_duration', 'throughput', 'peak_rss')
         return super(BackupAdmin, self).add_view(request, form_url, extra_context)
 
     def change_view(self, request, object_id, form_url='', extra_context=None):
@@ -72,6 +128,7 @@ class BackupAdmin(admin.ModelAdmin):
 
     def save_model(self, request, obj, form, change):
         super().save_model(request, obj, form, change)  # Save the model
+        result = None
         # Verify if the status is not 'Not Started'
         if obj.status == STATUS.PENDING.value:
             # Start the backup
@@ -83,26 +140,45 @@ class BackupAdmin(admin.ModelAdmin):
                 countdown=(obj.dt_create - timezone.now()).total_seconds()
             )
 
-        # Set the task id
-        obj.set_task(result.id)
-        obj.save()
+        # Set the task id (only the column, the task may already be running)
+        if result:
+            obj.store_task(result.id)
 
 
 admin.site.register(Backup, BackupAdmin)
 
 
+class EnvironmentBackupRunAdmin(RelatedAdmin):
+    # The runs are created by the backups of the environments (backup_environment)
+    list_select_related = ('environment',)
+    list_display = ('name', 'environment', 'dt_create', 'dt_start', 'dt_predicted_end', 'dt_end', 'duration', 'backup_count', 'failed_count', 'size', 'status', 'description')
+    search_fields = ('name', 'environment__name', 'status')
+    list_filter = ('environment', 'status')
+    readonly_fields = ('name', 'environment', 'task_id', 'dt_create', 'dt_start', 'dt_predicted_end', 'dt_end', 'status', 'description', 'backup_count', 'failed_count', 'size', 'throughput', 'peak_rss')
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(EnvironmentBackupRun, EnvironmentBackupRunAdmin)
+
+
 class RestoreAdminForm(forms.ModelForm):
     user = forms.CharField(max_length=255, required=False, help_text='User with permission to perform restore')
     password = forms.CharField(max_length=255, widget=forms.PasswordInput, required=False, help_text='Password of user with permission to perform restore')
     to_keep_old_data = forms.BooleanField(initial=True, required=False, help_text='Keep old data in the destination database (rename current schemas to {schema_old_DD_MM_YYYY_HH_MM})')
     to_ignore_public_schema = forms.BooleanField(initial=True, required=False, help_text='Ignore public schema in the destination database')
+    jobs = forms.IntegerField(initial=1, min_value=1, help_text='Number of parallel jobs used by pg_restore (only used in custom and directory formats)')
+    to_verify_checksum = forms.BooleanField(initial=True, required=False, help_text='Verify the checksum of the backup while restoring it (before restoring it in custom and directory formats)')
 
     class Meta:
         model = Restore
         fields = '__all__'
 
 
-class RestoreAdmin(admin.ModelAdmin):
+class RestoreAdmin(TaskProgressMixin, RelatedAdmin):
+    list_select_related = ('origin_backup__database__project', 'origin_backup__database__environment', 'destination_database__project', 'destination_database__environment')
+
     def truncated_description(self, obj):
         if not obj.description:  # Verify if it is empty
             return obj.description
@@ -113,15 +189,15 @@ class RestoreAdmin(admin.ModelAdmin):
         else:
             return obj.description
 
-    list_display = ('name', 'origin_backup', 'destination_database', 'dt_create', 'dt_start', 'dt_end', 'status', 'truncated_description')
-    search_fields = ('name', 'origin_backup__name', 'origin_backup__project__name', 'destination_database__name', 'dt_start', 'status')
+    list_display = ('name', 'origin_backup', 'destination_database', 'dt_create', 'dt_start', 'dt_end', 'status', 'progress', 'truncated_description')
+    search_fields = ('name', 'origin_backup__name', 'origin_backup__database__project__name', 'destination_database__name', 'dt_start', 'status')
     list_filter = ('destination_database', 'destination_database__project', 'destination_database__environment', 'status')
-    autocomplete_fields = ('origin_backup', 'destination_database')
+    autocomplete_fields = ('origin_backup', 'destination_database', 'profile')
 
     form = RestoreAdminForm
 
     def add_view(self, request, form_url='', extra_context=None):
-        self.exclude = ('task_id', 'dt_start', 'dt_end', 'status', 'description')
+        self.exclude = ('task_id', 'dt_start', 'dt_end', 'status', 'description', 'throughput', 'peak_rss')
         return super(RestoreAdmin, self).add_view(request, form_url, extra_context)
 
     def change_view(self, request, object_id, form_url='', extra_context=None):
@@ -130,25 +206,138 @@ class RestoreAdmin(admin.ModelAdmin):
 
     def save_model(self, request, obj, form, change):
         super().save_model(request, obj, form, change)  # Save the model
+        result = None
         # Verify if the status is not 'Not Started'
         if obj.status == STATUS.PENDING.value:
             # Start the restore
-            result = tasks.perform_restore.delay(obj.id, form.cleaned_data.get('user'), form.cleaned_data.get('password'), form.cleaned_data.get('to_keep_old_data'), form.cleaned_data.get('to_ignore_public_schema'))
+            result = tasks.perform_restore.delay(obj.id, form.cleaned_data.get('user'), form.cleaned_data.get('password'), form.cleaned_data.get('to_keep_old_data'), form.cleaned_data.get('to_ignore_public_schema'), form.cleaned_data.get('jobs'), form.cleaned_data.get('to_verify_checksum'))
         elif obj.status == STATUS.SCHEDULED.value:
             # Schedule the restore
             result = tasks.perform_restore.apply_async(
-                args=[obj.id, form.cleaned_data.get('user'), form.cleaned_data.get('password'), form.cleaned_data.get('to_keep_old_data'), form.cleaned_data.get('to_ignore_public_schema')],
+                args=[obj.id, form.cleaned_data.get('user'), form.cleaned_data.get('password'), form.cleaned_data.get('to_keep_old_data'), form.cleaned_data.get('to_ignore_public_schema'), form.cleaned_data.get('jobs'), form.cleaned_data.get('to_verify_checksum')],
                 countdown=(obj.dt_create - timezone.now()).total_seconds()
             )
 
-        # Set the task id
-        obj.set_task(result.id)
-        obj.save()
+        # Set the task id (only the column, the task may already be running)
+        if result:
+            obj.store_task(result.id)
 
 
 admin.site.register(Restore, RestoreAdmin)
 
 
+class DatabaseCopyAdminForm(forms.ModelForm):
+    user = forms.CharField(max_length=255, required=False, help_text='User with permission to dump the origin database and to recreate the destination database')
+    password = forms.CharField(max_length=255, widget=forms.PasswordInput, required=False, help_text='Password of user with permission to dump the origin database and to recreate the destination database')
+    jobs = forms.IntegerField(initial=1, min_value=1, help_text='Number of groups of tables copied at the same time, each one through its own pipe')
+
+    class Meta:
+        model = DatabaseCopy
+        fields = '__all__'
+
+
+class DatabaseCopyAdmin(TaskProgressMixin, RelatedAdmin):
+    list_select_related = ('origin_database__project', 'origin_database__environment', 'destination_database__project', 'destination_database__environment')
+    list_display = ('name', 'origin_database', 'destination_database', 'size', 'dt_create', 'dt_start', 'dt_end', 'status', 'progress', 'description')
+    search_fields = ('name', 'origin_database__name', 'destination_database__name', 'status')
+    list_filter = ('destination_database__project', 'destination_database__environment', 'status')
+    autocomplete_fields = ('origin_database', 'destination_database')
+
+    form = DatabaseCopyAdminForm
+
+    def add_view(self, request, form_url='', extra_context=None):
+        self.exclude = ('task_id', 'dt_start', 'dt_end', 'status', 'description', 'size', 'throughput', 'peak_rss')
+        return super(DatabaseCopyAdmin, self).add_view(request, form_url, extra_context)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        self.exclude = ('task_id',)
+        return super(DatabaseCopyAdmin, self).change_view(request, object_id, form_url, extra_context)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)  # Save the model
+        # Verify if the status is not 'Not Started'
+        if obj.status == STATUS.PENDING.value:
+            # Start the copy
+            result = tasks.perform_copy.delay(obj.id, form.cleaned_data.get('user'), form.cleaned_data.get('password'), form.cleaned_data.get('jobs'))
+
+            # Set the task id (only the column, the task may already be running)
+            obj.store_task(result.id)
+
+
+admin.site.register(DatabaseCopy, DatabaseCopyAdmin)
+
+
+class BaseBackupAdminForm(forms.ModelForm):
+    user = forms.CharField(max_length=255, required=False, help_text='User with the REPLICATION privilege | Default: "{host.user}"')
+    password = forms.CharField(max_length=255, widget=forms.PasswordInput, required=False, help_text='Password of user with the REPLICATION privilege | Default: "{host.password}"')
+
+    class Meta:
+        model = BaseBackup
+        fields = '__all__'
+
+
+class BaseBackupAdmin(RelatedAdmin):
+    list_select_related = ('host',)
+    list_display = ('name', 'path', 'host', 'dt_create', 'dt_start', 'dt_end', 'status', 'description')
+    search_fields = ('name', 'path', 'host__name', 'status')
+    list_filter = ('host', 'status')
+    autocomplete_fields = ('host',)
+
+    form = BaseBackupAdminForm
+
+    def add_view(self, request, form_url='', extra_context=None):
+        self.exclude = ('task_id', 'path', 'dt_start', 'dt_end', 'status', 'description', 'throughput', 'peak_rss')
+        return super(BaseBackupAdmin, self).add_view(request, form_url, extra_context)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        self.exclude = ('task_id', 'path')
+        return super(BaseBackupAdmin, self).change_view(request, object_id, form_url, extra_context)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)  # Save the model
+        # Verify if the status is not 'Not Started'
+        if obj.status == STATUS.PENDING.value:
+            # Start the base backup
+            user = form.cleaned_data.get('user') or obj.host.user
+            password = form.cleaned_data.get('password') or obj.host.password
+            result = tasks.perform_base_backup.delay(obj.id, user, password)
+
+            # Set the task id (only the column, the task may already be running)
+            obj.store_task(result.id)
+
+
+admin.site.register(BaseBackup, BaseBackupAdmin)
+
+
+class PointInTimeRestoreAdmin(RelatedAdmin):
+    list_select_related = ('host', 'base_backup__host')
+    list_display = ('name', 'host', 'target_time', 'data_directory', 'base_backup', 'dt_create', 'dt_start', 'dt_end', 'status', 'description')
+    search_fields = ('name', 'host__name', 'data_directory', 'status')
+    list_filter = ('host', 'status')
+    autocomplete_fields = ('host',)
+
+    def add_view(self, request, form_url='', extra_context=None):
+        self.exclude = ('task_id', 'dt_start', 'dt_end', 'status', 'description', 'base_backup', 'throughput', 'peak_rss')
+        return super(PointInTimeRestoreAdmin, self).add_view(request, form_url, extra_context)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        self.exclude = ('task_id',)
+        return super(PointInTimeRestoreAdmin, self).change_view(request, object_id, form_url, extra_context)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)  # Save the model
+        # Verify if the status is not 'Not Started'
+        if obj.status == STATUS.PENDING.value:
+            # Start the restore
+            result = tasks.perform_point_in_time_restore.delay(obj.id)
+
+            # Set the task id (only the column, the task may already be running)
+            obj.store_task(result.id)
+
+
+admin.site.register(PointInTimeRestore, PointInTimeRestoreAdmin)
+
+
 class PeriodicTaskAdminForm(forms.ModelForm):
     crontab = forms.ModelChoiceField(
         queryset=CrontabSchedule.objects.all(),
@@ -165,10 +354,20 @@ class PeriodicTaskAdminForm(forms.ModelForm):
             self.fields['crontab'].initial = self.instance.periodic_task.crontab  # Set the initial value as the current
 
 
-class PeriodicTaskAdmin(admin.ModelAdmin):
+class PeriodicTaskAdmin(RelatedAdmin):
     def enabled(self, obj) -> bool:
         return obj.periodic_task.enabled if obj.periodic_task else None
 
+    @admin.display(description='Next start')
+    def next_start(self, obj):
+        # Next time of the schedule, plus the offset of the task in its spread window
+        if not obj.periodic_task or not obj.periodic_task.crontab:
+            return None
+
+        now = timezone.now().replace(microsecond=0)
+        next_run = now + obj.periodic_task.crontab.schedule.remaining_estimate(now)
+        return timezone.localtime(next_run + timedelta(seconds=obj.spread_offset()))
+
     form = PeriodicTaskAdminForm
 
     def add_view(self, request, form_url="", extra_context=None):
@@ -201,16 +400,27 @@ class PeriodicTaskAdmin(admin.ModelAdmin):
 
 
 class PeriodicDatabaseBackupAdmin(PeriodicTaskAdmin):
-    list_display = ('name', 'enabled', 'periodic_task', 'database')
-    autocomplete_fields = ('periodic_task', 'database')
+    list_select_related = ('periodic_task__crontab', 'database__project', 'database__environment')
+    list_display = ('name', 'enabled', 'periodic_task', 'database', 'spread_window', 'next_start')
+    autocomplete_fields = ('periodic_task', 'database', 'profile')
 
 
 admin.site.register(PeriodicDatabaseBackup, PeriodicDatabaseBackupAdmin)
 
 
 class PeriodicEnvironmentBackupAdmin(PeriodicTaskAdmin):
-    list_display = ('name', 'enabled', 'periodic_task', 'environment')
+    list_select_related = ('periodic_task__crontab', 'environment')
+    list_display = ('name', 'enabled', 'periodic_task', 'environment', 'spread_window', 'next_start')
     autocomplete_fields = ('periodic_task', 'environment')
 
 
 admin.site.register(PeriodicEnvironmentBackup, PeriodicEnvironmentBackupAdmin)
+
+
+class PeriodicHostBackupAdmin(PeriodicTaskAdmin):
+    list_select_related = ('periodic_task__crontab', 'host')
+    list_display = ('name', 'enabled', 'periodic_task', 'host', 'spread_window', 'next_start')
+    autocomplete_fields = ('periodic_task', 'host')
+
+
+admin.site.register(PeriodicHostBackup, PeriodicHostBackupAdmin)
@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from django.conf import settings
+
+from backup_manager.models import Host
+
+# Pools and server versions are kept per worker process (they are reset after a fork)
+_pools = {}
+_versions = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def _check_fork():
+    global _pid
+    # The connections of the parent process can't be shared with the child, so start from scratch
+    if _pid != os.getpid():
+        _pools.clear()
+        _versions.clear()
+        _pid = os.getpid()
+
+
+class Pool:
+    # Idle connections to a database, kept by the worker process (up to BACKUP_POOL_SIZE) for the next tasks
+    def __init__(self, **params):
+        self.params = params
+        self.idle = []  # (connection, when it was given back)
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection, idle_since = self.idle.pop()  # The most recently used one
+
+            # The server may close the connections idle for long, so only those are checked before being reused
+            if connection.closed:
+                continue
+            if time.monotonic() - idle_since < settings.BACKUP_POOL_CHECK_AFTER:
+                return connection
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1 ;')
+                connection.rollback()
+                return connection
+            except psycopg2.Error:
+                connection.close()
+
+        return psycopg2.connect(**self.params)
+
+    def putconn(self, connection, close: bool = False):
+        if not close and not connection.closed:
+            try:
+                connection.rollback()  # Uncommitted transactions are rolled back (no round trip if there is none)
+            except psycopg2.Error:
+                close = True
+
+        with self.lock:
+            if not close and not connection.closed and len(self.idle) < settings.BACKUP_POOL_SIZE:
+                self.idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def closeall(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            connection.close()
+
+
+def get_pool(host: Host, dbname: str, user: str, password: str) -> Pool:
+    _check_fork()
+
+    key = (host.ip, host.port, dbname, user, password)
+    with _lock:
+        if key not in _pools:
+            _pools[key] = Pool(
+                host=host.ip,
+                port=host.port,
+                dbname=dbname,
+                user=user,
+                password=password,
+                connect_timeout=settings.BACKUP_CONNECT_TIMEOUT,
+            )
+        return _pools[key]
+
+
+def close_pool(host: Host, dbname: str):
+    _check_fork()
+
+    # Close the idle connections to a database (e.g. before dropping it)
+    with _lock:
+        for key in [key for key in _pools if key[:3] == (host.ip, host.port, dbname)]:
+            _pools.pop(key).closeall()
+
+
+@contextmanager
+def connect(host: Host, dbname: str, user: str, password: str, autocommit: bool = False):
+    pool = get_pool(host, dbname, user, password)
+
+    try:
+        connection = pool.getconn()
+    except Exception:
+        invalidate_server_version(host)
+        raise
+
+    try:
+        connection.autocommit = autocommit
+        yield connection
+    except Exception:
+        # Don't give a connection in an unknown state back to the pool
+        pool.putconn(connection, close=True)
+        raise
+    else:
+        pool.putconn(connection)  # Kept for the next tasks of the worker
+
+
+@contextmanager
+def export_snapshot(host: Host, dbname: str, user: str, password: str):
+    # Other sessions can see the database as of this snapshot (pg_dump --snapshot), while the transaction that exported it
+    # is open (until the end of the block)
+    with connect(host, dbname, user, password, autocommit=True) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute('BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY ;')
+            cursor.execute('SELECT pg_export_snapshot() ;')
+            yield cursor.fetchone()[0]
+            cursor.execute('COMMIT ;')
+
+
+def get_server_version(host: Host, dbname: str, user: str, password: str) -> str:
+    _check_fork()
+
+    # The version of the server is cached per host for a while
+    cached = _versions.get((host.ip, host.port))
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    with connect(host, dbname, user, password) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT version() ;')
+            version = cursor.fetchone()[0].split(' ')[1]
+
+    _versions[(host.ip, host.port)] = (version, time.monotonic() + settings.BACKUP_VERSION_CACHE_TTL)
+
+    return version
+
+
+def invalidate_server_version(host: Host):
+    _versions.pop((host.ip, host.port), None)
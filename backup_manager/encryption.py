@@ -0,0 +1,222 @@
+import hashlib
+import os
+import shutil
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+
+from backup_manager import streams
+
+# Encrypted file: header (magic, size of the chunks and random prefix of the nonces) followed by the chunks,
+# each one encrypted with AES-256-GCM and followed by its tag
+MAGIC = b'PGBKENC\x01'
+HEADER = struct.Struct('>8sI8s')
+TAG_SIZE = 16
+
+
+def parse_key(key: str) -> bytes:
+    # The keys are stored in hex
+    try:
+        secret = bytes.fromhex(key)
+    except ValueError:
+        raise ValueError('The encryption key must be in hex')
+    if len(secret) != 32:
+        raise ValueError('The encryption key must have 32 bytes (64 hex digits)')
+    return secret
+
+
+def key_id(secret: bytes) -> str:
+    # Fingerprint of a key stored with the backups encrypted with it, telling which key they need (it doesn't reveal the key)
+    return hashlib.sha256(b'backup_manager key id' + secret).hexdigest()[:16]
+
+
+def nonce(prefix: bytes, index: int) -> bytes:
+    return prefix + struct.pack('>I', index)
+
+
+def associated_data(index: int, is_final: bool) -> bytes:
+    # Each chunk is bound to its position and to being the last one, so chunks can't be reordered, dropped or truncated
+    return struct.pack('>Q?', index, is_final)
+
+
+class EncryptingWriter:
+    # Encrypts a stream chunk by chunk into a file, the chunks are encrypted in parallel and written in order
+    def __init__(self, file, key: bytes, chunk_size: int = None):
+        self.file = file
+        self.cipher = AESGCM(key)
+        self.chunk_size = chunk_size or settings.BACKUP_ENCRYPTION_CHUNK_SIZE
+        self.prefix = os.urandom(8)
+        self.index = 0
+        self.buffer = bytearray()
+        self.futures = deque()
+        self.threads = settings.BACKUP_ENCRYPTION_THREADS
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+        self.file.write(HEADER.pack(MAGIC, self.chunk_size, self.prefix))
+
+    def write(self, chunk: bytes):
+        self.buffer += chunk
+        # The last chunk is only known when the stream ends, so a full chunk is kept until more data comes
+        while len(self.buffer) > self.chunk_size:
+            self.encrypt(bytes(self.buffer[:self.chunk_size]), is_final=False)
+            del self.buffer[:self.chunk_size]
+
+    def encrypt(self, data: bytes, is_final: bool):
+        self.futures.append(self.executor.submit(self.cipher.encrypt, nonce(self.prefix, self.index), data, associated_data(self.index, is_final)))
+        self.index += 1
+
+        # Write the chunks already encrypted, keeping at most two per thread in memory
+        while self.futures and (self.futures[0].done() or len(self.futures) > 2 * self.threads):
+            self.file.write(self.futures.popleft().result())
+
+    def close(self):
+        try:
+            self.encrypt(bytes(self.buffer), is_final=True)
+            while self.futures:
+                self.file.write(self.futures.popleft().result())
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Without close() (the stream failed) the last chunk is never written, but the threads are always stopped
+        self.executor.shutdown(cancel_futures=True)
+
+
+def read_exactly(file, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = file.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_header(data: bytes) -> (int, bytes):
+    if len(data) < HEADER.size:
+        raise ValueError('The backup is not encrypted or is corrupted')
+    magic, chunk_size, prefix = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC:
+        raise ValueError('The backup is not encrypted or is corrupted')
+    return chunk_size, prefix
+
+
+def decrypt_chunk(cipher: AESGCM, prefix: bytes, index: int, data: bytes, is_final: bool) -> bytes:
+    try:
+        return cipher.decrypt(nonce(prefix, index), data, associated_data(index, is_final))
+    except InvalidTag:
+        raise ValueError(f'Chunk {index} of the backup can\'t be decrypted: wrong key, or the backup is corrupted')
+
+
+class DecryptingReader:
+    # Decrypts a file into a stream, the next chunks are decrypted in parallel while the current one is read
+    def __init__(self, file, key: bytes):
+        self.file = file
+        self.cipher = AESGCM(key)
+        self.chunk_size, self.prefix = read_header(read_exactly(file, HEADER.size))
+        self.index = 0
+        self.next_chunk = read_exactly(file, self.chunk_size + TAG_SIZE)
+        self.buffer = b''
+        self.futures = deque()
+        self.threads = settings.BACKUP_ENCRYPTION_THREADS
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+    def fill(self):
+        # A chunk is the last one when nothing follows it
+        while self.next_chunk is not None and len(self.futures) < 2 * self.threads:
+            data = self.next_chunk
+            following = read_exactly(self.file, self.chunk_size + TAG_SIZE)
+            self.next_chunk = following or None
+            self.futures.append(self.executor.submit(decrypt_chunk, self.cipher, self.prefix, self.index, data, not following))
+            self.index += 1
+
+    def read(self, size: int = streams.CHUNK_SIZE) -> bytes:
+        while len(self.buffer) < size:
+            self.fill()
+            if not self.futures:
+                break
+            self.buffer += self.futures.popleft().result()
+
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        if not chunk:
+            self.executor.shutdown(cancel_futures=True)
+        return chunk
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # The stream may not be read to its end (e.g. psql exited early)
+        self.close()
+
+
+def decrypt_range(storage, key: str, secret: bytes, start: int, length: int) -> bytes:
+    # Decrypt a range of the original bytes of a file in the storage, downloading only the chunks that hold it
+    cipher = AESGCM(secret)
+    chunk_size, prefix = read_header(storage.read_range(key, 0, HEADER.size))
+    stored_chunk_size = chunk_size + TAG_SIZE
+    chunks = max(-(-(storage.size(key) - HEADER.size) // stored_chunk_size), 1)
+
+    first = start // chunk_size
+    if length <= 0 or first >= chunks:
+        return b''
+    last = min((start + length - 1) // chunk_size, chunks - 1)
+
+    data = storage.read_range(key, HEADER.size + first * stored_chunk_size, (last - first + 1) * stored_chunk_size)
+    with ThreadPoolExecutor(max_workers=settings.BACKUP_ENCRYPTION_THREADS) as executor:
+        plain = b''.join(executor.map(
+            lambda index: decrypt_chunk(cipher, prefix, index, data[(index - first) * stored_chunk_size:(index - first + 1) * stored_chunk_size], index == chunks - 1),
+            range(first, last + 1),
+        ))
+
+    offset = start - first * chunk_size
+    return plain[offset:offset + length]
+
+
+def encrypt_directory(path: str, storage, key: str, secret: bytes) -> (str, int, dict):
+    # Encrypt each file of a directory into the storage, returning the checksums of the encrypted files
+    # (in the format of streams.directory_checksum)
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            file_path = os.path.join(root, name)
+            relative_path = os.path.relpath(file_path, path)
+            with open(file_path, 'rb') as file, storage.open_write(os.path.join(key, relative_path)) as destination:
+                output = streams.ChecksumWriter(streams.throttled(destination))
+                with EncryptingWriter(output, secret) as writer:
+                    shutil.copyfileobj(file, writer, streams.CHUNK_SIZE)
+                    writer.close()
+            files[relative_path] = {'checksum': output.hexdigest(), 'size': output.size}
+
+    return streams.combined_checksum(files), sum(file['size'] for file in files.values()), files
+
+
+def decrypt_file(storage, key: str, secret: bytes, path: str):
+    # Decrypt a file of the storage straight into a local file, downloading it in ranges (so no encrypted copy is staged)
+    with open(path, 'wb') as output:
+        start = 0
+        while True:
+            data = decrypt_range(storage, key, secret, start, settings.BACKUP_S3_PART_SIZE)
+            if not data:
+                break
+            output.write(data)
+            start += len(data)
+
+
+def decrypt_into(storage, key: str, secret: bytes, path: str, is_directory: bool = False):
+    # Decrypt a file, or each file of a directory, of the storage into the path
+    names = storage.list_files(key) if is_directory else [None]
+    for name in names:
+        file_path = os.path.join(path, name) if name else path
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        decrypt_file(storage, os.path.join(key, name) if name else key, secret, file_path)
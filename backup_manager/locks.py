@@ -0,0 +1,131 @@
+import time
+
+import redis
+from django.conf import settings
+
+# Takes a slot in every semaphore or in none of them (a holder that already has its slots keeps them)
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local expire_at = tonumber(ARGV[2])
+local token = ARGV[3]
+
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    if not redis.call('ZSCORE', key, token) and redis.call('ZCARD', key) >= tonumber(ARGV[3 + i]) then
+        return 0
+    end
+end
+
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, expire_at, token)
+end
+
+return 1
+"""
+
+# Takes the bytes transferred from the bandwidth (token bucket) of the storage, returning the seconds to wait.
+# The tokens can go below zero: every request is granted and waits until the debt before it is paid, so the requests
+# are served in the order they arrive and a big one is never starved by smaller ones
+CONSUME_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate) - requested
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 60)
+redis.call('INCRBY', KEYS[2], requested)
+
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+# Keys of the bandwidth and of the concurrency of the storage, shared by all the hosts
+STORAGE_BUCKET_KEY = 'backup_manager:storage:bucket'
+STORAGE_BYTES_KEY = 'backup_manager:storage:bytes'
+STORAGE_MEASURED_KEY = 'backup_manager:storage:measured'
+STORAGE_LIMIT_KEY = 'backup_manager:storage:limit'
+STORAGE_SLOTS_KEY = 'backup_manager:slots:storage'
+
+STORAGE_DECREASE_FACTOR = 0.75  # Applied to the concurrency of the storage when it is saturated
+
+_client = None
+
+
+def get_client() -> redis.Redis:
+    # One client per process, shared by the tasks
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.BACKUP_LOCK_URL)
+    return _client
+
+
+def acquire(slots: dict, token: str, time_limit: int) -> bool:
+    # Nothing to acquire if there are no limits
+    if not slots:
+        return True
+
+    # The slots expire after the time limit of the task holding them, so the ones of dead workers are freed
+    now = time.time()
+    expire_at = now + time_limit + 60
+
+    client = get_client()
+    keys = list(slots.keys())
+    limits = [slots[key] for key in keys]
+    return bool(client.eval(ACQUIRE_SCRIPT, len(keys), *keys, now, expire_at, token, *limits))
+
+
+def release(slots: dict, token: str):
+    if not slots:
+        return
+
+    client = get_client()
+    for key in slots:
+        client.zrem(key, token)
+
+
+def consume_bandwidth(size: int) -> float:
+    # Seconds to wait before transferring the bytes, to stay in the bandwidth of the storage
+    rate = settings.BACKUP_STORAGE_BANDWIDTH
+    capacity = rate * settings.BACKUP_STORAGE_BURST
+    keys = [STORAGE_BUCKET_KEY, STORAGE_BYTES_KEY]
+    return float(get_client().eval(CONSUME_SCRIPT, len(keys), *keys, time.time(), rate, capacity, size))
+
+
+def get_storage_limit() -> int:
+    # Number of backups allowed to write into the storage at the same time (adjusted by adjust_storage_limit)
+    limit = get_client().get(STORAGE_LIMIT_KEY)
+    return int(limit) if limit else settings.BACKUP_STORAGE_MAX_CONCURRENT
+
+
+def adjust_storage_limit() -> int:
+    # Additive increase and multiplicative decrease of the concurrency of the storage, from the throughput since the
+    # last adjustment: the limit goes down while the storage is saturated (fewer backups at the same time get the same
+    # throughput, each one finishing sooner) and goes up while there are backups waiting and bandwidth to spare
+    client = get_client()
+    now = time.time()
+    transferred = int(client.getset(STORAGE_BYTES_KEY, 0) or 0)
+    measured = float(client.getset(STORAGE_MEASURED_KEY, now) or now)
+    limit = get_storage_limit()
+
+    if now - measured <= 0:
+        return limit  # First measure
+
+    throughput = transferred / (now - measured)
+    client.zremrangebyscore(STORAGE_SLOTS_KEY, '-inf', now)
+    running = client.zcard(STORAGE_SLOTS_KEY)
+
+    if throughput >= settings.BACKUP_STORAGE_SATURATION * settings.BACKUP_STORAGE_BANDWIDTH:
+        limit = max(settings.BACKUP_STORAGE_MIN_CONCURRENT, int(limit * STORAGE_DECREASE_FACTOR))
+    elif running >= limit:
+        limit = min(settings.BACKUP_STORAGE_MAX_CONCURRENT, limit + 1)
+
+    client.set(STORAGE_LIMIT_KEY, limit)
+    return limit
@@ -0,0 +1,205 @@
+import itertools
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+import psycopg2
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from backup_manager import tasks
+from backup_manager.models import Host, Project, Environment, Database, Backup, Restore, STATUS, FORMAT_CHOICES, \
+    COMPRESSION, COMPRESSION_CHOICES
+
+USER = 'benchmark'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def csv_option(value: str) -> list:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the backups and restores against a throwaway local PostgreSQL (it must not be run as root, initdb refuses it)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pg-bin', help='Folder of the PostgreSQL binaries (initdb, pg_ctl, pg_dump...) | Default: the ones in the PATH')
+        parser.add_argument('--tables', type=int, default=10, help='Number of tables of the synthetic database')
+        parser.add_argument('--rows', type=int, default=100000, help='Number of rows of the largest table (the others get fewer, down to 1/tables of it)')
+        parser.add_argument('--text-size', type=int, default=100, help='Bytes of text in each row')
+        parser.add_argument('--formats', type=csv_option, default=['p', 'c', 'd'], help='Backup formats, comma separated')
+        parser.add_argument('--jobs', type=csv_option, default=['1', '4'], help='Numbers of parallel jobs, comma separated (only used in directory format and in the restores of archives)')
+        parser.add_argument('--compressions', type=csv_option, default=['n', 'gz', 'zst'], help='Compressions, comma separated')
+        parser.add_argument('--levels', type=csv_option, default=['default'], help='Compression levels, comma separated ("default" for the default of the compressor)')
+        parser.add_argument('--repeat', type=int, default=1, help='Runs of each combination')
+        parser.add_argument('--no-restore', action='store_true', help='Only benchmark the backups')
+        parser.add_argument('--output', help='File where the results are written as JSON | Default: stdout')
+        parser.add_argument('--keep', action='store_true', help='Keep the temporary folder (cluster, backups and logs) for inspection')
+
+    def handle(self, *args, **options):
+        formats = [value for value, _ in FORMAT_CHOICES]
+        compressions = [value for value, _ in COMPRESSION_CHOICES]
+        for value in options['formats']:
+            if value not in formats:
+                raise CommandError(f'Invalid format: {value} (choices: {", ".join(formats)})')
+        for value in options['compressions']:
+            if value not in compressions:
+                raise CommandError(f'Invalid compression: {value} (choices: {", ".join(compressions)})')
+
+        # The commands run by the tasks are the ones of the benchmarked version
+        if options['pg_bin']:
+            os.environ['PATH'] = f'{options["pg_bin"]}{os.pathsep}{os.environ["PATH"]}'
+        for command in ['initdb', 'pg_ctl', 'pg_dump', 'pg_restore', 'psql']:
+            if not shutil.which(command):
+                raise CommandError(f'{command} not found, set --pg-bin')
+
+        directory = tempfile.mkdtemp(prefix='backup_manager_benchmark_')
+        port = free_port()
+        data_directory = os.path.join(directory, 'data')
+        try:
+            self.start_cluster(directory, data_directory, port)
+            try:
+                self.generate_database(port, options['tables'], options['rows'], options['text_size'])
+                results = self.run(directory, port, options)
+            finally:
+                subprocess.run(['pg_ctl', '-D', data_directory, '-m', 'fast', 'stop'], capture_output=True)
+        finally:
+            if options['keep']:
+                self.stderr.write(f'Kept {directory}')
+            else:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        output = json.dumps(results, indent=4)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+        else:
+            self.stdout.write(output)
+
+    def start_cluster(self, directory: str, data_directory: str, port: int):
+        self.stderr.write(f'Starting PostgreSQL in {data_directory} (port {port})')
+        subprocess.run(['initdb', '-D', data_directory, '-U', USER, '--auth', 'trust'], check=True, capture_output=True)
+        subprocess.run([
+            'pg_ctl', '-D', data_directory, '-l', os.path.join(directory, 'postgresql.log'), '-w',
+            '-o', f'-p {port} -k {directory} -c listen_addresses=127.0.0.1',
+            'start',
+        ], check=True, capture_output=True)
+
+    def create_database(self, port: int, name: str):
+        maintenance = psycopg2.connect(host='127.0.0.1', port=port, dbname='postgres', user=USER)
+        try:
+            maintenance.autocommit = True
+            with maintenance.cursor() as cursor:
+                cursor.execute(f'CREATE DATABASE {name} ;')
+        finally:
+            maintenance.close()
+
+    def generate_database(self, port: int, tables: int, rows: int, text_size: int):
+        self.stderr.write(f'Generating {tables} tables, up to {rows} rows each')
+        self.create_database(port, 'benchmark')
+
+        database = psycopg2.connect(host='127.0.0.1', port=port, dbname='benchmark', user=USER)
+        try:
+            database.autocommit = True
+            with database.cursor() as cursor:
+                # Tables of decreasing sizes, with an index besides the primary key (rebuilt by the restores)
+                for i in range(tables):
+                    cursor.execute(f"""
+                        CREATE TABLE table_{i} (
+                            id bigint PRIMARY KEY,
+                            amount numeric(12, 2) NOT NULL,
+                            created timestamptz NOT NULL,
+                            content text NOT NULL
+                        ) ;
+                        INSERT INTO table_{i}
+                        SELECT n, random() * 10000, now() - n * interval '1 second', repeat(md5(n::text), {max(text_size // 32, 1)})
+                        FROM generate_series(1, {max(rows * (tables - i) // tables, 1)}) AS n ;
+                        CREATE INDEX table_{i}_created_idx ON table_{i} (created) ;
+                    """)
+
+                # The statistics are the estimates of the sizes used by the tasks
+                cursor.execute('VACUUM ANALYZE ;')
+        finally:
+            database.close()
+
+    @contextmanager
+    def platform_database(self, port: int):
+        # The objects of the benchmark live in a database of the throwaway cluster, the database of the platform (and
+        # its server) is never touched
+        self.create_database(port, 'platform')
+        settings_dict = connection.settings_dict
+        old_settings = dict(settings_dict)
+        connection.close()
+        settings_dict.update(ENGINE='django.db.backends.postgresql', HOST='127.0.0.1', PORT=port, NAME='platform', USER=USER, PASSWORD='', OPTIONS={})
+        try:
+            call_command('migrate', verbosity=0, interactive=False)
+            yield
+        finally:
+            connection.close()
+            settings_dict.clear()
+            settings_dict.update(old_settings)
+
+    def run(self, directory: str, port: int, options: dict) -> list:
+        with self.platform_database(port):
+            # Nobody follows the progress, and the limits of the platform don't apply to the throwaway cluster
+            benchmark_settings = {
+                'BACKUP_PROGRESS_INTERVAL': None,
+                'BACKUP_MAX_CONCURRENT': None,
+                'BACKUP_STORAGE_BANDWIDTH': None,
+            }
+            with override_settings(**benchmark_settings):
+                host = Host.objects.create(name='benchmark', ip='127.0.0.1', port=port, user=USER, password='')
+                project = Project.objects.create(name='benchmark')
+                environment = Environment.objects.create(name='benchmark')
+                origin = Database.objects.create(name='benchmark', host=host, project=project, environment=environment)
+                destination = Database.objects.create(name='benchmark_restore', host=host, project=project, environment=environment)
+
+                levels = [None if level == 'default' else int(level) for level in options['levels']]
+                combinations = itertools.product(options['formats'], [int(jobs) for jobs in options['jobs']], options['compressions'], levels, range(options['repeat']))
+
+                results = []
+                for format, jobs, compression, level, run in combinations:
+                    if compression == COMPRESSION.NONE.value and level is not None:
+                        continue  # Nothing to compress
+
+                    result = {'format': format, 'jobs': jobs, 'compression': compression, 'compression_level': level, 'run': run}
+                    self.stderr.write(f'Benchmarking {result}')
+
+                    # The paths of the backups only change every minute, so each run writes in a folder of its own
+                    with override_settings(BACKUP_STORAGE_ROOT=os.path.join(directory, 'storage', str(len(results)))):
+                        backup = Backup.objects.create(database=origin, format=format, jobs=jobs, compression=compression, compression_level=level)
+                        tasks.perform_backup.apply(args=[backup.id, USER, ''])
+                        backup.refresh_from_db()
+                        result['backup'] = self.task_result(backup, size=backup.size)
+
+                        if not options['no_restore'] and backup.status == STATUS.SUCCESS.value:
+                            restore = Restore.objects.create(origin_backup=backup, destination_database=destination)
+                            tasks.perform_restore.apply(args=[restore.id, USER, '', False, False, jobs, True])
+                            restore.refresh_from_db()
+                            result['restore'] = self.task_result(restore)
+
+                    results.append(result)
+
+                return results
+
+    def task_result(self, obj, **fields) -> dict:
+        duration = obj.duration()
+        return {
+            'status': obj.get_status_display(),
+            'duration': duration.total_seconds() if duration else None,
+            'throughput': obj.throughput,
+            'peak_rss': obj.peak_rss,
+            **fields,
+            'description': obj.description if obj.status == STATUS.FAILED.value else None,
+        }
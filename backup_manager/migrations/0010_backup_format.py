@@ -0,0 +1,44 @@
+# Generated by Django 4.2.5 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0009_alter_periodicdatabasebackup_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='format',
+            field=models.CharField(blank=True, choices=[('p', 'PLAIN'), ('c', 'CUSTOM'), ('d', 'DIRECTORY')], default='p', help_text='Default: "{database.backup_format}"', max_length=1),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='jobs',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Default: "{database.backup_jobs}" | Only used in directory format', null=True),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='backup_format',
+            field=models.CharField(choices=[('p', 'PLAIN'), ('c', 'CUSTOM'), ('d', 'DIRECTORY')], default='p', help_text='Default format of the backups of this database', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='backup_jobs',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Default number of parallel jobs of the backups of this database (only used in directory format)'),
+        ),
+        migrations.AlterField(
+            model_name='periodicdatabasebackup',
+            name='name',
+            field=models.CharField(blank=True, help_text='Default: "Backup {database.project.name} - {database.environment.name} ({database.name}) [{self.periodic_task.crontab.human_readable}]"', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='periodicenvironmentbackup',
+            name='name',
+            field=models.CharField(blank=True, help_text='Default: "Backup {environment.name} [{self.periodic_task.crontab.human_readable}]"', max_length=255),
+        ),
+    ]
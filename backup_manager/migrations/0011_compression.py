@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0010_backup_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='compression',
+            field=models.CharField(blank=True, choices=[('n', 'NONE'), ('gz', 'GZIP'), ('zst', 'ZSTD')], default='n', help_text='Default: "{database.compression}"', max_length=3),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='compression_level',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Default: "{database.compression_level}"', null=True),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='compression',
+            field=models.CharField(choices=[('n', 'NONE'), ('gz', 'GZIP'), ('zst', 'ZSTD')], default='gz', help_text='Default compression of the backups of this database', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='compression_level',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Default compression level of the backups of this database (GZIP: 1-9 | ZSTD: 1-19) | Leave it _blank_ to use the default of the compressor', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 10:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0011_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='max_concurrent_backups',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Max number of backups running at the same time in this host | Leave it _blank_ for no limit', null=True),
+        ),
+    ]
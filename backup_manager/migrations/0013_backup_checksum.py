@@ -0,0 +1,33 @@
+# Generated by Django 4.2.5 on 2026-10-18 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0012_host_max_concurrent_backups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='checksum',
+            field=models.CharField(blank=True, help_text='SHA-256 of the backup file (of the list of files with their checksums in directory format)', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='row_count',
+            field=models.BigIntegerField(blank=True, help_text='Estimated number of rows in the database when backed up', null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='size',
+            field=models.BigIntegerField(blank=True, help_text='Size of the backup in bytes', null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='table_count',
+            field=models.IntegerField(blank=True, help_text='Number of tables in the database when backed up', null=True),
+        ),
+    ]
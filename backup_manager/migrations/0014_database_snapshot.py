@@ -0,0 +1,24 @@
+# Generated by Django 4.2.5 on 2026-10-18 10:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0013_backup_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='database',
+            name='keep_snapshot',
+            field=models.BooleanField(default=False, help_text='Keep the latest backup restored in a database of the host ("{name}_snapshot"), so restores in the same host are cloned from it'),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='snapshot_backup',
+            field=models.ForeignKey(blank=True, help_text='Backup currently in the snapshot database', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='backup_manager.backup'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_beat', '0018_improve_crontab_helptext'),
+        ('backup_manager', '0014_database_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BaseBackup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('dt_create', models.DateTimeField(auto_now_add=True)),
+                ('dt_start', models.DateTimeField(blank=True, null=True)),
+                ('dt_end', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('PD', 'PENDING'), ('ST', 'STARTED'), ('SC', 'SUCCESS'), ('FL', 'FAILED'), ('MN', 'MANUAL'), ('SD', 'SCHEDULED')], default='PD', max_length=2)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('name', models.CharField(blank=True, help_text='Default: "{host.name}_{date_time}"', max_length=255)),
+                ('path', models.CharField(max_length=255)),
+            ],
+            options={
+                'db_table': 'tb_base_backup',
+            },
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='wal_archiving',
+            field=models.BooleanField(default=False, help_text='Stream the WAL of this host into the storage (pg_receivewal), allowing point-in-time restores from its base backups | The user needs the REPLICATION privilege'),
+        ),
+        migrations.CreateModel(
+            name='PointInTimeRestore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('dt_create', models.DateTimeField(auto_now_add=True)),
+                ('dt_start', models.DateTimeField(blank=True, null=True)),
+                ('dt_end', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('PD', 'PENDING'), ('ST', 'STARTED'), ('SC', 'SUCCESS'), ('FL', 'FAILED'), ('MN', 'MANUAL'), ('SD', 'SCHEDULED')], default='PD', max_length=2)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('name', models.CharField(blank=True, help_text='Default: "{host.name} @ {target_time}"', max_length=255)),
+                ('target_time', models.DateTimeField(help_text='Time until which the WAL is replayed')),
+                ('data_directory', models.CharField(help_text='Empty directory, reachable by the workers, where the data directory of the recovered cluster is prepared', max_length=255)),
+                ('base_backup', models.ForeignKey(blank=True, help_text='Base backup used (the latest one finished before the target time)', null=True, on_delete=django.db.models.deletion.SET_NULL, to='backup_manager.basebackup')),
+                ('host', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backup_manager.host')),
+            ],
+            options={
+                'db_table': 'tb_point_in_time_restore',
+            },
+        ),
+        migrations.CreateModel(
+            name='PeriodicHostBackup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, help_text='Default: "Base backup {host.name} [{self.periodic_task.crontab.human_readable}]"', max_length=255)),
+                ('host', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backup_manager.host')),
+                ('periodic_task', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='django_celery_beat.periodictask')),
+            ],
+            options={
+                'db_table': 'tb_periodic_host_backup',
+            },
+        ),
+        migrations.AddField(
+            model_name='basebackup',
+            name='host',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backup_manager.host'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0015_wal_archiving'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the commands run by the task, or of the worker', null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='throughput',
+            field=models.FloatField(blank=True, help_text='Bytes per second written (backups) or read (restores)', null=True),
+        ),
+        migrations.AddField(
+            model_name='basebackup',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the commands run by the task, or of the worker', null=True),
+        ),
+        migrations.AddField(
+            model_name='basebackup',
+            name='throughput',
+            field=models.FloatField(blank=True, help_text='Bytes per second written (backups) or read (restores)', null=True),
+        ),
+        migrations.AddField(
+            model_name='pointintimerestore',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the commands run by the task, or of the worker', null=True),
+        ),
+        migrations.AddField(
+            model_name='pointintimerestore',
+            name='throughput',
+            field=models.FloatField(blank=True, help_text='Bytes per second written (backups) or read (restores)', null=True),
+        ),
+        migrations.AddField(
+            model_name='restore',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the commands run by the task, or of the worker', null=True),
+        ),
+        migrations.AddField(
+            model_name='restore',
+            name='throughput',
+            field=models.FloatField(blank=True, help_text='Bytes per second written (backups) or read (restores)', null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0016_task_metrics'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['database', 'dt_create'], name='tb_backup_database_dt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['status'], name='tb_backup_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['task_id'], name='tb_backup_task_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['dt_end'], name='tb_backup_dt_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restore',
+            index=models.Index(fields=['destination_database', 'dt_create'], name='tb_restore_database_dt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restore',
+            index=models.Index(fields=['status'], name='tb_restore_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restore',
+            index=models.Index(fields=['task_id'], name='tb_restore_task_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restore',
+            index=models.Index(fields=['dt_end'], name='tb_restore_dt_end_idx'),
+        ),
+    ]
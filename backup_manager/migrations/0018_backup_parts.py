@@ -0,0 +1,51 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0017_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='shards',
+            field=models.PositiveSmallIntegerField(blank=True, default=1, help_text='Default: "{database.backup_shards}" | When more than 1, the backup is a folder with one part per worker', null=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='backup_shards',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Default number of workers the backups of this database are split across (each one dumps part of the tables, all from the same snapshot) | 1 to dump it in a single worker'),
+        ),
+        migrations.CreateModel(
+            name='BackupPart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('dt_create', models.DateTimeField(auto_now_add=True)),
+                ('dt_start', models.DateTimeField(blank=True, null=True)),
+                ('dt_end', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('PD', 'PENDING'), ('ST', 'STARTED'), ('SC', 'SUCCESS'), ('FL', 'FAILED'), ('MN', 'MANUAL'), ('SD', 'SCHEDULED')], default='PD', max_length=2)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('throughput', models.FloatField(blank=True, help_text='Bytes per second written (backups) or read (restores)', null=True)),
+                ('peak_rss', models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the commands run by the task, or of the worker', null=True)),
+                ('number', models.PositiveSmallIntegerField(help_text='Order in which the part is restored')),
+                ('section', models.CharField(choices=[('pre-data', 'PRE_DATA'), ('data', 'DATA'), ('post-data', 'POST_DATA')], max_length=9)),
+                ('tables', models.JSONField(blank=True, help_text='Tables whose data is in this part | Blank in the part with the data of all the other tables (and of the sequences)', null=True)),
+                ('estimated_size', models.BigIntegerField(blank=True, help_text='Size of the tables of this part in the database, in bytes', null=True)),
+                ('path', models.CharField(max_length=255)),
+                ('checksum', models.CharField(blank=True, help_text='SHA-256 of the part file (of the list of files with their checksums in directory format)', max_length=64, null=True)),
+                ('size', models.BigIntegerField(blank=True, help_text='Size of the part in bytes', null=True)),
+                ('backup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='backup_manager.backup')),
+            ],
+            options={
+                'db_table': 'tb_backup_part',
+                'ordering': ['number'],
+            },
+        ),
+    ]
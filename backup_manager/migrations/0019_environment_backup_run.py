@@ -0,0 +1,41 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0018_backup_parts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnvironmentBackupRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('dt_create', models.DateTimeField(auto_now_add=True)),
+                ('dt_start', models.DateTimeField(blank=True, null=True)),
+                ('dt_end', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('PD', 'PENDING'), ('ST', 'STARTED'), ('SC', 'SUCCESS'), ('FL', 'FAILED'), ('MN', 'MANUAL'), ('SD', 'SCHEDULED')], default='PD', max_length=2)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('throughput', models.FloatField(blank=True, help_text='Bytes per second written (backups) or read (restores)', null=True)),
+                ('peak_rss', models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the commands run by the task, or of the worker', null=True)),
+                ('name', models.CharField(blank=True, help_text='Default: "{environment.name}_{date_time}"', max_length=255)),
+                ('backup_count', models.IntegerField(blank=True, help_text='Number of backups in the run', null=True)),
+                ('failed_count', models.IntegerField(blank=True, help_text='Number of backups of the run that failed', null=True)),
+                ('size', models.BigIntegerField(blank=True, help_text='Total size of the backups of the run in bytes', null=True)),
+                ('environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backup_manager.environment')),
+            ],
+            options={
+                'db_table': 'tb_environment_backup_run',
+            },
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='environment_run',
+            field=models.ForeignKey(blank=True, help_text='Backup of the whole environment this backup is part of', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='backups', to='backup_manager.environmentbackuprun'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0019_environment_backup_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatabaseCopy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('dt_create', models.DateTimeField(auto_now_add=True)),
+                ('dt_start', models.DateTimeField(blank=True, null=True)),
+                ('dt_end', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('PD', 'PENDING'), ('ST', 'STARTED'), ('SC', 'SUCCESS'), ('FL', 'FAILED'), ('MN', 'MANUAL'), ('SD', 'SCHEDULED')], default='PD', max_length=2)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('throughput', models.FloatField(blank=True, help_text='Bytes per second written (backups) or read (restores)', null=True)),
+                ('peak_rss', models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the commands run by the task, or of the worker', null=True)),
+                ('name', models.CharField(blank=True, help_text='Default: "{origin_database} -> {destination_database}"', max_length=255)),
+                ('size', models.BigIntegerField(blank=True, help_text='Size of the tables copied in bytes (from the statistics of the origin database)', null=True)),
+                ('destination_database', models.ForeignKey(help_text='Its data is replaced by the one of the origin database', on_delete=django.db.models.deletion.CASCADE, related_name='copies_to', to='backup_manager.database')),
+                ('origin_database', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='copies_from', to='backup_manager.database')),
+            ],
+            options={
+                'db_table': 'tb_database_copy',
+            },
+        ),
+    ]
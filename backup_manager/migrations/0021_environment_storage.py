@@ -0,0 +1,44 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:19
+
+from django.db import migrations, models
+import django_cryptography.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0020_database_copy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environment',
+            name='s3_access_key',
+            field=models.CharField(blank=True, help_text='Only used in S3 storage | Leave it _blank_ to use the credentials of the workers', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='s3_bucket',
+            field=models.CharField(blank=True, help_text='Only used in S3 storage', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='s3_endpoint_url',
+            field=models.CharField(blank=True, help_text='Only used in S3 storage | Leave it _blank_ for AWS', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='s3_region',
+            field=models.CharField(blank=True, help_text='Only used in S3 storage', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='s3_secret_key',
+            field=django_cryptography.fields.encrypt(models.CharField(blank=True, help_text='Only used in S3 storage (encrypted)', max_length=255, null=True)),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='storage',
+            field=models.CharField(choices=[('local', 'LOCAL'), ('s3', 'S3')], default='local', help_text='Where the backups of this environment are stored | LOCAL: the folder of the storage in the workers | S3: a bucket of an S3 compatible storage', max_length=5),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:21
+
+from django.db import migrations, models
+import django_cryptography.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0021_environment_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='encrypted',
+            field=models.BooleanField(default=False, help_text='Encrypted with the key of the environment'),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='encryption_key',
+            field=django_cryptography.fields.encrypt(models.CharField(blank=True, help_text='AES-256 key the new backups of this environment are encrypted with, in hex (e.g. `python -c "import secrets; print(secrets.token_hex(32))"`) | Leave it _blank_ to not encrypt them | The backups encrypted with a previous key can only be restored with it (encrypted)', max_length=64, null=True)),
+        ),
+    ]
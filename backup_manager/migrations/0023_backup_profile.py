@@ -0,0 +1,48 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0022_backup_encryption'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('schema_only', models.BooleanField(default=False, help_text='Dump only the schema, without any data')),
+                ('include_tables', models.TextField(blank=True, help_text='Patterns of the tables dumped (pg_dump --table), one per line | Leave it _blank_ for all the tables')),
+                ('exclude_tables', models.TextField(blank=True, help_text='Patterns of the tables not dumped (pg_dump --exclude-table), one per line')),
+                ('exclude_table_data', models.TextField(blank=True, help_text='Patterns of the tables dumped without their data (pg_dump --exclude-table-data), one per line | E.g. the audit and log tables')),
+            ],
+            options={
+                'db_table': 'tb_backup_profile',
+            },
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='profile',
+            field=models.ForeignKey(blank=True, help_text='Default: "{database.backup_profile}"', null=True, on_delete=django.db.models.deletion.PROTECT, to='backup_manager.backupprofile'),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='backup_profile',
+            field=models.ForeignKey(blank=True, help_text='Default profile of the backups of this database | Leave it _blank_ to dump everything', null=True, on_delete=django.db.models.deletion.SET_NULL, to='backup_manager.backupprofile'),
+        ),
+        migrations.AddField(
+            model_name='periodicdatabasebackup',
+            name='profile',
+            field=models.ForeignKey(blank=True, help_text='Default: "{database.backup_profile}"', null=True, on_delete=django.db.models.deletion.SET_NULL, to='backup_manager.backupprofile'),
+        ),
+        migrations.AddField(
+            model_name='restore',
+            name='profile',
+            field=models.ForeignKey(blank=True, help_text='Restore only the data of the tables of this profile (the schema is restored whole) | Only used in custom and directory formats | Leave it _blank_ to restore the whole backup', null=True, on_delete=django.db.models.deletion.SET_NULL, to='backup_manager.backupprofile'),
+        ),
+    ]
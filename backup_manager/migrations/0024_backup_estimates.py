@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0023_backup_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='database_size',
+            field=models.BigIntegerField(blank=True, help_text='Size of the database (pg_database_size) when backed up, in bytes', null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='estimated_duration',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds the backup was expected to take when dispatched by its environment run', null=True),
+        ),
+        migrations.AddField(
+            model_name='environmentbackuprun',
+            name='dt_predicted_end',
+            field=models.DateTimeField(blank=True, help_text='When the run is expected to end, from the estimated durations of its backups', null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0024_backup_estimates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='periodicdatabasebackup',
+            name='spread_window',
+            field=models.PositiveIntegerField(default=0, help_text="Seconds after the scheduled time within which the task starts, each task at its own fixed offset (so the tasks of the same schedule don't start together) | 0 to start at the scheduled time"),
+        ),
+        migrations.AddField(
+            model_name='periodicenvironmentbackup',
+            name='spread_window',
+            field=models.PositiveIntegerField(default=0, help_text="Seconds after the scheduled time within which the task starts, each task at its own fixed offset (so the tasks of the same schedule don't start together) | 0 to start at the scheduled time"),
+        ),
+        migrations.AddField(
+            model_name='periodichostbackup',
+            name='spread_window',
+            field=models.PositiveIntegerField(default=0, help_text="Seconds after the scheduled time within which the task starts, each task at its own fixed offset (so the tasks of the same schedule don't start together) | 0 to start at the scheduled time"),
+        ),
+    ]
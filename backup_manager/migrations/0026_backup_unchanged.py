@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0025_periodic_spread_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='fingerprint',
+            field=models.CharField(blank=True, help_text='Fingerprint of the changes of the database when backed up (it changes whenever anything is written in the database)', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='unchanged_from',
+            field=models.ForeignKey(blank=True, help_text='Backup holding the dump, when the database was unchanged since it (this backup was not dumped again)', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='unchanged_backups', to='backup_manager.backup'),
+        ),
+        migrations.AddField(
+            model_name='database',
+            name='skip_unchanged',
+            field=models.BooleanField(default=False, help_text='Record the periodic and environment backups of this database as unchanged, pointing to its latest backup, instead of dumping it again when nothing changed since then'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0026_backup_unchanged'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backup',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the largest command run by the task', null=True),
+        ),
+        migrations.AlterField(
+            model_name='backuppart',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the largest command run by the task', null=True),
+        ),
+        migrations.AlterField(
+            model_name='basebackup',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the largest command run by the task', null=True),
+        ),
+        migrations.AlterField(
+            model_name='databasecopy',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the largest command run by the task', null=True),
+        ),
+        migrations.AlterField(
+            model_name='environmentbackuprun',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the largest command run by the task', null=True),
+        ),
+        migrations.AlterField(
+            model_name='pointintimerestore',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the largest command run by the task', null=True),
+        ),
+        migrations.AlterField(
+            model_name='restore',
+            name='peak_rss',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory (RSS) in bytes of the largest command run by the task', null=True),
+        ),
+    ]
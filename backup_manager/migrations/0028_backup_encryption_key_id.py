@@ -0,0 +1,24 @@
+# Generated by Django 4.2.5 on 2026-10-18 11:54
+
+from django.db import migrations, models
+import django_cryptography.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0027_task_peak_rss_help'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='encryption_key_id',
+            field=models.CharField(blank=True, help_text='Fingerprint of the key the backup is encrypted with', max_length=16, null=True),
+        ),
+        migrations.AlterField(
+            model_name='environment',
+            name='encryption_key',
+            field=django_cryptography.fields.encrypt(models.CharField(blank=True, help_text='AES-256 key the new backups of this environment are encrypted with, in hex (e.g. `python -c "import secrets; print(secrets.token_hex(32))"`) | Leave it _blank_ to not encrypt them | It can\'t be changed while there are backups encrypted with it, they can only be restored with it (encrypted)', max_length=64, null=True)),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:10
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_manager', '0028_backup_encryption_key_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backup',
+            name='jobs',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Default: "{database.backup_jobs}" | Only used in directory format', null=True, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AlterField(
+            model_name='backup',
+            name='shards',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Default: "{database.backup_shards}" | When more than 1, the backup is a folder with one part per worker', null=True, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AlterField(
+            model_name='database',
+            name='backup_jobs',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Default number of parallel jobs of the backups of this database (only used in directory format)', validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AlterField(
+            model_name='database',
+            name='backup_shards',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Default number of workers the backups of this database are split across (each one dumps part of the tables, all from the same snapshot) | 1 to dump it in a single worker', validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
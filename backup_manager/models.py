@@ -1,14 +1,22 @@
+import hashlib
+import json
 import os
+from datetime import timedelta
+from fnmatch import fnmatchcase
 from enum import Enum
 
 from celery.result import AsyncResult
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
 from django.db import models
-from django.db.models import ProtectedError
+from django.db.models import ProtectedError, Q
 from django.utils import timezone
 from django_celery_beat.models import PeriodicTask
 from django_cryptography.fields import encrypt
 
+from backup_manager.encryption import parse_key, key_id
+
 
 # Create your models here.
 
@@ -23,12 +31,55 @@ class Project(models.Model):
         db_table = 'tb_project'
 
 
+# Possible storages of the backups of an environment
+class STORAGE(Enum):
+    LOCAL = 'local'
+    S3 = 's3'
+
+
+STORAGE_CHOICES = (
+    (STORAGE.LOCAL.value, STORAGE.LOCAL.name),
+    (STORAGE.S3.value, STORAGE.S3.name),
+)
+
+
 class Environment(models.Model):
     name = models.CharField(max_length=255)
+    storage = models.CharField(max_length=5, choices=STORAGE_CHOICES, default=STORAGE.LOCAL.value, help_text='Where the backups of this environment are stored | LOCAL: the folder of the storage in the workers | S3: a bucket of an S3 compatible storage')
+    s3_endpoint_url = models.CharField(max_length=255, null=True, blank=True, help_text='Only used in S3 storage | Leave it _blank_ for AWS')
+    s3_bucket = models.CharField(max_length=255, null=True, blank=True, help_text='Only used in S3 storage')
+    s3_region = models.CharField(max_length=255, null=True, blank=True, help_text='Only used in S3 storage')
+    s3_access_key = models.CharField(max_length=255, null=True, blank=True, help_text='Only used in S3 storage | Leave it _blank_ to use the credentials of the workers')
+    s3_secret_key = encrypt(models.CharField(max_length=255, null=True, blank=True, help_text='Only used in S3 storage (encrypted)'))
+    encryption_key = encrypt(models.CharField(max_length=64, null=True, blank=True, help_text='AES-256 key the new backups of this environment are encrypted with, in hex (e.g. `python -c "import secrets; print(secrets.token_hex(32))"`) | Leave it _blank_ to not encrypt them | It can\'t be changed while there are backups encrypted with it, they can only be restored with it (encrypted)'))
 
     def __str__(self):
         return self.name
 
+    def clean(self):
+        super().clean()
+
+        if self.storage == STORAGE.S3.value and not self.s3_bucket:
+            raise ValidationError('The bucket is required in S3 storage')
+
+        if self.encryption_key:
+            try:
+                parse_key(self.encryption_key)
+            except ValueError as e:
+                raise ValidationError({'encryption_key': str(e)})
+
+        # The backups can only be restored with the key they were encrypted with, so it isn't changed while there are any
+        previous_key = Environment.objects.filter(pk=self.pk).values_list('encryption_key', flat=True).first() if self.pk else None
+        if previous_key and previous_key != self.encryption_key:
+            dependent_count = Backup.objects.filter(
+                Q(encryption_key_id=key_id(parse_key(previous_key))) | Q(encryption_key_id__isnull=True),
+                database__environment=self,
+                encrypted=True,
+                status=STATUS.SUCCESS.value,
+            ).count()
+            if dependent_count:
+                raise ValidationError({'encryption_key': f'{dependent_count} backups are encrypted with the current key, it can only be changed after they are deleted'})
+
     class Meta:
         db_table = 'tb_environment'
 
@@ -39,14 +90,136 @@ class Host(models.Model):
     port = models.IntegerField()
     user = models.CharField(max_length=255, null=True, blank=True, help_text='User used in periodic tasks')
     password = encrypt(models.CharField(max_length=255, null=True, blank=True, help_text='Password of user used in periodic tasks (encrypted)'))
+    max_concurrent_backups = models.PositiveSmallIntegerField(null=True, blank=True, help_text='Max number of backups running at the same time in this host | Leave it _blank_ for no limit')
+    wal_archiving = models.BooleanField(default=False, help_text='Stream the WAL of this host into the storage (pg_receivewal), allowing point-in-time restores from its base backups | The user needs the REPLICATION privilege')
 
     def __str__(self):
         return f'{self.name} ({self.ip}:{self.port})'
 
+    def physical_path(self) -> str:
+        return os.path.join(settings.BACKUP_STORAGE_ROOT, '_physical', f'{self.name}_{self.id}')
+
+    def wal_path(self) -> str:
+        return os.path.join(self.physical_path(), 'wal')
+
     class Meta:
         db_table = 'tb_host'
 
 
+# Possible formats of a backup (pg_dump --format)
+class FORMAT(Enum):
+    PLAIN = 'p'
+    CUSTOM = 'c'
+    DIRECTORY = 'd'
+
+
+FORMAT_CHOICES = (
+    (FORMAT.PLAIN.value, FORMAT.PLAIN.name),
+    (FORMAT.CUSTOM.value, FORMAT.CUSTOM.name),
+    (FORMAT.DIRECTORY.value, FORMAT.DIRECTORY.name),
+)
+
+# Extension of the backup path for each format (the directory format is a folder, so it has none)
+FORMAT_EXTENSIONS = {
+    FORMAT.PLAIN.value: '.sql',
+    FORMAT.CUSTOM.value: '.dump',
+    FORMAT.DIRECTORY.value: '',
+}
+
+# Possible compressions of a backup
+class COMPRESSION(Enum):
+    NONE = 'n'
+    GZIP = 'gz'
+    ZSTD = 'zst'
+
+
+COMPRESSION_CHOICES = (
+    (COMPRESSION.NONE.value, COMPRESSION.NONE.name),
+    (COMPRESSION.GZIP.value, COMPRESSION.GZIP.name),
+    (COMPRESSION.ZSTD.value, COMPRESSION.ZSTD.name),
+)
+
+# Extension added to the path of compressed plain backups (the other formats are compressed internally by pg_dump)
+COMPRESSION_EXTENSIONS = {
+    COMPRESSION.NONE.value: '',
+    COMPRESSION.GZIP.value: '.gz',
+    COMPRESSION.ZSTD.value: '.zst',
+}
+
+# Valid levels of each compression
+COMPRESSION_LEVELS = {
+    COMPRESSION.GZIP.value: range(1, 10),
+    COMPRESSION.ZSTD.value: range(1, 20),
+}
+
+
+def validate_compression(compression: str, compression_level: int):
+    # Check if the compression level is valid for the compression
+    if compression_level is None:
+        return
+    if compression == COMPRESSION.NONE.value:
+        raise ValidationError(f'Compression level must be blank when there is no compression')
+    if compression in COMPRESSION_LEVELS and compression_level not in COMPRESSION_LEVELS[compression]:
+        levels = COMPRESSION_LEVELS[compression]
+        raise ValidationError(f'Compression level must be between {levels[0]} and {levels[-1]}')
+
+
+def split_patterns(text: str) -> list:
+    return [line.strip() for line in (text or '').splitlines() if line.strip()]
+
+
+def match_pattern(table: str, pattern: str) -> bool:
+    # Match a table ("schema.name") with a pattern of pg_dump (psql rules: * and ? wildcards, unquoted names in lower
+    # case, and a pattern without schema matches the tables of any schema)
+    def normalize(name: str) -> str:
+        return name[1:-1].replace('""', '"') if name.startswith('"') and name.endswith('"') else name.lower()
+
+    schema, name = table.split('.', 1)
+    if '.' in pattern:
+        schema_pattern, name_pattern = pattern.split('.', 1)
+        return fnmatchcase(schema, normalize(schema_pattern)) and fnmatchcase(name, normalize(name_pattern))
+    return fnmatchcase(name, normalize(pattern))
+
+
+class BackupProfile(models.Model):
+    name = models.CharField(max_length=255)
+    schema_only = models.BooleanField(default=False, help_text='Dump only the schema, without any data')
+    include_tables = models.TextField(blank=True, help_text='Patterns of the tables dumped (pg_dump --table), one per line | Leave it _blank_ for all the tables')
+    exclude_tables = models.TextField(blank=True, help_text='Patterns of the tables not dumped (pg_dump --exclude-table), one per line')
+    exclude_table_data = models.TextField(blank=True, help_text='Patterns of the tables dumped without their data (pg_dump --exclude-table-data), one per line | E.g. the audit and log tables')
+
+    def __str__(self):
+        return self.name
+
+    def dump_options(self, schema_only: bool = True) -> list:
+        # pg_dump options of the profile (--schema-only can't be combined with --section)
+        options = ['--schema-only'] if self.schema_only and schema_only else []
+        options += [option for pattern in split_patterns(self.include_tables) for option in ('--table', pattern)]
+        options += [option for pattern in split_patterns(self.exclude_tables) for option in ('--exclude-table', pattern)]
+        options += [option for pattern in split_patterns(self.exclude_table_data) for option in ('--exclude-table-data', pattern)]
+        return options
+
+    def includes_table(self, table: str) -> bool:
+        include_tables = split_patterns(self.include_tables)
+        if include_tables and not any(match_pattern(table, pattern) for pattern in include_tables):
+            return False
+        return not any(match_pattern(table, pattern) for pattern in split_patterns(self.exclude_tables))
+
+    def includes_data(self, table: str) -> bool:
+        if self.schema_only or not self.includes_table(table):
+            return False
+        return not any(match_pattern(table, pattern) for pattern in split_patterns(self.exclude_table_data))
+
+    class Meta:
+        db_table = 'tb_backup_profile'
+
+
+class DatabaseManager(models.Manager):
+    # The project and the environment are always shown along with the database (__str__), e.g. in the admin filters
+    def get_queryset(self):
+        return super().get_queryset().select_related('project', 'environment')
+
+
 class Database(models.Model):
     name = models.CharField(max_length=255)
     host = models.ForeignKey(Host, on_delete=models.CASCADE)
@@ -54,10 +227,29 @@ class Database(models.Model):
     environment = models.ForeignKey(Environment, on_delete=models.CASCADE)
     user = models.CharField(max_length=255, null=True, blank=True, help_text='Overwrite the user used in periodic tasks')
     password = encrypt(models.CharField(max_length=255, null=True, blank=True, help_text='Overwrite the password of user used in periodic tasks (encrypted)'))
+    backup_format = models.CharField(max_length=1, choices=FORMAT_CHOICES, default=FORMAT.PLAIN.value, help_text='Default format of the backups of this database')
+    backup_jobs = models.PositiveSmallIntegerField(default=1, validators=[MinValueValidator(1)], help_text='Default number of parallel jobs of the backups of this database (only used in directory format)')
+    backup_shards = models.PositiveSmallIntegerField(default=1, validators=[MinValueValidator(1)], help_text='Default number of workers the backups of this database are split across (each one dumps part of the tables, all from the same snapshot) | 1 to dump it in a single worker')
+    compression = models.CharField(max_length=3, choices=COMPRESSION_CHOICES, default=COMPRESSION.GZIP.value, help_text='Default compression of the backups of this database')
+    compression_level = models.PositiveSmallIntegerField(null=True, blank=True, help_text='Default compression level of the backups of this database (GZIP: 1-9 | ZSTD: 1-19) | Leave it _blank_ to use the default of the compressor')
+    backup_profile = models.ForeignKey(BackupProfile, on_delete=models.SET_NULL, null=True, blank=True, help_text='Default profile of the backups of this database | Leave it _blank_ to dump everything')
+    skip_unchanged = models.BooleanField(default=False, help_text='Record the periodic and environment backups of this database as unchanged, pointing to its latest backup, instead of dumping it again when nothing changed since then')
+    keep_snapshot = models.BooleanField(default=False, help_text='Keep the latest backup restored in a database of the host ("{name}_snapshot"), so restores in the same host are cloned from it')
+    snapshot_backup = models.ForeignKey('Backup', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', help_text='Backup currently in the snapshot database')
+
+    objects = DatabaseManager()
 
     def __str__(self):
         return f'{self.name} ({self.project.name} - {self.environment.name})'
 
+    def snapshot_name(self) -> str:
+        return f'{self.name}_snapshot'
+
+    def clean(self):
+        super().clean()
+
+        validate_compression(self.compression, self.compression_level)
+
     class Meta:
         db_table = 'tb_database'
 
@@ -81,6 +273,9 @@ STATUS_CHOICES = (
     (STATUS.SCHEDULED.value, STATUS.SCHEDULED.name),
 )
 
+# States of a celery task while it runs (the dumps and restores report their progress with the PROGRESS state)
+RUNNING_STATES = {'STARTED', 'PROGRESS'}
+
 
 class TaskModel(models.Model):
     task_id = models.CharField(max_length=255, null=True, blank=True)
@@ -89,6 +284,8 @@ class TaskModel(models.Model):
     dt_end = models.DateTimeField(null=True, blank=True)
     status = models.CharField(max_length=2, choices=STATUS_CHOICES, default=STATUS.PENDING.value)
     description = models.TextField(null=True, blank=True)
+    throughput = models.FloatField(null=True, blank=True, help_text='Bytes per second written (backups) or read (restores)')
+    peak_rss = models.BigIntegerField(null=True, blank=True, help_text='Peak memory (RSS) in bytes of the largest command run by the task')
 
     def is_running(self) -> bool:
         if self.status == STATUS.STARTED.value:
@@ -114,23 +311,61 @@ class TaskModel(models.Model):
     def set_task(self, task_id: str = ''):
         self.task_id = task_id
 
+    def store_task(self, task_id: str):
+        # Set the task id, writing only its column
+        self.set_task(task_id)
+        type(self).objects.filter(pk=self.pk).update(task_id=task_id)
+
+    def transferred_bytes(self) -> int:
+        # Bytes written or read by the task, used to compute its throughput
+        return None
+
+    def duration(self) -> timedelta:
+        if self.dt_start and self.dt_end:
+            return self.dt_end - self.dt_start
+        return None
+
+    def queue_wait(self) -> timedelta:
+        # Time waiting for a worker (or a free slot) before starting
+        if self.dt_create and self.dt_start:
+            return self.dt_start - self.dt_create
+        return None
+
     def start_task(self) -> bool:
-        if self.status == STATUS.STARTED.value:  # Check if the task is already started
+        # Set the status before running the command, only if the task is still waiting (compare-and-set on the status,
+        # so two workers can't both start it) and writing only the columns that change
+        values = {'status': STATUS.STARTED.value, 'dt_start': timezone.now()}
+        if self.task_id:
+            values['task_id'] = self.task_id
+
+        waiting = [STATUS.PENDING.value, STATUS.SCHEDULED.value]
+        if not type(self).objects.filter(pk=self.pk, status__in=waiting).update(**values):  # Check if the task is already started (or finished)
             return False
 
-        # Set the status and description before running the command
-        self.set_status(STATUS.STARTED.value)
-        self.dt_start = timezone.now()
-        self.save()
+        for field, value in values.items():
+            setattr(self, field, value)
 
         return True
 
-    def finish_task(self, status: STATUS, description: str):
-        # Set the status and description after a success
-        self.set_status(status.value)
-        self.dt_end = timezone.now()
-        self.description = description
-        self.save()
+    def finish_task(self, status: STATUS, description: str, **fields):
+        # Set the status and description after the command
+        values = {'status': status.value, 'dt_end': timezone.now(), 'description': description}
+
+        # Set the other fields given (e.g. the results of the task)
+        values.update(fields)
+        for field, value in values.items():
+            setattr(self, field, value)
+
+        # Compute the throughput of the task
+        duration = self.duration()
+        transferred_bytes = self.transferred_bytes()
+        if duration and transferred_bytes:
+            self.throughput = transferred_bytes / max(duration.total_seconds(), 1)
+        values['throughput'] = self.throughput
+        values['peak_rss'] = self.peak_rss
+
+        # Write only the columns that change
+        type(self).objects.filter(pk=self.pk).update(**values)
 
     def clean(self):
         super().clean()
@@ -139,11 +374,12 @@ class TaskModel(models.Model):
         if self.task_id and not self.is_running():
             try:
                 result = AsyncResult(self.task_id)
-                if result.state != 'STARTED':
+                running = result.state in RUNNING_STATES
+                if not running:
                     result.revoke(terminate=True, wait=True, timeout=15)
             except Exception as e:
                 raise ValidationError(f'Error revoking task: {e}')
-            else:
+            if running:
                 raise ValidationError(f'The task is already running, wait for it to finish!')
         elif self.is_running():
             raise ValidationError(f'The task is already running, wait for it to finish!')
@@ -153,11 +389,13 @@ class TaskModel(models.Model):
         if self.task_id:
             try:
                 result = AsyncResult(self.task_id)
-                if result.state == 'STARTED':
-                    raise ProtectedError(f'The task is already running, wait for it to finish!')
-                result.revoke(terminate=True, wait=True, timeout=15)
+                running = result.state in RUNNING_STATES
+                if not running:
+                    result.revoke(terminate=True, wait=True, timeout=15)
             except Exception as e:
-                raise ProtectedError(f'Error revoking task: {e}')
+                raise ProtectedError(f'Error revoking task: {e}', {self})
+            if running:
+                raise ProtectedError(f'The task is already running, wait for it to finish!', {self})
 
         super().delete(using, keep_parents)
 
@@ -165,22 +403,89 @@ class TaskModel(models.Model):
         abstract = True
 
 
+class EnvironmentBackupRun(TaskModel):
+    name = models.CharField(max_length=255, blank=True, help_text='Default: "{environment.name}_{date_time}"')
+    environment = models.ForeignKey(Environment, on_delete=models.CASCADE)
+    backup_count = models.IntegerField(null=True, blank=True, help_text='Number of backups in the run')
+    failed_count = models.IntegerField(null=True, blank=True, help_text='Number of backups of the run that failed')
+    size = models.BigIntegerField(null=True, blank=True, help_text='Total size of the backups of the run in bytes')
+    dt_predicted_end = models.DateTimeField(null=True, blank=True, help_text='When the run is expected to end, from the estimated durations of its backups')
+
+    def __str__(self):
+        return f'{self.name} [{self.dt_create}] {{{self.status}}}'
+
+    def transferred_bytes(self) -> int:
+        return self.size
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # If the name is blank, set default
+        if not self.name:
+            self.name = f'{self.environment.name}_{(self.dt_create or timezone.now()).strftime("%d-%m-%Y-%H-%M")}'
+
+        super().save(force_insert, force_update, using, update_fields)
+
+    class Meta:
+        db_table = 'tb_environment_backup_run'
+
+
 class Backup(TaskModel):
     name = models.CharField(max_length=255, blank=True, help_text='Default: "{project.name}_{environment.name}_{date_time}"')
     path = models.CharField(max_length=255)
     database = models.ForeignKey(Database, on_delete=models.CASCADE)
+    environment_run = models.ForeignKey(EnvironmentBackupRun, on_delete=models.SET_NULL, null=True, blank=True, related_name='backups', help_text='Backup of the whole environment this backup is part of')
     dt_create = models.DateTimeField(blank=True, help_text='Leave it _blank_ if the backup is to be done now  | Set it to a future date if the backup is to be scheduled  | Set it to a past date if the backup is already done')
+    format = models.CharField(max_length=1, choices=FORMAT_CHOICES, blank=True, help_text='Default: "{database.backup_format}"')
+    jobs = models.PositiveSmallIntegerField(null=True, blank=True, validators=[MinValueValidator(1)], help_text='Default: "{database.backup_jobs}" | Only used in directory format')
+    shards = models.PositiveSmallIntegerField(null=True, blank=True, validators=[MinValueValidator(1)], help_text='Default: "{database.backup_shards}" | When more than 1, the backup is a folder with one part per worker')
+    compression = models.CharField(max_length=3, choices=COMPRESSION_CHOICES, blank=True, help_text='Default: "{database.compression}"')
+    compression_level = models.PositiveSmallIntegerField(null=True, blank=True, help_text='Default: "{database.compression_level}"')
+    profile = models.ForeignKey(BackupProfile, on_delete=models.PROTECT, null=True, blank=True, help_text='Default: "{database.backup_profile}"')
+    checksum = models.CharField(max_length=64, null=True, blank=True, help_text='SHA-256 of the backup file (of the list of files with their checksums in directory format)')
+    size = models.BigIntegerField(null=True, blank=True, help_text='Size of the backup in bytes')
+    table_count = models.IntegerField(null=True, blank=True, help_text='Number of tables in the database when backed up')
+    row_count = models.BigIntegerField(null=True, blank=True, help_text='Estimated number of rows in the database when backed up')
+    database_size = models.BigIntegerField(null=True, blank=True, help_text='Size of the database (pg_database_size) when backed up, in bytes')
+    estimated_duration = models.PositiveIntegerField(null=True, blank=True, help_text='Seconds the backup was expected to take when dispatched by its environment run')
+    encrypted = models.BooleanField(default=False, help_text='Encrypted with the key of the environment')
+    encryption_key_id = models.CharField(max_length=16, null=True, blank=True, help_text='Fingerprint of the key the backup is encrypted with')
+    fingerprint = models.CharField(max_length=64, null=True, blank=True, help_text='Fingerprint of the changes of the database when backed up (it changes whenever anything is written in the database)')
+    unchanged_from = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='unchanged_backups', help_text='Backup holding the dump, when the database was unchanged since it (this backup was not dumped again)')
 
     def __str__(self):
         return f'{self.name} ({self.database}) [{self.dt_create}] {{{self.status}}}'
 
-    def complete_path(self) -> str:
-        default = os.path.join('/', 'mnt', 'netapp01', 'postgres')
+    def resolve(self) -> 'Backup':
+        # Backup holding the dump (itself, unless the database was unchanged since a previous backup)
+        return self.unchanged_from or self
+
+    def storage_key(self) -> str:
+        # Path of the backup in the storage of its environment
+        if self.unchanged_from_id:
+            return self.unchanged_from.storage_key()
         month_year = self.dt_create.strftime('%m-%Y')
-        path = os.path.join(default, self.database.environment.name, month_year, self.database.project.name, self.path)
-        return path
+        return os.path.join(self.database.environment.name, month_year, self.database.project.name, self.path)
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+    def complete_path(self) -> str:
+        return os.path.join(settings.BACKUP_STORAGE_ROOT, self.storage_key())
+
+    def log_path(self) -> str:
+        return f'{self.complete_path()}.log'
+
+    def transferred_bytes(self) -> int:
+        return None if self.unchanged_from_id else self.size  # Nothing was dumped
+
+    def manifest_key(self) -> str:
+        return f'{self.storage_key()}.manifest.json'
+
+    def is_split(self) -> bool:
+        return bool(self.shards) and self.shards > 1
+
+    def sections(self) -> list:
+        # Sections of the dump in the backup, restored one at a time
+        return ['pre-data', 'data', 'post-data']
+
+    def set_defaults(self):
+        # Fill the blank fields (called by save, and before a bulk_create, which doesn't call save)
         if not self.pk:  # If the object is being created
             # If the creation date is already set
             if not self.dt_create:
@@ -188,28 +493,163 @@ class Backup(TaskModel):
             else:
                 self.set_status(STATUS.MANUAL.value)  # The backup is already done
 
+            # The backup is encrypted if its environment has a key when it is created
+            if self.status != STATUS.MANUAL.value:
+                self.encrypted = bool(self.database.environment.encryption_key)
+                if self.encrypted:
+                    self.encryption_key_id = key_id(parse_key(self.database.environment.encryption_key))
+
+            # If the profile is blank, use the default of the database
+            if not self.profile_id:
+                self.profile_id = self.database.backup_profile_id
+
         date_time: str = self.dt_create.strftime('%d-%m-%Y-%H-%M')
 
         # If the name is blank, set default
         if not self.name:
             self.name = f'{self.database.project.name}_{self.database.environment.name}_{date_time}'
 
-        self.path = f'{self.database.project.name}_{self.database.name}_{date_time}.sql'  # Set the path
+        # If the format or the number of jobs are blank, use the defaults of the database
+        if not self.format:
+            self.format = self.database.backup_format
+        if not self.jobs:
+            self.jobs = self.database.backup_jobs
+        if not self.shards:
+            self.shards = self.database.backup_shards
+
+        # If the compression is blank, use the default of the database
+        if not self.compression:
+            self.compression = self.database.compression
+            self.compression_level = self.database.compression_level
+
+        extension = FORMAT_EXTENSIONS[self.format]
+        if self.format == FORMAT.PLAIN.value:
+            extension += COMPRESSION_EXTENSIONS[self.compression]
+        if self.is_split():
+            extension = '.parts'  # Folder with the parts, each one with the extension of the format
+        self.path = f'{self.database.project.name}_{self.database.name}_{date_time}{extension}'  # Set the path
 
         # If the creation date is in the future
         if self.dt_create > timezone.now():
             self.set_status(STATUS.SCHEDULED.value)  # The backup is scheduled
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        self.set_defaults()
+
         super().save(force_insert, force_update, using, update_fields)
 
+    def clean(self):
+        super().clean()
+
+        validate_compression(self.compression, self.compression_level)
+
     class Meta:
         db_table = 'tb_backup'
+        indexes = [
+            models.Index(fields=['database', 'dt_create'], name='tb_backup_database_dt_idx'),
+            models.Index(fields=['status'], name='tb_backup_status_idx'),
+            models.Index(fields=['task_id'], name='tb_backup_task_id_idx'),
+            models.Index(fields=['dt_end'], name='tb_backup_dt_end_idx'),
+        ]
+
+
+# Sections of a dump (pg_dump --section), the data is split across the parts of a backup
+class SECTION(Enum):
+    PRE_DATA = 'pre-data'
+    DATA = 'data'
+    POST_DATA = 'post-data'
+
+
+SECTION_CHOICES = (
+    (SECTION.PRE_DATA.value, SECTION.PRE_DATA.name),
+    (SECTION.DATA.value, SECTION.DATA.name),
+    (SECTION.POST_DATA.value, SECTION.POST_DATA.name),
+)
+
+
+class BackupPart(TaskModel):
+    backup = models.ForeignKey(Backup, on_delete=models.CASCADE, related_name='parts')
+    number = models.PositiveSmallIntegerField(help_text='Order in which the part is restored')
+    section = models.CharField(max_length=9, choices=SECTION_CHOICES)
+    tables = models.JSONField(null=True, blank=True, help_text='Tables whose data is in this part | Blank in the part with the data of all the other tables (and of the sequences)')
+    estimated_size = models.BigIntegerField(null=True, blank=True, help_text='Size of the tables of this part in the database, in bytes')
+    path = models.CharField(max_length=255)
+    checksum = models.CharField(max_length=64, null=True, blank=True, help_text='SHA-256 of the part file (of the list of files with their checksums in directory format)')
+    size = models.BigIntegerField(null=True, blank=True, help_text='Size of the part in bytes')
+
+    def __str__(self):
+        return f'{self.backup.name} [{self.number}: {self.section}] {{{self.status}}}'
+
+    # The parts are dumped with the options of their backup
+    @property
+    def database(self) -> Database:
+        return self.backup.database
+
+    @property
+    def format(self) -> str:
+        return self.backup.format
+
+    @property
+    def jobs(self) -> int:
+        return self.backup.jobs
+
+    @property
+    def compression(self) -> str:
+        return self.backup.compression
+
+    @property
+    def compression_level(self) -> int:
+        return self.backup.compression_level
+
+    @property
+    def encrypted(self) -> bool:
+        return self.backup.encrypted
+
+    @property
+    def encryption_key_id(self) -> str:
+        return self.backup.encryption_key_id
+
+    def storage_key(self) -> str:
+        return os.path.join(self.backup.storage_key(), self.path)
+
+    def complete_path(self) -> str:
+        return os.path.join(self.backup.complete_path(), self.path)
+
+    def log_path(self) -> str:
+        return f'{self.complete_path()}.log'
+
+    def transferred_bytes(self) -> int:
+        return self.size
+
+    def sections(self) -> list:
+        return [self.section]
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # Set the path
+        if not self.path:
+            extension = FORMAT_EXTENSIONS[self.format]
+            if self.format == FORMAT.PLAIN.value:
+                extension += COMPRESSION_EXTENSIONS[self.compression]
+            self.path = f'{self.number:03}_{self.section}{extension}'
+
+        super().save(force_insert, force_update, using, update_fields)
+
+    class Meta:
+        db_table = 'tb_backup_part'
+        ordering = ['number']
+
+
+def validate_same_project(origin_database: Database, destination_database: Database):
+    # Check if the origin and destination databases are of the same project
+    if origin_database.project != destination_database.project:
+        raise ValidationError(f'Origin and destination databases must be of the same project')
 
 
 class Restore(TaskModel):
     name = models.CharField(max_length=255, blank=True, help_text='Default: "{origin_backup} -> {destination_database}"')
     origin_backup = models.ForeignKey(Backup, on_delete=models.CASCADE)
     destination_database = models.ForeignKey(Database, on_delete=models.CASCADE)
+    profile = models.ForeignKey(BackupProfile, on_delete=models.SET_NULL, null=True, blank=True, help_text='Restore only the data of the tables of this profile (the schema is restored whole) | Only used in custom and directory formats | Leave it _blank_ to restore the whole backup')
 
     def __str__(self):
         return f'{self.name} (({self.origin_backup}) -> {self.destination_database.name}) [{self.dt_create}] {{{self.status}}}'
@@ -221,27 +661,159 @@ class Restore(TaskModel):
 
         super().save(force_insert, force_update, using, update_fields)
 
+    def log_path(self) -> str:
+        return f'{self.origin_backup.complete_path()}.restore_{self.id}.log'
+
+    def transferred_bytes(self) -> int:
+        return self.origin_backup.size
+
     def clean(self, *args, **kwargs):
         super().clean()
 
-        # Check if the origin and destination databases are of the same project
-        if self.origin_backup.database.project != self.destination_database.project:
-            raise ValidationError(f'Origin and destination databases must be of the same project')
+        validate_same_project(self.origin_backup.database, self.destination_database)
 
         # Check if the origin backup is successful
         if self.origin_backup.status != STATUS.SUCCESS.value:
             raise ValidationError(f'Origin backup must be successful before using it to restore')
 
+        # Plain backups are replayed whole by psql
+        if self.profile and self.origin_backup.format == FORMAT.PLAIN.value:
+            raise ValidationError({'profile': 'Plain backups can only be restored whole'})
+
     class Meta:
         db_table = 'tb_restore'
+        indexes = [
+            models.Index(fields=['destination_database', 'dt_create'], name='tb_restore_database_dt_idx'),
+            models.Index(fields=['status'], name='tb_restore_status_idx'),
+            models.Index(fields=['task_id'], name='tb_restore_task_id_idx'),
+            models.Index(fields=['dt_end'], name='tb_restore_dt_end_idx'),
+        ]
+
+
+class DatabaseCopy(TaskModel):
+    name = models.CharField(max_length=255, blank=True, help_text='Default: "{origin_database} -> {destination_database}"')
+    origin_database = models.ForeignKey(Database, on_delete=models.CASCADE, related_name='copies_from')
+    destination_database = models.ForeignKey(Database, on_delete=models.CASCADE, related_name='copies_to', help_text='Its data is replaced by the one of the origin database')
+    size = models.BigIntegerField(null=True, blank=True, help_text='Size of the tables copied in bytes (from the statistics of the origin database)')
+
+    def __str__(self):
+        return f'{self.name} [{self.dt_create}] {{{self.status}}}'
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # If the name is blank, set default
+        if not self.name:
+            self.name = f'{self.origin_database} -> {self.destination_database}'
+
+        super().save(force_insert, force_update, using, update_fields)
+
+    def log_path(self) -> str:
+        # There is no backup file to keep the log beside
+        return os.path.join(settings.BACKUP_STORAGE_ROOT, '_copies', f'copy_{self.id}.log')
+
+    def transferred_bytes(self) -> int:
+        return self.size
+
+    def clean(self, *args, **kwargs):
+        super().clean()
+
+        if self.origin_database_id and self.destination_database_id:
+            validate_same_project(self.origin_database, self.destination_database)
+
+            # Check if the databases are not the same
+            if self.origin_database_id == self.destination_database_id:
+                raise ValidationError(f'Origin and destination databases must be different')
+
+    class Meta:
+        db_table = 'tb_database_copy'
+
+
+class BaseBackup(TaskModel):
+    name = models.CharField(max_length=255, blank=True, help_text='Default: "{host.name}_{date_time}"')
+    path = models.CharField(max_length=255)
+    host = models.ForeignKey(Host, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return f'{self.name} ({self.host}) [{self.dt_create}] {{{self.status}}}'
+
+    def complete_path(self) -> str:
+        return os.path.join(self.host.physical_path(), 'base', self.path)
+
+    def log_path(self) -> str:
+        return f'{self.complete_path()}.log'
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        date_time: str = (self.dt_create or timezone.now()).strftime('%d-%m-%Y-%H-%M')
+
+        # If the name is blank, set default
+        if not self.name:
+            self.name = f'{self.host.name}_{date_time}'
+
+        # Set the path
+        if not self.path:
+            self.path = date_time
+
+        super().save(force_insert, force_update, using, update_fields)
+
+    class Meta:
+        db_table = 'tb_base_backup'
+
+
+class PointInTimeRestore(TaskModel):
+    name = models.CharField(max_length=255, blank=True, help_text='Default: "{host.name} @ {target_time}"')
+    host = models.ForeignKey(Host, on_delete=models.CASCADE)
+    target_time = models.DateTimeField(help_text='Time until which the WAL is replayed')
+    data_directory = models.CharField(max_length=255, help_text='Empty directory, reachable by the workers, where the data directory of the recovered cluster is prepared')
+    base_backup = models.ForeignKey(BaseBackup, on_delete=models.SET_NULL, null=True, blank=True, help_text='Base backup used (the latest one finished before the target time)')
+
+    def __str__(self):
+        return f'{self.name} [{self.dt_create}] {{{self.status}}}'
+
+    def log_path(self) -> str:
+        return f'{self.data_directory.rstrip(os.sep)}.log'
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # If the name is blank, set default
+        if not self.name:
+            self.name = f'{self.host.name} @ {self.target_time}'
+
+        super().save(force_insert, force_update, using, update_fields)
+
+    def clean(self):
+        super().clean()
+
+        # Check if the host has its WAL archived
+        if not self.host.wal_archiving:
+            raise ValidationError(f'WAL archiving is not enabled in the host')
+
+        # Check if the target time is in the past
+        if self.target_time > timezone.now():
+            raise ValidationError(f'Target time must be in the past')
+
+    class Meta:
+        db_table = 'tb_point_in_time_restore'
 
 
 class PeriodicTaskModel(models.Model):
     name = models.CharField(max_length=255)
     periodic_task = models.OneToOneField(to=PeriodicTask, on_delete=models.CASCADE, null=True, blank=True)
+    spread_window = models.PositiveIntegerField(default=0, help_text='Seconds after the scheduled time within which the task starts, each task at its own fixed offset (so the tasks of the same schedule don\'t start together) | 0 to start at the scheduled time')
+
+    def spread_key(self) -> str:
+        # What the task backs up, the offset of the task depends only on it (the subclasses name their target, the
+        # name is the default since the pk isn't set yet when the offset of a new task is computed)
+        return f'{self._meta.model_name}:{self.name}'
+
+    def spread_offset(self) -> int:
+        # Fixed offset of the task inside its window, from a hash of what it backs up
+        if not self.spread_window:
+            return 0
+        digest = hashlib.sha256(self.spread_key().encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % self.spread_window
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         self.periodic_task.name = self.name
+        # The task starts itself again after its offset (see the delay of the tasks)
+        self.periodic_task.kwargs = json.dumps({'delay': self.spread_offset()} if self.spread_window else {})
         self.periodic_task.save()
 
         super().save(force_insert, force_update, using, update_fields)
@@ -251,6 +823,14 @@ class PeriodicTaskModel(models.Model):
             self.periodic_task.delete()
         super().delete(using, keep_parents)
 
+    def clean(self):
+        super().clean()
+
+        # A task waiting longer than the visibility timeout would be delivered again by redis
+        visibility_timeout = settings.CELERY_BROKER_TRANSPORT_OPTIONS.get('visibility_timeout')
+        if visibility_timeout and self.spread_window >= visibility_timeout:
+            raise ValidationError({'spread_window': f'The spread window must be shorter than the visibility timeout of the broker ({visibility_timeout} seconds)'})
+
     class Meta:
         abstract = True
 
@@ -258,16 +838,20 @@ class PeriodicTaskModel(models.Model):
 class PeriodicDatabaseBackup(PeriodicTaskModel):
     name = models.CharField(max_length=255, blank=True, help_text='Default: "Backup {database.project.name} - {database.environment.name} ({database.name}) [{self.periodic_task.crontab.human_readable}]"')
     database = models.ForeignKey(Database, on_delete=models.CASCADE)
+    profile = models.ForeignKey(BackupProfile, on_delete=models.SET_NULL, null=True, blank=True, help_text='Default: "{database.backup_profile}"')
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         # If the name is blank, set default
         self.name = f'Backup {self.database.project.name} - {self.database.environment.name} ({self.database.name}) [{self.periodic_task.crontab.human_readable}]'
 
         self.periodic_task.task = 'backup_manager.tasks.create_backup'
-        self.periodic_task.args = f'[{self.database.id}]'
+        self.periodic_task.args = f'[{self.database.id}, {self.profile_id}]' if self.profile_id else f'[{self.database.id}]'
 
         super().save(force_insert, force_update, using, update_fields)
 
+    def spread_key(self) -> str:
+        return f'database:{self.database_id}:{self.profile_id}'
+
     def clean(self):
         super().clean()
 
@@ -296,5 +880,36 @@ class PeriodicEnvironmentBackup(PeriodicTaskModel):
 
         super().save(force_insert, force_update, using, update_fields)
 
+    def spread_key(self) -> str:
+        return f'environment:{self.environment_id}'
+
     class Meta:
         db_table = 'tb_periodic_environment_backup'
+
+
+class PeriodicHostBackup(PeriodicTaskModel):
+    name = models.CharField(max_length=255, blank=True, help_text='Default: "Base backup {host.name} [{self.periodic_task.crontab.human_readable}]"')
+    host = models.ForeignKey(Host, on_delete=models.CASCADE)
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # If the name is blank, set default
+        self.name = f'Base backup {self.host.name} [{self.periodic_task.crontab.human_readable}]'
+
+        self.periodic_task.task = 'backup_manager.tasks.create_base_backup'
+        self.periodic_task.args = f'[{self.host.id}]'
+
+        super().save(force_insert, force_update, using, update_fields)
+
+    def spread_key(self) -> str:
+        return f'host:{self.host_id}'
+
+    def clean(self):
+        super().clean()
+
+        if not self.host.user:
+            raise ValidationError(f'User not set in host')
+        if not self.host.password:
+            raise ValidationError(f'Password not set in host')
+
+    class Meta:
+        db_table = 'tb_periodic_host_backup'
@@ -0,0 +1,143 @@
+import re
+import threading
+import time
+
+from django.conf import settings
+
+# Lines of the verbose output of pg_dump and pg_restore telling that the data of a table started being copied
+TABLE_STARTED = (
+    re.compile(r'dumping contents of table "?(?P<table>[^"]+)"?$'),
+    re.compile(r'processing data for table "?(?P<table>[^"]+)"?$'),
+    re.compile(r'launching item \d+ TABLE DATA (?P<schema>\S+) (?P<table>\S+)$'),
+)
+# Line of the verbose output of the parallel jobs telling that the data of a table was copied
+TABLE_FINISHED = re.compile(r'finished item \d+ TABLE DATA (?P<schema>\S+) (?P<table>\S+)$')
+
+
+def table_name(match: re.Match) -> str:
+    groups = match.groupdict()
+    if groups.get('schema'):
+        return f'{groups["schema"]}.{groups["table"]}'
+    return groups['table']
+
+
+class Progress:
+    # Estimates how much of a dump or restore is done from the tables already copied and their sizes,
+    # reporting it (throttled) as the state of the celery task
+    def __init__(self, task, sizes: dict = None, parallel: bool = False, total: int = None):
+        self.task = task
+        self.sizes = sizes or {}
+        self.total = total if total is not None else sum(self.sizes.values())
+        self.parallel = parallel
+        self.done = 0  # Bytes done
+        self.tables_done = 0
+        self.running = []
+        self.step = None
+        self.started = time.monotonic()
+        self.last_report = 0
+        self.lock = threading.Lock()
+
+    def size(self, table: str) -> int:
+        # Old versions of pg_dump print the tables without their schema
+        if table in self.sizes:
+            return self.sizes[table]
+        return next((size for name, size in self.sizes.items() if name.endswith(f'.{table}')), 0)
+
+    def on_line(self, line: str):
+        line = line.rstrip()
+        for pattern in TABLE_STARTED:
+            match = pattern.search(line)
+            if match:
+                self.table_started(table_name(match))
+                return
+
+        match = TABLE_FINISHED.search(line)
+        if match:
+            self.table_finished(table_name(match))
+
+    def table_started(self, table: str):
+        with self.lock:
+            # The parallel jobs print the table when launching it and again when dumping it
+            if table in self.running:
+                return
+
+            # Without parallel jobs, a table is done when the next one starts
+            if not self.parallel:
+                for running in self.running:
+                    self._finish(running)
+                self.running = []
+            self.running.append(table)
+        self.report()
+
+    def table_finished(self, table: str):
+        with self.lock:
+            if table in self.running:
+                self.running.remove(table)
+            self._finish(table)
+        self.report()
+
+    def _finish(self, table: str):
+        self.done += self.size(table)
+        self.tables_done += 1
+
+    def advance(self, size: int):
+        # Progress measured in bytes (e.g. the bytes of a plain backup already fed to psql)
+        with self.lock:
+            self.done += size
+        self.report()
+
+    def set_step(self, step: str):
+        self.step = step
+        self.report(force=True)
+
+    def state(self) -> dict:
+        elapsed = time.monotonic() - self.started
+
+        percent, eta = None, None
+        if self.total:
+            done = min(self.done, self.total)
+            percent = round(100 * done / self.total, 1)
+            if done:
+                eta = round(elapsed * (self.total - done) / done)
+
+        return {
+            'percent': percent,
+            'eta': eta,
+            'elapsed': round(elapsed),
+            'table': self.running[-1] if self.running else None,
+            'tables_done': self.tables_done,
+            'tables': len(self.sizes) or None,
+            'step': self.step,
+        }
+
+    def report(self, force: bool = False):
+        if not self.task or settings.BACKUP_PROGRESS_INTERVAL is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self.last_report < settings.BACKUP_PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+
+        # The progress is only informative, it must never stop the task
+        try:
+            self.task.update_state(state='PROGRESS', meta=self.state())
+        except Exception:
+            pass
+
+
+def describe(info: dict) -> str:
+    # Short text of the state reported by a running task, for the admin
+    parts = []
+    if info.get('step'):
+        parts.append(info['step'])
+    if info.get('percent') is not None:
+        parts.append(f'{info["percent"]}%')
+    if info.get('tables'):
+        parts.append(f'{info["tables_done"]}/{info["tables"]} tables')
+    if info.get('table'):
+        parts.append(info['table'])
+    if info.get('eta') is not None:
+        eta = info['eta']
+        parts.append(f'ETA {eta // 3600}:{eta % 3600 // 60:02}:{eta % 60:02}')
+    return ' | '.join(parts)
@@ -0,0 +1,294 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from backup_manager.models import Environment, STORAGE
+
+
+class DiscardWrite(Exception):
+    # Raised inside open_write to discard what was written (e.g. the output of a failed dump) instead of storing it
+    pass
+
+
+@contextmanager
+def staging_folder():
+    # Local folder for the files that can't be written (or read) straight from the storage, removed afterwards
+    directory = tempfile.mkdtemp(dir=settings.BACKUP_STAGING_ROOT)
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@contextmanager
+def staging_path(key: str):
+    with staging_folder() as directory:
+        yield os.path.join(directory, os.path.basename(key))
+
+
+class LocalStorage:
+    # Files in a folder of the workers (e.g. a network mount shared by all of them)
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    @contextmanager
+    def open_write(self, key: str):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        with open(self.path(key), 'wb') as file:
+            yield file
+
+    @contextmanager
+    def open_read(self, key: str):
+        with open(self.path(key), 'rb') as file:
+            yield file
+
+    @contextmanager
+    def staging(self, key: str):
+        # The files are written in place
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        yield self.path(key)
+
+    def store_directory(self, key: str, path: str):
+        pass  # Already in place
+
+    @contextmanager
+    def local_copy(self, key: str, is_directory: bool = False):
+        yield self.path(key)
+
+    def list_files(self, key: str) -> list:
+        # Paths of the files of a directory, relative to it
+        return [os.path.relpath(os.path.join(root, name), self.path(key)) for root, _, names in os.walk(self.path(key)) for name in names]
+
+    def write_bytes(self, key: str, data: bytes):
+        with self.open_write(key) as file:
+            file.write(data)
+
+    def read_bytes(self, key: str) -> bytes:
+        with self.open_read(key) as file:
+            return file.read()
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self.path(key))
+
+    def read_range(self, key: str, start: int, length: int) -> bytes:
+        with self.open_read(key) as file:
+            file.seek(start)
+            return file.read(length)
+
+
+class MultipartWriter:
+    # Streams the writes into a multipart upload, uploading up to BACKUP_S3_MAX_IN_FLIGHT parts at the same time
+    # (so at most that number of parts, plus the one being filled, are in memory)
+    def __init__(self, client, bucket: str, key: str):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = settings.BACKUP_S3_PART_SIZE
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.futures = deque()
+        self.executor = ThreadPoolExecutor(max_workers=settings.BACKUP_S3_MAX_IN_FLIGHT)
+        self.slots = threading.BoundedSemaphore(settings.BACKUP_S3_MAX_IN_FLIGHT)
+
+    def write(self, chunk: bytes):
+        self.buffer += chunk
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def upload_part(self, data: bytes):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+
+        # Wait for a free slot, keeping the memory bounded
+        self.slots.acquire()
+        number = len(self.parts) + len(self.futures) + 1
+        self.futures.append(self.executor.submit(self._upload_part, number, data))
+
+        # Collect the parts already uploaded (raising their errors)
+        while self.futures and self.futures[0].done():
+            self.parts.append(self.futures.popleft().result())
+
+    def _upload_part(self, number: int, data: bytes) -> dict:
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def close(self):
+        try:
+            # Small files are uploaded in a single request
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+                return
+
+            if self.buffer:
+                self.upload_part(bytes(self.buffer))
+            while self.futures:
+                self.parts.append(self.futures.popleft().result())
+
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        except BaseException:
+            # A part failed, so the upload is aborted rather than completed without it
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class RangeReader:
+    # Reads an object sequentially while the next ranges are downloaded in parallel
+    # (up to BACKUP_S3_MAX_IN_FLIGHT ranges in memory)
+    def __init__(self, client, bucket: str, key: str):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.range_size = settings.BACKUP_S3_PART_SIZE
+        self.next_offset = 0
+        self.futures = deque()
+        self.current = b''  # Range being read, from the offset (the reads slice it instead of copying the rest)
+        self.offset = 0
+        self.executor = ThreadPoolExecutor(max_workers=settings.BACKUP_S3_MAX_IN_FLIGHT)
+        self.fill()
+
+    def fill(self):
+        while len(self.futures) < settings.BACKUP_S3_MAX_IN_FLIGHT and self.next_offset < self.size:
+            end = min(self.next_offset + self.range_size, self.size) - 1
+            self.futures.append(self.executor.submit(self.read_range, self.next_offset, end))
+            self.next_offset = end + 1
+
+    def read_range(self, start: int, end: int) -> bytes:
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{end}')
+        return response['Body'].read()
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while size != 0:
+            if self.offset >= len(self.current):
+                if not self.futures:
+                    break
+                self.current, self.offset = self.futures.popleft().result(), 0
+                self.fill()
+
+            end = len(self.current) if size < 0 else self.offset + size
+            chunk = self.current[self.offset:end]
+            self.offset += len(chunk)
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+
+        return b''.join(chunks)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class S3Storage:
+    # Objects in a bucket of an S3 compatible storage, the keys are the paths of the local storage
+    def __init__(self, bucket: str, endpoint_url: str = None, region: str = None, access_key: str = None, secret_key: str = None):
+        try:
+            import boto3
+        except ImportError:
+            raise ImportError('boto3 is required to use S3 storages (pip install boto3)')
+
+        self.bucket = bucket
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None,
+        )
+
+    @contextmanager
+    def open_write(self, key: str):
+        writer = MultipartWriter(self.client, self.bucket, key)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+    @contextmanager
+    def open_read(self, key: str):
+        reader = RangeReader(self.client, self.bucket, key)
+        try:
+            yield reader
+        finally:
+            reader.close()
+
+    @contextmanager
+    def staging(self, key: str):
+        # Files written by the commands themselves (e.g. the directory format) are staged locally, and stored by
+        # store_directory
+        with staging_path(key) as path:
+            yield path
+
+    def store_directory(self, key: str, path: str):
+        for root, _, names in os.walk(path):
+            for name in names:
+                file_path = os.path.join(root, name)
+                with open(file_path, 'rb') as file, self.open_write(f'{key}/{os.path.relpath(file_path, path)}') as writer:
+                    shutil.copyfileobj(file, writer, settings.BACKUP_S3_PART_SIZE)
+
+    @contextmanager
+    def local_copy(self, key: str, is_directory: bool = False):
+        # Commands that need random access to the files (e.g. pg_restore) read a local copy
+        with staging_folder() as directory:
+            path = os.path.join(directory, os.path.basename(key))
+            names = self.list_files(key) if is_directory else [None]
+            for name in names:
+                file_path = os.path.join(path, name) if name else path
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with self.open_read(os.path.join(key, name) if name else key) as reader, open(file_path, 'wb') as file:
+                    shutil.copyfileobj(reader, file, settings.BACKUP_S3_PART_SIZE)
+
+            yield path
+
+    def list_files(self, key: str) -> list:
+        # Paths of the objects under a key, relative to it
+        paginator = self.client.get_paginator('list_objects_v2')
+        return [os.path.relpath(item['Key'], key) for page in paginator.paginate(Bucket=self.bucket, Prefix=f'{key}/') for item in page.get('Contents', [])]
+
+    def write_bytes(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def read_bytes(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def size(self, key: str) -> int:
+        return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+
+    def read_range(self, key: str, start: int, length: int) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key, Range=f'bytes={start}-{start + length - 1}')['Body'].read()
+
+
+def get_storage(environment: Environment):
+    # Storage of the backups of an environment
+    if environment.storage == STORAGE.S3.value:
+        return S3Storage(
+            environment.s3_bucket,
+            endpoint_url=environment.s3_endpoint_url,
+            region=environment.s3_region,
+            access_key=environment.s3_access_key,
+            secret_key=environment.s3_secret_key,
+        )
+    return LocalStorage(settings.BACKUP_STORAGE_ROOT)
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import time
+
+from django.conf import settings
+
+from backup_manager import locks
+
+CHUNK_SIZE = 1024 * 1024  # Size of the chunks copied between the commands and the files
+CHECKSUM_ALGORITHM = 'sha256'
+
+
+class ChecksumWriter:
+    # Writes a stream into a file, computing its checksum and size on the way (so the file is never read again)
+    def __init__(self, file):
+        self.file = file
+        self.checksum = hashlib.new(CHECKSUM_ALGORITHM)
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self.checksum.update(chunk)
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+    def hexdigest(self) -> str:
+        return self.checksum.hexdigest()
+
+
+class ChecksumReader:
+    # Reads a file into a stream, computing its checksum and size on the way
+    def __init__(self, file, on_read=None):
+        self.file = file
+        self.checksum = hashlib.new(CHECKSUM_ALGORITHM)
+        self.size = 0
+        self.on_read = on_read  # Called with the size of each chunk read (e.g. to follow the progress)
+
+    def read(self, size: int = CHUNK_SIZE) -> bytes:
+        chunk = self.file.read(size)
+        self.checksum.update(chunk)
+        self.size += len(chunk)
+        if self.on_read:
+            self.on_read(len(chunk))
+        return chunk
+
+    def hexdigest(self) -> str:
+        return self.checksum.hexdigest()
+
+
+class ThrottledFile:
+    # Reads and writes a file of the storage within its bandwidth, shared with the other workers
+    def __init__(self, file):
+        self.file = file
+
+    def throttle(self, size: int):
+        # The limit is only a protection of the storage, it must never stop the task
+        try:
+            wait = locks.consume_bandwidth(size)
+        except Exception:
+            return
+        if wait > 0:
+            time.sleep(wait)
+
+    def write(self, chunk: bytes):
+        self.throttle(len(chunk))
+        self.file.write(chunk)
+
+    def read(self, size: int = CHUNK_SIZE) -> bytes:
+        chunk = self.file.read(size)
+        self.throttle(len(chunk))
+        return chunk
+
+
+def throttled(file):
+    # Without a bandwidth set, the storage is used as fast as possible
+    if settings.BACKUP_STORAGE_BANDWIDTH:
+        return ThrottledFile(file)
+    return file
+
+
+def file_checksum(path: str) -> (str, int):
+    with open(path, 'rb') as file:
+        reader = ChecksumReader(file)
+        while reader.read():
+            pass
+
+    return reader.hexdigest(), reader.size
+
+
+def directory_checksum(path: str) -> (str, int, dict):
+    # The checksum of a directory is the checksum of the list of its files with their own checksums
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            file_path = os.path.join(root, name)
+            checksum, size = file_checksum(file_path)
+            files[os.path.relpath(file_path, path)] = {'checksum': checksum, 'size': size}
+
+    return combined_checksum(files), sum(file['size'] for file in files.values()), files
+
+
+def combined_checksum(files: dict) -> str:
+    # Checksum of the list of the files with their own checksums (in the format of sha256sum)
+    checksum = hashlib.new(CHECKSUM_ALGORITHM)
+    for name in sorted(files):
+        checksum.update(f'{files[name]["checksum"]}  {name}\n'.encode('utf-8'))
+
+    return checksum.hexdigest()
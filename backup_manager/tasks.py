@@ -1,51 +1,216 @@
+import hashlib
+import heapq
+import json
 import os
+import re
+import shutil
+import socket
 import subprocess
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import timedelta
+from statistics import median
 
-import psycopg2
-from celery import shared_task
+from celery import chord, shared_task
+from celery.result import AsyncResult
+from django.conf import settings
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
 from django.utils import timezone
 
-from backup_manager.models import Database, Backup, Restore, STATUS, Environment
+from backup_manager import connections, encryption, locks, progress, storages, streams
+from backup_manager.models import Host, Database, Backup, Restore, STATUS, Environment, FORMAT, COMPRESSION, BaseBackup, \
+    PointInTimeRestore, BackupPart, SECTION, EnvironmentBackupRun, DatabaseCopy, BackupProfile
 
 
-def database_connect(database: Database, user: str, password: str) -> (psycopg2.extensions.connection, psycopg2.extensions.cursor):
-    connection = psycopg2.connect(
-        host=database.host.ip,
-        port=database.host.port,
-        dbname=database.name,
-        user=user,
-        password=password,
-    )
-    cursor = connection.cursor()
+def get_pg_version(database: Database, user: str, password: str) -> str:
+    return connections.get_server_version(database.host, database.name, user, password)
 
-    return connection, cursor
 
+class OutputBuffer:
+    # Keeps only the last lines of an output in memory, counting the ones that were dropped
+    def __init__(self, size: int):
+        self.lines = deque(maxlen=size)
+        self.count = 0
+
+    def append(self, line: str):
+        self.lines.append(line)
+        self.count += 1
+
+    def summary(self, log_path: str = None) -> str:
+        max_length = settings.BACKUP_DESCRIPTION_MAX_LENGTH
+        description = ''.join(self.lines)
+
+        # Verify if part of the output was dropped, pointing to the full log
+        if self.count > len(self.lines) or len(description) > max_length:
+            description = f'[Output truncated ({self.count} lines), full log in {log_path}]\n' + description[-max_length:]
+
+        return description
+
+
+def capture_output(stream, buffer: OutputBuffer, log, lock: threading.Lock, on_line=None):
+    # Read the output incrementally, keeping the last lines in the buffer and writing all of them to the log
+    for line in iter(stream.readline, b''):
+        text = line.decode('utf-8', errors='replace')
+        buffer.append(text)
+        if on_line:
+            on_line(text)
+        if log:
+            with lock:
+                log.write(line)
+    stream.close()
+
+
+def run_command(obj, command: list, password: str, on_line=None):
+    return run_pipeline(obj, [command], password, on_line=on_line)
+
+
+def feed_input(source, stream, errors: list, processes: list):
+    # Write the source into the stdin of the first command, chunk by chunk
+    try:
+        for chunk in iter(source.read, b''):
+            stream.write(chunk)
+    except BrokenPipeError:
+        pass  # The command stopped reading, its exit code tells why
+    except Exception as e:
+        errors.append(e)
+        kill_processes(processes)
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def copy_output(stream, destination, errors: list, processes: list):
+    # Read the stdout of the last command into the destination, chunk by chunk
+    try:
+        for chunk in iter(lambda: stream.read(streams.CHUNK_SIZE), b''):
+            destination.write(chunk)
+    except Exception as e:
+        # Stop the commands, otherwise they would block writing into a pipe nobody reads
+        errors.append(e)
+        kill_processes(processes)
+    finally:
+        stream.close()
+
+
+def read_peak_rss(pid: int) -> int:
+    # High-water mark of the memory (RSS) of a running process, in bytes: only of the command it runs, unlike its
+    # rusage, which also counts the memory of the worker it was forked from
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0  # It already exited, or there is no /proc
+
+
+def watch_memory(processes: list, peaks: dict, stop: threading.Event):
+    # Read the high-water mark of the commands until they exit (it only grows, so only the growth of the last interval
+    # before a command exits is missed)
+    while True:
+        for process in processes:
+            peaks[process.pid] = max(peaks.get(process.pid, 0), read_peak_rss(process.pid))
+        if stop.wait(settings.BACKUP_MEMORY_POLL_INTERVAL):
+            return
 
-def get_pg_version(database: Database, user: str, password: str) -> str:
-    connection, cursor = database_connect(database, user, password)
-    cursor.execute('SELECT version() ;')
-    pg_version = cursor.fetchone()[0].split(' ')[1]
-    cursor.close()
-    connection.close()
 
-    return pg_version
+def kill_processes(processes: list):
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
 
 
-def run_command(obj, command: list, password: str):
+def run_pipeline(obj, commands: list, password: str, input=None, output=None, on_line=None):
     # Set the postgres password as an environment variable
     os.environ['PGPASSWORD'] = password
 
-    # Run the command
+    log_path = obj.log_path()
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)  # The logs are always local, even of backups in other storages
+    processes = []
+    threads = []
+    buffers = []
+    stdout_buffer = OutputBuffer(settings.BACKUP_OUTPUT_LINES)
+    errors = []
+    peaks = {}
+    stop_watching = threading.Event()
     try:
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, input=password, check=True, encoding='utf-8')
-        # Set the status and description after a success
-        status= STATUS.SUCCESS
-        description = result.stdout
-    except subprocess.CalledProcessError as e:
-        # Set the status and description after a fail
-        status = STATUS.FAILED
-        description = e.stderr
+        # The full output of the commands is kept in a log beside the backup
+        with open(log_path, 'ab') as log:
+            lock = threading.Lock()
+
+            # Chain the commands, the stdout of each one is the stdin of the next
+            stdin = subprocess.PIPE if input else subprocess.DEVNULL
+            for i, command in enumerate(commands):
+                is_last = i == len(commands) - 1
+                process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                processes.append(process)
+
+                if i == 0 and input:
+                    # The input is streamed into the first command
+                    thread = threading.Thread(target=feed_input, args=(input, process.stdin, errors, processes), daemon=True)
+                    thread.start()
+                    threads.append(thread)
+                elif i > 0:
+                    # Close the parent copy of the pipe, so the previous command receives SIGPIPE if the next one dies
+                    stdin.close()
+                stdin = process.stdout
+
+                buffer = OutputBuffer(settings.BACKUP_OUTPUT_LINES)
+                buffers.append(buffer)
+                # The stderr of the commands is also followed by the progress of the task
+                thread = threading.Thread(target=capture_output, args=(process.stderr, buffer, log, lock, on_line), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+                if is_last and output:
+                    # The stdout of the last command is streamed into the output
+                    thread = threading.Thread(target=copy_output, args=(process.stdout, output, errors, processes), daemon=True)
+                    thread.start()
+                    threads.append(thread)
+                elif is_last:
+                    # The stdout of the last command is the description of a success
+                    thread = threading.Thread(target=capture_output, args=(process.stdout, stdout_buffer, log, lock), daemon=True)
+                    thread.start()
+                    threads.append(thread)
+
+            # Keep the peak memory of the largest command for the metrics of the task
+            memory_thread = threading.Thread(target=watch_memory, args=(processes, peaks, stop_watching), daemon=True)
+            memory_thread.start()
+
+            for process in processes:
+                process.wait()
+            stop_watching.set()
+            for thread in threads + [memory_thread]:
+                thread.join()
+
+        obj.peak_rss = max([obj.peak_rss or 0, *peaks.values()]) or None
+
+        # Verify if the input or the output failed
+        if errors:
+            raise errors[0]
+
+        # Verify if any of the commands failed
+        failed = [i for i, process in enumerate(processes) if process.returncode != 0]
+        if failed:
+            # Set the status and description after a fail
+            status = STATUS.FAILED
+            description = ''.join(buffers[i].summary(log_path) or f'{commands[i][0]} exited with code {processes[i].returncode}\n' for i in failed)
+        else:
+            # Set the status and description after a success
+            status = STATUS.SUCCESS
+            description = stdout_buffer.summary(log_path)
     except Exception as e:
+        # Kill the commands that are still running
+        kill_processes(processes)
+        stop_watching.set()
+
         # Set the status and description after a fail
         status = STATUS.FAILED
         description = str(e)
@@ -53,147 +218,911 @@ def run_command(obj, command: list, password: str):
     return status, description
 
 
-@shared_task
-def perform_backup(backup_id: int, user: str, password: str, already_started: bool = False):
+def compress_command(compression: str, compression_level: int = None) -> list:
+    if compression == COMPRESSION.ZSTD.value:
+        # Use all the cores available
+        command = ['zstd', '-T0', '-q', '-c']
+    else:
+        # pigz is a parallel implementation of gzip, use it when available
+        command = ['pigz' if shutil.which('pigz') else 'gzip', '-c']
+
+    if compression_level is not None:
+        command.append(f'-{compression_level}')
+
+    return command
+
+
+def decompress_command(compression: str) -> list:
+    # Decompress the stdin into the stdout
+    if compression == COMPRESSION.ZSTD.value:
+        return ['zstd', '-d', '-q', '-c']
+    return ['gzip', '-d', '-c']
+
+
+def archive_compression_options(compression: str, compression_level: int = None) -> list:
+    # Custom and directory archives are compressed internally by pg_dump
+    if compression == COMPRESSION.NONE.value:
+        return ['--compress', '0']
+    if compression == COMPRESSION.ZSTD.value:  # Requires pg_dump 16 or newer
+        return ['--compress', 'zstd' if compression_level is None else f'zstd:{compression_level}']
+    if compression_level is not None:
+        return ['--compress', str(compression_level)]
+    return []
+
+
+def time_limit(task) -> int:
+    # Seconds the task can run before being killed (the limit of this call, of the task or of all the tasks)
+    return (task.request.timelimit or (None, None))[0] or task.time_limit or settings.CELERY_TASK_TIME_LIMIT
+
+
+def backup_slots(host: Host) -> dict:
+    # Semaphores limiting the backups running at the same time, with their limits
+    slots = {}
+    if host.max_concurrent_backups:
+        slots[f'backup_manager:slots:host:{host.id}'] = host.max_concurrent_backups
+    if settings.BACKUP_MAX_CONCURRENT:
+        slots['backup_manager:slots:global'] = settings.BACKUP_MAX_CONCURRENT
+    if settings.BACKUP_STORAGE_BANDWIDTH:
+        # The concurrency of the storage is adjusted from its throughput (adjust_storage_concurrency)
+        slots[locks.STORAGE_SLOTS_KEY] = locks.get_storage_limit()
+    return slots
+
+
+@shared_task(bind=True, max_retries=None, acks_late=True, time_limit=settings.BACKUP_TASK_TIME_LIMIT, soft_time_limit=settings.BACKUP_TASK_SOFT_TIME_LIMIT)
+def perform_backup(self, backup_id: int, user: str, password: str, already_started: bool = False, skip_unchanged: bool = False):
     backup = Backup.objects.get(id=backup_id)  # Get the backup object
 
-    if not already_started:  # Verify if the task was already started
-        successfully_started = backup.start_task()
+    # Wait for a free slot in the host before starting, retrying the task later if there is none (a split backup only
+    # waits for its parts, which take the slots themselves)
+    try:
+        slots = backup_slots(backup.database.host) if not backup.is_split() else {}
+        acquired = locks.acquire(slots, self.request.id, time_limit(self))
+    except Exception as e:
+        # Set the status and description after a fail
+        backup.finish_task(STATUS.FAILED, f'Error acquiring backup slot: {e}')
+        return
+    if not acquired:
+        raise self.retry(countdown=settings.BACKUP_SLOT_RETRY_DELAY)
 
-        # Verify if it was successfully started
-        if not successfully_started:
-            return
+    try:
+        # Keep the id of the task, so its progress can be followed while it runs
+        backup.set_task(self.request.id)
+
+        if not already_started:  # Verify if the task was already started
+            successfully_started = backup.start_task()
+
+            # Verify if it was successfully started
+            if not successfully_started:
+                return
+
+        try:
+            run_backup(backup, user, password, self, skip_unchanged)
+        except Exception as e:
+            # Recorded in the backup rather than failing the task, so the chord of its environment run ends normally
+            backup.finish_task(STATUS.FAILED, str(e))
+    finally:
+        locks.release(slots, self.request.id)
 
+
+def run_backup(backup: Backup, user: str, password: str, task=None, skip_unchanged: bool = False):
     host = backup.database.host
     database = backup.database
 
     # Create the directory structure if it doesn't exist
     os.makedirs(os.path.dirname(backup.complete_path()), exist_ok=True)
 
-    # Get the postgres version
+    # Get the postgres version, the fingerprint of the changes (before dumping, so the changes made while dumping
+    # show up in the next one) and the size of the database
     try:
         pg_version = get_pg_version(database, user, password)
+        fingerprint = get_fingerprint(database, user, password) if skip_unchanged else None
+        table_sizes, row_count, database_size = get_table_stats(database, user, password)
     except Exception as e:
         # Set the status and description after a fail
         backup.finish_task(STATUS.FAILED, str(e))
         return
 
+    # Nothing changed since the latest backup, so this one points to its dump instead of dumping again
+    original = find_unchanged(backup, fingerprint)
+    if original:
+        backup.finish_task(
+            STATUS.SUCCESS,
+            f'Unchanged since the backup {original.name} ({original.id}), not dumped again',
+            unchanged_from=original,
+            fingerprint=fingerprint,
+            checksum=original.checksum,
+            size=original.size,
+            table_count=len(table_sizes),
+            row_count=row_count,
+            database_size=database_size,
+        )
+        return
+
+    # Only the data of the tables of the profile is dumped
+    profile = backup.profile
+    data_sizes = {table: size for table, size in table_sizes.items() if not profile or profile.includes_data(table)}
+
+    files = None
+    if backup.is_split():
+        status, description, checksum, size, files = dump_parts(backup, user, password, pg_version, data_sizes, task)
+    else:
+        # The progress is estimated from the tables already dumped and their sizes
+        dump_progress = progress.Progress(task, data_sizes, parallel=backup.format == FORMAT.DIRECTORY.value and backup.jobs > 1)
+
+        command = dump_command(database, backup.format, user, pg_version)
+        if profile:
+            command += profile.dump_options()
+        status, description, checksum, size, files = dump(backup, command, password, on_line=dump_progress.on_line)
+
+    # The server may have changed (e.g. upgraded), so check its version again in the next task
+    if status == STATUS.FAILED:
+        connections.invalidate_server_version(host)
+        backup.finish_task(status, description)
+        return
+
+    backup.finish_task(status, description, checksum=checksum, size=size, table_count=len(table_sizes), row_count=row_count, database_size=database_size, fingerprint=fingerprint)
+    write_manifest(backup, files, data_sizes)
+
+    # Keep the snapshot of the database up to date with its latest backup
+    if database.keep_snapshot:
+        refresh_snapshot.delay(backup.id, user, password)
+
+
+def major_version(pg_version: str) -> str:
+    # Major version of a server (e.g. "16.2" -> "16", "9.6.24" -> "9.6")
+    numbers = re.match(r'(\d+)(?:\.(\d+))?', pg_version)
+    if int(numbers[1]) < 10 and numbers[2]:
+        return f'{numbers[1]}.{numbers[2]}'
+    return numbers[1]
+
+
+def pg_command(name: str, pg_version: str) -> str:
+    # Client of the major version of the server, when installed in BACKUP_PG_BIN, otherwise the one in the PATH
+    # (the latest client works with all the older servers)
+    if settings.BACKUP_PG_BIN:
+        path = os.path.join(settings.BACKUP_PG_BIN.format(version=major_version(pg_version)), name)
+        if os.path.exists(path):
+            return path
+    return name
+
+
+def dump_command(database: Database, format: str, user: str, pg_version: str) -> list:
     # Construct the pg_dump command
-    command = [
-        'pg_dump',
-        '-V', pg_version,
+    return [
+        pg_command('pg_dump', pg_version),
+        '-h', database.host.ip,
+        '-p', str(database.host.port),
+        '-U', user,
+        '--dbname', database.name,
+        '--format', format,
+        '--verbose',  # Prints each table dumped, followed by the progress
+    ]
+
+
+def psql_command(host: Host, dbname: str, user: str, pg_version: str) -> list:
+    return [
+        pg_command('psql', pg_version),
         '-h', host.ip,
         '-p', str(host.port),
         '-U', user,
-        '--dbname', database.name,
-        '--file', backup.complete_path(),
+        '--dbname', dbname,
     ]
 
-    status, description = run_command(backup, command, password)
 
-    backup.finish_task(status, description)
+def encryption_key(obj) -> bytes:
+    # The backups are encrypted (and decrypted) with the key of their environment
+    if not obj.encrypted:
+        return None
+    key = obj.database.environment.encryption_key
+    if not key:
+        raise ValueError('The backup is encrypted but its environment has no encryption key')
+    secret = encryption.parse_key(key)
+    if obj.encryption_key_id and obj.encryption_key_id != encryption.key_id(secret):
+        raise ValueError(f'The backup is encrypted with another key than the one of its environment (key id {obj.encryption_key_id})')
+    return secret
 
 
-@shared_task
-def perform_restore(restore_id: int, user: str, password: str, to_keep_old_data: bool, to_ignore_public_schema: bool):
+def dump(obj, command: list, password: str, on_line=None) -> (STATUS, str, str, int, dict):
+    # Run pg_dump into the storage of the backup (or of one of its parts), returning its checksum and size
+    storage = storages.get_storage(obj.database.environment)
+    key = obj.storage_key()
+
+    files = None
+    try:
+        secret = encryption_key(obj)
+
+        if obj.format == FORMAT.DIRECTORY.value:
+            # The directory format is the only one that can be dumped in parallel, its files are written by pg_dump itself
+            # (into a staging folder, in remote storages or when encrypted) so they are checksummed right after the dump
+            with storages.staging_path(key) if secret else storage.staging(key) as path:
+                command = command + ['--jobs', str(obj.jobs), '--file', path]
+                command += archive_compression_options(obj.compression, obj.compression_level)
+                status, description = run_command(obj, command, password, on_line=on_line)
+
+                checksum, size = None, None
+                if status == STATUS.SUCCESS and secret:
+                    checksum, size, files = encryption.encrypt_directory(path, storage, key, secret)
+                elif status == STATUS.SUCCESS:
+                    checksum, size, files = streams.directory_checksum(path)
+                    storage.store_directory(key, path)
+        else:
+            commands = [command]
+            if obj.format == FORMAT.CUSTOM.value:
+                commands[0] = command + archive_compression_options(obj.compression, obj.compression_level)
+            elif obj.compression != COMPRESSION.NONE.value:
+                # Pass the plain dump through the compressor
+                commands.append(compress_command(obj.compression, obj.compression_level))
+
+            # Stream the dump straight into the storage (encrypted on the way, if the environment has a key),
+            # computing the checksum of what is stored
+            with storage.open_write(key) as file:
+                output = streams.ChecksumWriter(streams.throttled(file))
+                with encryption.EncryptingWriter(output, secret) if secret else nullcontext(output) as writer:
+                    status, description = run_pipeline(obj, commands, password, output=writer, on_line=on_line)
+                    if status != STATUS.SUCCESS:
+                        raise storages.DiscardWrite(description)  # The partial dump is not stored (e.g. the upload is aborted)
+                    if secret:
+                        writer.close()
+            checksum, size = output.hexdigest(), output.size
+    except storages.DiscardWrite:
+        return status, description, None, None, None
+    except Exception as e:
+        # The storage failed (e.g. an upload was refused)
+        return STATUS.FAILED, str(e), None, None, None
+
+    return status, description, checksum, size, files
+
+
+def split_tables(table_sizes: dict, shards: int) -> list:
+    # Split the tables in groups of similar sizes, giving each table (largest first) to the smallest group
+    groups = [[0, []] for _ in range(min(shards, len(table_sizes)) or 1)]
+    for table, size in sorted(table_sizes.items(), key=lambda item: item[1] or 0, reverse=True):
+        group = min(groups, key=lambda group: group[0])
+        group[0] += size or 0
+        group[1].append(table)
+
+    # The smallest group also gets the data of everything else (tables created after the statistics, sequences, large objects)
+    groups.sort(key=lambda group: group[0], reverse=True)
+    groups[-1][1] = None
+    return groups
+
+
+def table_pattern(table: str) -> str:
+    # Quote the names, so pg_dump matches them exactly
+    schema, name = table.split('.', 1)
+    return '"{}"."{}"'.format(schema.replace('"', '""'), name.replace('"', '""'))
+
+
+def table_options(tables: list, other_groups: list) -> list:
+    # pg_dump options selecting the data of a group of tables (see split_tables),
+    # the group without tables has everything that is not in the other groups
+    if tables is None:
+        return [option for group in other_groups if group for table in group for option in ('--exclude-table', table_pattern(table))]
+    return [option for table in tables for option in ('--table', table_pattern(table))]
+
+
+def dump_parts(backup: Backup, user: str, password: str, pg_version: str, table_sizes: dict, task=None) -> (STATUS, str, str, int, dict):
+    # The schema, the data of each group of tables and the indexes and constraints are dumped in separate parts,
+    # each one by a different worker, all from the same snapshot of the database
+    groups = split_tables(table_sizes, backup.shards)
+    if backup.profile and backup.profile.schema_only:
+        groups = []  # Only the schema is dumped
+    os.makedirs(backup.complete_path(), exist_ok=True)
+
+    parts = [BackupPart(backup=backup, number=0, section=SECTION.PRE_DATA.value, estimated_size=0)]
+    for estimated_size, tables in groups:
+        parts.append(BackupPart(backup=backup, number=len(parts), section=SECTION.DATA.value, tables=tables, estimated_size=estimated_size))
+    parts.append(BackupPart(backup=backup, number=len(parts), section=SECTION.POST_DATA.value, estimated_size=0))
+
+    # The progress is estimated from the parts already dumped and the sizes of their tables
+    dump_progress = progress.Progress(task, total=sum(table_sizes.values()))
+    dump_progress.set_step(f'{len(parts)} parts')
+
+    try:
+        # The snapshot is kept until all the parts are dumped
+        with connections.export_snapshot(backup.database.host, backup.database.name, user, password) as snapshot:
+            for part in parts:
+                part.save()
+                part.store_task(perform_backup_part.delay(part.id, user, password, pg_version, snapshot).id)
+
+            wait_parts(backup, dump_progress)
+    except Exception as e:
+        stop_parts(backup, 'Stopped, the backup failed')
+        return STATUS.FAILED, str(e), None, None, None
+
+    parts = list(backup.parts.all())
+    failed = [part for part in parts if part.status != STATUS.SUCCESS.value]
+    if failed:
+        description = ''.join(f'[{part}]\n{part.description or ""}\n' for part in failed)
+        return STATUS.FAILED, description, None, None, None
+
+    # The checksum of the backup is the checksum of the list of its parts with their own checksums
+    files = {part.path: {'checksum': part.checksum, 'size': part.size} for part in parts}
+    return STATUS.SUCCESS, '', streams.combined_checksum(files), sum(part.size for part in parts), files
+
+
+def wait_parts(backup: Backup, dump_progress: progress.Progress):
+    # Wait for the parts to be dumped, stopping at the first one that fails (the others can't finish without the snapshot)
+    # or when they take longer than BACKUP_PARTS_TIMEOUT (e.g. no worker of the parts is free), before the backup is killed
+    deadline = time.monotonic() + settings.BACKUP_PARTS_TIMEOUT
+    done = set()
+    while True:
+        parts = backup.parts.values('id', 'status', 'estimated_size')
+        for part in parts:
+            if part['status'] == STATUS.SUCCESS.value and part['id'] not in done:
+                done.add(part['id'])
+                dump_progress.advance(part['estimated_size'] or 0)
+
+        if len(done) == len(parts):
+            return
+        if any(part['status'] == STATUS.FAILED.value for part in parts):
+            stop_parts(backup, 'Stopped, another part of the backup failed')
+            return
+        if time.monotonic() >= deadline:
+            stop_parts(backup, f'Not dumped within {settings.BACKUP_PARTS_TIMEOUT} seconds')
+            return
+
+        time.sleep(settings.BACKUP_PART_POLL_INTERVAL)
+
+
+def stop_parts(backup: Backup, description: str):
+    # Revoke the parts still waiting or running and set them as failed (the snapshot is closed when the backup ends)
+    unfinished = backup.parts.filter(status__in=[STATUS.PENDING.value, STATUS.STARTED.value])
+    for task_id in unfinished.filter(task_id__isnull=False).values_list('task_id', flat=True):
+        AsyncResult(task_id).revoke(terminate=True)
+    unfinished.update(status=STATUS.FAILED.value, dt_end=timezone.now(), description=description)
+
+
+@shared_task(bind=True, max_retries=None, acks_late=True, time_limit=settings.BACKUP_TASK_TIME_LIMIT, soft_time_limit=settings.BACKUP_TASK_SOFT_TIME_LIMIT)
+def perform_backup_part(self, part_id: int, user: str, password: str, pg_version: str, snapshot: str):
+    part = BackupPart.objects.select_related('backup__database__host').get(id=part_id)  # Get the part object
+
+    # Each part takes a slot in the host like a backup, retrying the task later if there is none
+    try:
+        slots = backup_slots(part.backup.database.host)
+        acquired = locks.acquire(slots, self.request.id, time_limit(self))
+    except Exception as e:
+        # Set the status and description after a fail
+        part.finish_task(STATUS.FAILED, f'Error acquiring backup slot: {e}')
+        return
+    if not acquired:
+        raise self.retry(countdown=settings.BACKUP_SLOT_RETRY_DELAY)
+
+    try:
+        # Keep the id of the task, so its progress can be followed while it runs
+        part.set_task(self.request.id)
+
+        successfully_started = part.start_task()
+
+        # Verify if it was successfully started
+        if not successfully_started:
+            return
+
+        # Dump the section of the part from the snapshot of its backup
+        backup = part.backup
+        command = dump_command(backup.database, backup.format, user, pg_version) + ['--snapshot', snapshot, '--section', part.section]
+        if part.section == SECTION.DATA.value:
+            other_parts = backup.parts.filter(section=SECTION.DATA.value, tables__isnull=False).exclude(id=part.id)
+            command += table_options(part.tables, list(other_parts.values_list('tables', flat=True)))
+
+        # The tables of the parts were already chosen with the profile, it only applies to the schema and to everything else
+        if backup.profile and (part.section != SECTION.DATA.value or part.tables is None):
+            command += backup.profile.dump_options(schema_only=False)
+
+        status, description, checksum, size, _ = dump(part, command, password)
+
+        part.finish_task(status, description, checksum=checksum, size=size)
+    finally:
+        locks.release(slots, self.request.id)
+
+
+def get_table_stats(database: Database, user: str, password: str) -> (dict, int, int):
+    # Size of each table and estimated number of rows, from the statistics of the database, and its whole size
+    with connections.connect(database.host, database.name, user, password) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT schemaname || '.' || relname, pg_table_size(relid), n_live_tup FROM pg_stat_user_tables ;")
+            rows = cursor.fetchall()
+            cursor.execute('SELECT pg_database_size(current_database()) ;')
+            database_size = cursor.fetchone()[0]
+
+    return {table: size for table, size, _ in rows}, sum(row_count for _, _, row_count in rows), database_size
+
+
+def get_fingerprint(database: Database, user: str, password: str) -> str:
+    # Fingerprint of the changes of the database: the statistics count the rows written in each table (and in the
+    # catalogs, so any change of the schema too), along with the values of the sequences; a restart or a reset of the
+    # statistics also changes it. None when it can't be taken (e.g. the statistics are not collected), so it is dumped
+    try:
+        with connections.connect(database.host, database.name, user, password) as connection:
+            with connection.cursor() as cursor:
+                return fingerprint_query(cursor)
+    except Exception:
+        return None
+
+
+def fingerprint_query(cursor) -> str:
+    cursor.execute("SELECT current_setting('track_counts') = 'on' ;")
+    if not cursor.fetchone()[0]:
+        return None
+    cursor.execute('SELECT pg_stat_clear_snapshot() ;')  # Fresh statistics, not the ones cached in the transaction
+
+    cursor.execute("""
+        SELECT pg_postmaster_start_time(), stats_reset
+        FROM pg_stat_database
+        WHERE datname = current_database() ;
+    """)
+    fingerprint = [cursor.fetchone()]
+
+    # The shared catalogs change with the other databases, and the statistics of the columns with ANALYZE
+    cursor.execute("""
+        SELECT stat.relid, stat.n_tup_ins, stat.n_tup_upd, stat.n_tup_del
+        FROM pg_stat_all_tables stat
+        JOIN pg_class class ON class.oid = stat.relid
+        WHERE NOT class.relisshared AND stat.relid <> 'pg_catalog.pg_statistic'::regclass
+        ORDER BY stat.relid ;
+    """)
+    fingerprint.append(cursor.fetchall())
+
+    cursor.execute('SELECT schemaname, sequencename, last_value FROM pg_sequences ORDER BY schemaname, sequencename ;')
+    fingerprint.append(cursor.fetchall())
+
+    return hashlib.sha256(repr(fingerprint).encode('utf-8')).hexdigest()
+
+
+def find_unchanged(backup: Backup, fingerprint: str) -> Backup:
+    # Backup holding the dump of the database as it is now: the latest successful backup (with the same profile,
+    # format and compression), if nothing changed since it
+    if not fingerprint:
+        return None
+
+    previous = Backup.objects.filter(
+        database_id=backup.database_id,
+        profile_id=backup.profile_id,
+        format=backup.format,
+        compression=backup.compression,
+        status=STATUS.SUCCESS.value,
+        dt_start__isnull=False,
+    ).exclude(id=backup.id).select_related('unchanged_from').order_by('-dt_start').first()
+    if not previous or previous.fingerprint != fingerprint:
+        return None
+    return previous.resolve()
+
+
+def read_manifest(backup: Backup) -> dict:
+    try:
+        return json.loads(storages.get_storage(backup.database.environment).read_bytes(backup.manifest_key()))
+    except Exception:
+        return {}  # Backups done before the manifests existed
+
+
+def write_manifest(backup: Backup, files: dict = None, tables: dict = None):
+    # Describe what was written, so the backup can be checked without the platform
+    manifest = {
+        'backup': backup.id,
+        'name': backup.name,
+        'host': str(backup.database.host),
+        'database': backup.database.name,
+        'format': backup.format,
+        'compression': backup.compression,
+        'compression_level': backup.compression_level,
+        'algorithm': streams.CHECKSUM_ALGORITHM,
+        'checksum': backup.checksum,
+        'size': backup.size,
+        'table_count': backup.table_count,
+        'row_count': backup.row_count,
+        'dt_start': backup.dt_start.isoformat() if backup.dt_start else None,
+        'dt_end': backup.dt_end.isoformat() if backup.dt_end else None,
+    }
+    if files:
+        manifest['files'] = files
+    if tables:
+        manifest['tables'] = tables  # Sizes of the tables when dumped, used to estimate the progress of the restores
+
+    storages.get_storage(backup.database.environment).write_bytes(backup.manifest_key(), json.dumps(manifest, indent=4).encode())
+
+
+@shared_task(bind=True, acks_late=True, time_limit=settings.BACKUP_TASK_TIME_LIMIT, soft_time_limit=settings.BACKUP_TASK_SOFT_TIME_LIMIT)
+def perform_restore(self, restore_id: int, user: str, password: str, to_keep_old_data: bool, to_ignore_public_schema: bool, jobs: int = 1, to_verify_checksum: bool = False):
     restore = Restore.objects.get(id=restore_id)  # Get the restore object
 
+    # Keep the id of the task, so its progress can be followed while it runs
+    restore.set_task(self.request.id)
+
     successfully_started = restore.start_task()
 
     # Verify if it was successfully started
     if not successfully_started:
         return
 
-    origin_backup = restore.origin_backup
+    origin_backup = restore.origin_backup.resolve()  # The backup holding the dump
     destination_database = restore.destination_database
 
     host = destination_database.host
 
-    try:
-        connection, cursor = database_connect(destination_database, user, password)
-    except Exception as e:
-        # Set the status and description after a fail
-        restore.finish_task(STATUS.FAILED, str(e))
-        return
-
     if to_keep_old_data:
         try:
-            # Rename all current schemas to schema_(timezone.now())
-            cursor.execute(f"""
-            SELECT schema_name
-            FROM information_schema.schemata
-            WHERE catalog_name = '{destination_database.name}'
-            AND schema_name NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
-            AND schema_name NOT LIKE '%_old_%' ;
-            """)
-
-            for row in cursor.fetchall():
-                schema_name = row[0]
-                if to_ignore_public_schema and schema_name == 'public':  # Verify if the public schema should be ignored
-                    continue
-                cursor.execute(f"ALTER SCHEMA {schema_name} RENAME TO {schema_name}_old_{restore.dt_create.strftime('%d_%m_%Y_%H_%M')} ;")
+            with connections.connect(host, destination_database.name, user, password) as connection:
+                with connection.cursor() as cursor:
+                    # Rename all current schemas to schema_(timezone.now())
+                    cursor.execute(f"""
+                    SELECT schema_name
+                    FROM information_schema.schemata
+                    WHERE catalog_name = '{destination_database.name}'
+                    AND schema_name NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
+                    AND schema_name NOT LIKE '%_old_%' ;
+                    """)
+
+                    for row in cursor.fetchall():
+                        schema_name = row[0]
+                        if to_ignore_public_schema and schema_name == 'public':  # Verify if the public schema should be ignored
+                            continue
+                        cursor.execute(f"ALTER SCHEMA {schema_name} RENAME TO {schema_name}_old_{restore.dt_create.strftime('%d_%m_%Y_%H_%M')} ;")
+
+                connection.commit()
         except Exception as e:
             # Set the status and description after a fail
             restore.finish_task(STATUS.FAILED, str(e))
             return
     else:
+        # Restores in the host of an up to date snapshot of the backup are cloned from it (copying files instead of replaying SQL)
+        snapshot = get_snapshot(origin_backup, destination_database, restore.profile)
+        if snapshot:
+            try:
+                recreate_database(host, destination_database.name, user, password, template=snapshot)
+            except Exception:
+                pass  # The snapshot is in use or is gone, do a full restore
+            else:
+                # Set the status and description after a success
+                restore.finish_task(STATUS.SUCCESS, f'Cloned from the snapshot database {snapshot}')
+                return
+
         try:
-            # Reset the destination database using Django's database management functions
-            # Terminate all connections to the database
-            cursor.execute(f"""
-                SELECT pg_terminate_backend(pg_stat_activity.pid)
-                FROM pg_stat_activity
-                WHERE pg_stat_activity.datname = '{destination_database.name}' ;
-            """)
-            cursor.execute(f'DROP DATABASE IF EXISTS {destination_database.name} ;')
-            cursor.execute(f'CREATE DATABASE {destination_database.name} ;')
+            recreate_database(host, destination_database.name, user, password)
         except Exception as e:
             # Set the status and description after a fail
             restore.finish_task(STATUS.FAILED, str(e))
             return
 
     try:
-        connection.commit()
-        cursor.close()
+        pg_version = get_pg_version(destination_database, user, password)
     except Exception as e:
         # Set the status and description after a fail
         restore.finish_task(STATUS.FAILED, str(e))
         return
 
+    status, description = restore_backup(restore, origin_backup, host, destination_database.name, user, password, pg_version, jobs, to_verify_checksum, self, restore.profile)
+
+    # The server may have changed (e.g. upgraded), so check its version again in the next task
+    if status == STATUS.FAILED:
+        connections.invalidate_server_version(host)
+
+    restore.finish_task(status, description)
+
+
+def restore_backup(obj, backup: Backup, host: Host, dbname: str, user: str, password: str, pg_version: str, jobs: int = 1, to_verify_checksum: bool = False, task=None, profile: BackupProfile = None):
+    # The progress of plain backups is estimated from the bytes already fed to psql,
+    # and the one of the archives from the tables already restored and their sizes when dumped
+    if backup.format == FORMAT.PLAIN.value:
+        restore_progress = progress.Progress(task, total=backup.size)
+    else:
+        table_sizes = read_manifest(backup).get('tables') or {}
+        table_sizes = {table: size for table, size in table_sizes.items() if not profile or profile.includes_data(table)}
+        restore_progress = progress.Progress(task, table_sizes, parallel=jobs > 1)
+
+    if not backup.is_split():
+        return restore_file(obj, backup, host, dbname, user, password, pg_version, jobs, to_verify_checksum, restore_progress, profile)
+
+    # The parts of a split backup are restored in order: the schema, the data of each group of tables and then the
+    # indexes and constraints (all of them, even if one fails)
+    statuses = []
+    descriptions = []
+    for part in backup.parts.order_by('number'):
+        restore_progress.set_step(part.section)
+        status, description = restore_file(obj, part, host, dbname, user, password, pg_version, jobs, to_verify_checksum, restore_progress, profile)
+        statuses.append(status)
+        descriptions.append(description)
+
+    return combined_status(statuses), '\n'.join(descriptions)
+
+
+def combined_status(statuses: list) -> STATUS:
+    return STATUS.FAILED if STATUS.FAILED in statuses else STATUS.SUCCESS
+
+
+def restore_file(obj, backup, host: Host, dbname: str, user: str, password: str, pg_version: str, jobs: int, to_verify_checksum: bool, restore_progress: progress.Progress, profile: BackupProfile = None):
+    # Restore a backup, or a part of one
+    # Backups done before the checksums existed can't be verified
+    to_verify_checksum = to_verify_checksum and bool(backup.checksum)
+
+    storage = storages.get_storage(backup.database.environment)
+    key = backup.storage_key()
+
+    # Plain backups are replayed by psql
+    if backup.format == FORMAT.PLAIN.value:
+        commands = [psql_command(host, dbname, user, pg_version)]
+
+        # Decompress the backup on the fly
+        if backup.compression != COMPRESSION.NONE.value:
+            commands.insert(0, decompress_command(backup.compression))
+
+        # Stream the backup into the commands (decrypted on the way), computing its checksum on the way
+        try:
+            secret = encryption_key(backup)
+
+            # psql applies the backup while reading it, so a local one is verified before (a remote one would have to
+            # be downloaded twice, it is only verified after being replayed)
+            if to_verify_checksum and isinstance(storage, storages.LocalStorage):
+                step = restore_progress.step
+                restore_progress.set_step('checksum')
+                checksum = streams.file_checksum(storage.path(key))[0]
+                if checksum != backup.checksum:
+                    return STATUS.FAILED, f'Checksum mismatch: the backup file is corrupted (expected {backup.checksum}, got {checksum})'
+                restore_progress.set_step(step)  # Back to the part being restored, if any
+
+            with storage.open_read(key) as file:
+                input = streams.ChecksumReader(streams.throttled(file), on_read=restore_progress.advance)
+                with encryption.DecryptingReader(input, secret) if secret else nullcontext(input) as source:
+                    status, description = run_pipeline(obj, commands, password, input=source)
+        except Exception as e:
+            # The storage failed (e.g. the backup is gone)
+            return STATUS.FAILED, str(e)
+
+        if status == STATUS.SUCCESS and to_verify_checksum and input.hexdigest() != backup.checksum:
+            return STATUS.FAILED, f'Checksum mismatch: the backup file is corrupted (expected {backup.checksum}, got {input.hexdigest()}), it was already replayed into the database\n{description}'
+
+        return status, description
+
+    # pg_restore needs random access to the archives, so the ones in remote storages are downloaded first
+    try:
+        secret = encryption_key(backup)
+        if secret:
+            # pg_restore can't read the encrypted archives, so they are decrypted from the storage in ranges into the
+            # staging folder (the chunks are authenticated while decrypted, so they aren't checksummed again)
+            restore_progress.set_step('decrypt')
+            with storages.staging_path(key) as path:
+                encryption.decrypt_into(storage, key, secret, path, is_directory=backup.format == FORMAT.DIRECTORY.value)
+                return restore_archive(obj, backup, path, host, dbname, user, password, pg_version, jobs, restore_progress, profile)
+
+        if not isinstance(storage, storages.LocalStorage):
+            restore_progress.set_step('download')
+        with storage.local_copy(key, is_directory=backup.format == FORMAT.DIRECTORY.value) as path:
+            # The archives are verified before restoring
+            if to_verify_checksum:
+                restore_progress.set_step('checksum')
+                if backup.format == FORMAT.DIRECTORY.value:
+                    checksum = streams.directory_checksum(path)[0]
+                else:
+                    checksum = streams.file_checksum(path)[0]
+
+                if checksum != backup.checksum:
+                    return STATUS.FAILED, f'Checksum mismatch: the backup file is corrupted (expected {backup.checksum}, got {checksum})'
+
+            return restore_archive(obj, backup, path, host, dbname, user, password, pg_version, jobs, restore_progress, profile)
+    except Exception as e:
+        # The storage failed (e.g. the backup is gone)
+        return STATUS.FAILED, str(e)
+
+
+# Last line of the output of pg_restore when it went on after errors
+IGNORED_ERRORS = re.compile(r'errors ignored on restore: \d+')
+
+# Entries of the list of an archive (pg_restore --list) with the data of a table or of everything else
+DATA_ENTRY = re.compile(r'^\d+; \d+ \d+ (?P<desc>TABLE DATA|SEQUENCE SET|BLOBS|BLOB DATA) (?P<schema>\S+) (?P<name>\S+)')
+
+
+def restore_list(path: str, pg_version: str, profile: BackupProfile, list_path: str):
+    # Write the list of the entries of the archive restored with the profile: the whole schema and only the data of
+    # the tables of the profile
+    result = subprocess.run([pg_command('pg_restore', pg_version), '--list', path], capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8', errors='replace'))
+
+    with open(list_path, 'w') as file:
+        for line in result.stdout.decode('utf-8').splitlines(keepends=True):
+            match = DATA_ENTRY.match(line)
+            if match and match['desc'] == 'TABLE DATA' and not profile.includes_data(f'{match["schema"]}.{match["name"]}'):
+                continue
+            if match and match['desc'] != 'TABLE DATA' and profile.schema_only:
+                continue
+            file.write(line)
+
+
+def restore_archive(obj, backup, path: str, host: Host, dbname: str, user: str, password: str, pg_version: str, jobs: int, restore_progress: progress.Progress, profile: BackupProfile = None):
+    with storages.staging_folder() as folder:
+        options = []
+        if profile:
+            list_path = os.path.join(folder, 'restore.list')
+            restore_list(path, pg_version, profile, list_path)
+            options = ['--use-list', list_path]
+
+        # Custom and directory backups are archives restored by pg_restore, one section at a time,
+        # so that the tables are loaded and the indexes are built in parallel
+        statuses = []
+        descriptions = []
+        for section in backup.sections():
+            command = [
+                pg_command('pg_restore', pg_version),
+                '-h', host.ip,
+                '-p', str(host.port),
+                '-U', user,
+                '--dbname', dbname,
+                '--section', section,
+                '--jobs', str(jobs),
+                '--verbose',  # Prints each table restored, followed by the progress
+                *options,
+                path,
+            ]
+
+            restore_progress.set_step(section)
+            status, description = run_command(obj, command, password, on_line=restore_progress.on_line)
+
+            # pg_restore goes on after the errors of the statements (e.g. a role that doesn't exist, or the schemas kept by
+            # the restore), exiting with 1: the section was restored, its errors are kept in the description
+            if status == STATUS.FAILED and IGNORED_ERRORS.search(description):
+                status = STATUS.SUCCESS
+
+            # The next sections are restored even if one fails, all of their errors are reported
+            statuses.append(status)
+            descriptions.append(description)
+
+    return combined_status(statuses), '\n'.join(descriptions)
+
+
+def recreate_database(host: Host, dbname: str, user: str, password: str, template: str = None):
+    # Close the idle connections of this worker to the database, so they don't block dropping it
+    connections.close_pool(host, dbname)
+
+    # Reset the database from a maintenance connection (a database can't drop itself)
+    with connections.connect(host, settings.BACKUP_MAINTENANCE_DATABASE, user, password, autocommit=True) as connection:
+        with connection.cursor() as cursor:
+            # Terminate all connections to the database (and to the template, which can't be in use while copied)
+            for name in [dbname, template] if template else [dbname]:
+                cursor.execute(f"""
+                    SELECT pg_terminate_backend(pg_stat_activity.pid)
+                    FROM pg_stat_activity
+                    WHERE pg_stat_activity.datname = '{name}' ;
+                """)
+            cursor.execute(f'DROP DATABASE IF EXISTS {dbname} ;')
+            if template:
+                cursor.execute(f'CREATE DATABASE {dbname} TEMPLATE {template} ;')
+            else:
+                cursor.execute(f'CREATE DATABASE {dbname} ;')
+
+
+def get_snapshot(backup: Backup, destination_database: Database, profile: BackupProfile = None) -> str:
+    # The snapshot can only be used as template in its own host, and only if it still holds this backup
+    database = backup.database
+    if not database.keep_snapshot or database.snapshot_backup_id != backup.id:
+        return None
+    # It holds the whole backup, so the restores of a profile (only some of the tables) are replayed instead
+    if profile:
+        return None
+    if database.host_id != destination_database.host_id or destination_database.name == database.snapshot_name():
+        return None
+    return database.snapshot_name()
+
+
+@shared_task(acks_late=True, time_limit=settings.BACKUP_TASK_TIME_LIMIT, soft_time_limit=settings.BACKUP_TASK_SOFT_TIME_LIMIT)
+def refresh_snapshot(backup_id: int, user: str, password: str):
+    backup = Backup.objects.get(id=backup_id)
+    database = backup.database
+
+    # The snapshot is not valid while it is being refreshed
+    Database.objects.filter(id=database.id).update(snapshot_backup=None)
+
+    try:
+        pg_version = get_pg_version(database, user, password)
+        recreate_database(database.host, database.snapshot_name(), user, password)
+    except Exception:
+        return  # Without a snapshot the restores are replayed in full
+
+    # Restore the backup into the snapshot, so the next restores in this host are cloned from it
+    status, _ = restore_backup(backup, backup, database.host, database.snapshot_name(), user, password, pg_version, backup.jobs)
+    if status == STATUS.SUCCESS:
+        Database.objects.filter(id=database.id).update(snapshot_backup=backup)
+
+
+@shared_task(bind=True, acks_late=True, time_limit=settings.BACKUP_TASK_TIME_LIMIT, soft_time_limit=settings.BACKUP_TASK_SOFT_TIME_LIMIT)
+def perform_copy(self, copy_id: int, user: str, password: str, jobs: int = 1):
+    copy = DatabaseCopy.objects.select_related('origin_database__host', 'destination_database__host').get(id=copy_id)  # Get the copy object
+
+    # Keep the id of the task, so its progress can be followed while it runs
+    copy.set_task(self.request.id)
+
+    successfully_started = copy.start_task()
+
+    # Verify if it was successfully started
+    if not successfully_started:
+        return
+
+    origin_database = copy.origin_database
+    destination_database = copy.destination_database
+
     try:
-        pg_version = get_pg_version(destination_database, user, password)
+        os.makedirs(os.path.dirname(copy.log_path()), exist_ok=True)
+
+        origin_version = get_pg_version(origin_database, user, password)
+        table_sizes, _, _ = get_table_stats(origin_database, user, password)
+
+        recreate_database(destination_database.host, destination_database.name, user, password)
+        destination_version = get_pg_version(destination_database, user, password)
     except Exception as e:
         # Set the status and description after a fail
-        restore.finish_task(STATUS.FAILED, str(e))
+        copy.finish_task(STATUS.FAILED, str(e))
         return
 
-    # Construct the pg_restore command
-    command = [
-        'psql',
-        '-V', pg_version,
-        '-h', host.ip,
-        '-p', str(host.port),
-        '-U', user,
-        '--dbname', destination_database.name,
-        '--file', origin_backup.complete_path(),
-    ]
+    # The progress is estimated from the tables already copied and their sizes
+    copy_progress = progress.Progress(self, table_sizes, parallel=jobs > 1)
+
+    # The output of pg_dump is piped straight into psql, without a backup file in between
+    dump = dump_command(origin_database, FORMAT.PLAIN.value, user, origin_version)
+    psql = psql_command(destination_database.host, destination_database.name, user, destination_version)
+    try:
+        if jobs > 1:
+            status, description = copy_in_parallel(copy, dump, psql, user, password, table_sizes, jobs, copy_progress)
+        else:
+            status, description = run_pipeline(copy, [dump, psql], password, on_line=copy_progress.on_line)
+    except Exception as e:
+        # Set the status and description after a fail
+        status, description = STATUS.FAILED, str(e)
 
-    status, description = run_command(restore, command, password)
+    # The servers may have changed (e.g. upgraded), so check their versions again in the next task
+    if status == STATUS.FAILED:
+        connections.invalidate_server_version(origin_database.host)
+        connections.invalidate_server_version(destination_database.host)
 
-    restore.finish_task(status, description)
+    copy.finish_task(status, description, size=sum(table_sizes.values()))
+
+
+def copy_in_parallel(copy: DatabaseCopy, dump: list, psql: list, user: str, password: str, table_sizes: dict, jobs: int, copy_progress: progress.Progress):
+    # The schema is copied first, then the data of each group of tables at the same time (one pipe per group) and then
+    # the indexes and constraints, all from the same snapshot of the origin database
+    origin_database = copy.origin_database
+    with connections.export_snapshot(origin_database.host, origin_database.name, user, password) as snapshot:
+        dump = dump + ['--snapshot', snapshot]
+
+        copy_progress.set_step(SECTION.PRE_DATA.value)
+        status, description = run_pipeline(copy, [dump + ['--section', SECTION.PRE_DATA.value], psql], password)
+        if status == STATUS.FAILED:
+            return status, description
+
+        copy_progress.set_step(SECTION.DATA.value)
+        groups = [tables for _, tables in split_tables(table_sizes, jobs)]
+        commands = [dump + ['--section', SECTION.DATA.value] + table_options(tables, groups) for tables in groups]
+        with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+            results = list(executor.map(lambda command: run_pipeline(copy, [command, psql], password, on_line=copy_progress.on_line), commands))
+
+        failed = [description for status, description in results if status == STATUS.FAILED]
+        if failed:
+            return STATUS.FAILED, '\n'.join(failed)
+
+        copy_progress.set_step(SECTION.POST_DATA.value)
+        return run_pipeline(copy, [dump + ['--section', SECTION.POST_DATA.value], psql], password)
+
+
+@shared_task
+def adjust_storage_concurrency():
+    # Adapt the number of backups writing into the storage at the same time to its throughput
+    if settings.BACKUP_STORAGE_BANDWIDTH:
+        locks.adjust_storage_limit()
 
 
 @shared_task
-def create_backup(database_id: int):
+def create_backup(database_id: int, profile_id: int = None, delay: int = 0):
+    # Started by its periodic task at the scheduled time, it starts again after the offset of the task in its
+    # spread window
+    if delay:
+        create_backup.apply_async(args=[database_id, profile_id], countdown=delay)
+        return
+
     database = Database.objects.get(id=database_id)
 
     # Create the backup object
     backup = Backup.objects.create(
-        database=database
+        database=database,
+        profile_id=profile_id,
     )
 
-    backup.start_task()
-
     # Get the user and password from the database
     user = database.user if database.user else database.host.user
     password = database.password if database.password else database.host.password
@@ -205,17 +1134,380 @@ def create_backup(database_id: int):
         backup.finish_task(STATUS.FAILED, 'Password not set in database or host')
         return
 
-    # Start the backup
-    perform_backup.delay(backup.id, user, password, already_started=True)
+    # Start the backup (it stays pending until there is a free slot in the host)
+    perform_backup.delay(backup.id, user, password, skip_unchanged=database.skip_unchanged)
 
 
 @shared_task
-def backup_environment(environment_id: int):
+def backup_environment(environment_id: int, delay: int = 0):
+    # Started again after the offset of its periodic task (see create_backup)
+    if delay:
+        backup_environment.apply_async(args=[environment_id], countdown=delay)
+        return
+
     environment = Environment.objects.get(id=environment_id)
 
+    # Create the run object, tracking the backups of the whole environment
+    run = EnvironmentBackupRun.objects.create(environment=environment)
+    run.start_task()
+
     # Get all databases from the environment
-    databases = Database.objects.filter(environment=environment)
+    databases = Database.objects.filter(environment=environment).select_related('host')
+
+    # Create a backup for each database at once
+    backups = []
+    credentials = {}
+    for database in databases:
+        backup = Backup(database=database, environment_run=run)
+        backup.set_defaults()
+
+        # Get the user and password from the database
+        user = database.user if database.user else database.host.user
+        password = database.password if database.password else database.host.password
+
+        if not user or not password:
+            backup.set_status(STATUS.FAILED.value)
+            backup.dt_end = timezone.now()
+            backup.description = 'User not set in database or host' if not user else 'Password not set in database or host'
+        else:
+            credentials[database.id] = (user, password)
+        backups.append(backup)
+
+    # The largest backups are dispatched first, so the workers don't end the run with a single long backup
+    estimates = estimate_durations([database for database in databases if database.id in credentials], credentials)
+    for backup in backups:
+        backup.estimated_duration = estimates.get(backup.database_id)
+    backups.sort(key=lambda backup: backup.estimated_duration if backup.estimated_duration is not None else -1, reverse=True)
 
-    # Create a backup for each database
+    Backup.objects.bulk_create(backups)
+
+    predicted_duration = predict_duration([backup for backup in backups if backup.database_id in credentials])
+    if predicted_duration is not None:
+        EnvironmentBackupRun.objects.filter(id=run.id).update(dt_predicted_end=timezone.now() + timedelta(seconds=predicted_duration))
+
+    # Start all the backups in one go, in order (they stay pending until there is a free slot in their host),
+    # the run is finished when all of them are
+    signatures = [
+        perform_backup.si(backup.id, *credentials[backup.database_id], skip_unchanged=backup.database.skip_unchanged)
+        for backup in backups if backup.database_id in credentials
+    ]
+    callback = finish_environment_backup.si(run.id)
+    if signatures:
+        chord(signatures)(callback.on_error(finish_environment_backup.si(run.id)))
+    else:
+        callback.delay()
+
+
+def get_database_sizes(databases: list, credentials: dict) -> dict:
+    # Current size of each database (pg_database_size), queried once per host
+    databases_by_host = defaultdict(list)
     for database in databases:
-        create_backup.delay(database.id)
+        databases_by_host[database.host].append(database)
+
+    sizes = {}
+    for host, host_databases in databases_by_host.items():
+        user, password = credentials[host_databases[0].id]
+        try:
+            with connections.connect(host, settings.BACKUP_MAINTENANCE_DATABASE, user, password) as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT datname, pg_database_size(datname) FROM pg_database WHERE datname = ANY(%s) ;', [[database.name for database in host_databases]])
+                    host_sizes = dict(cursor.fetchall())
+        except Exception:
+            continue  # The sizes of the host are unknown, the history of its databases still estimates them
+
+        for database in host_databases:
+            sizes[database.id] = host_sizes.get(database.name)
+
+    return sizes
+
+
+def estimate_durations(databases: list, credentials: dict) -> dict:
+    # Expected seconds of the next backup of each database: its current size at the speed of its latest backups
+    # (seconds per byte of the database), or the duration of its latest backups when their sizes are unknown,
+    # or its size at the speed of the other databases when it has no history
+    sizes = get_database_sizes(databases, credentials)
+
+    rates = defaultdict(list)
+    durations = defaultdict(list)
+    history = Backup.objects.filter(
+        database__in=databases,
+        status=STATUS.SUCCESS.value,
+        dt_start__isnull=False,
+        dt_end__isnull=False,
+        unchanged_from__isnull=True,  # Not dumped, so they tell nothing about the duration
+    ).annotate(
+        # Only the latest ones of each database are read
+        position=Window(RowNumber(), partition_by=F('database_id'), order_by=F('dt_end').desc()),
+    ).filter(position__lte=settings.BACKUP_ESTIMATE_HISTORY).values_list('database_id', 'dt_start', 'dt_end', 'database_size')
+    for database_id, dt_start, dt_end, database_size in history:
+        duration = (dt_end - dt_start).total_seconds()
+        durations[database_id].append(duration)
+        if database_size:
+            rates[database_id].append(duration / database_size)
+
+    all_rates = [rate for database_rates in rates.values() for rate in database_rates]
+
+    estimates = {}
+    for database in databases:
+        size = sizes.get(database.id)
+        if size and rates[database.id]:
+            estimates[database.id] = round(size * median(rates[database.id]))
+        elif durations[database.id]:
+            estimates[database.id] = round(median(durations[database.id]))
+        elif size and all_rates:
+            estimates[database.id] = round(size * median(all_rates))
+
+    return estimates
+
+
+def predict_duration(backups: list) -> float:
+    # Simulate the backups started in order by the workers (BACKUP_WORKER_SLOTS at the same time, and at most
+    # max_concurrent_backups per host), returning the seconds until the last one ends (None if none was estimated)
+    capacity = settings.BACKUP_WORKER_SLOTS
+    if settings.BACKUP_MAX_CONCURRENT:
+        capacity = min(capacity, settings.BACKUP_MAX_CONCURRENT)
+
+    workers = [0.0] * capacity  # When each slot is free again
+    hosts = {}
+    end = None
+    for backup in backups:
+        if backup.estimated_duration is None:
+            continue  # Unknown, only the estimated backups are predicted
+
+        host = backup.database.host
+        host_slots = None
+        if host.max_concurrent_backups:
+            host_slots = hosts.setdefault(host.id, [0.0] * host.max_concurrent_backups)
+
+        start = max(workers[0], host_slots[0] if host_slots else 0.0)
+        heapq.heapreplace(workers, start + backup.estimated_duration)
+        if host_slots:
+            heapq.heapreplace(host_slots, start + backup.estimated_duration)
+        end = max(end or 0.0, start + backup.estimated_duration)
+
+    return end
+
+
+@shared_task(bind=True, max_retries=None)
+def finish_environment_backup(self, run_id: int):
+    run = EnvironmentBackupRun.objects.get(id=run_id)
+
+    # Called once by the chord, or by its error callback as soon as a backup task failed (e.g. killed at its time limit)
+    if run.is_finished():
+        return
+
+    # The backups whose task ended without finishing them failed
+    for backup in run.backups.filter(status=STATUS.STARTED.value, task_id__isnull=False):
+        if AsyncResult(backup.task_id).ready():
+            backup.finish_task(STATUS.FAILED, 'The task of the backup ended without finishing it (e.g. killed at its time limit)')
+
+    # The other backups may still be running, the run is finished when all of them are
+    if run.backups.filter(status__in=[STATUS.PENDING.value, STATUS.STARTED.value, STATUS.SCHEDULED.value]).exists():
+        raise self.retry(countdown=settings.BACKUP_RUN_CHECK_INTERVAL)
+
+    # Aggregate the results of the backups of the run
+    backups = run.backups.values('status', 'size')
+    backup_count = len(backups)
+    failed_count = sum(1 for backup in backups if backup['status'] != STATUS.SUCCESS.value)
+    size = sum(backup['size'] or 0 for backup in backups)
+
+    status = STATUS.FAILED if failed_count else STATUS.SUCCESS
+    run.finish_task(status, f'{backup_count - failed_count} of {backup_count} backups succeeded', backup_count=backup_count, failed_count=failed_count, size=size)
+
+
+@shared_task(acks_late=True, time_limit=settings.BACKUP_TASK_TIME_LIMIT, soft_time_limit=settings.BACKUP_TASK_SOFT_TIME_LIMIT)
+def perform_base_backup(base_backup_id: int, user: str, password: str):
+    base_backup = BaseBackup.objects.get(id=base_backup_id)  # Get the base backup object
+
+    successfully_started = base_backup.start_task()
+
+    # Verify if it was successfully started
+    if not successfully_started:
+        return
+
+    host = base_backup.host
+
+    # Create the directory structure if it doesn't exist
+    os.makedirs(os.path.dirname(base_backup.complete_path()), exist_ok=True)
+
+    # Construct the pg_basebackup command, the WAL needed to make the copy consistent is streamed along with it
+    # (into pg_wal.tar.gz, beside base.tar.gz)
+    command = [
+        'pg_basebackup',
+        '-h', host.ip,
+        '-p', str(host.port),
+        '-U', user,
+        '--pgdata', base_backup.complete_path(),
+        '--format', 'tar',
+        '--gzip',
+        '--wal-method', 'stream',
+        '--checkpoint', 'fast',
+    ]
+
+    status, description = run_command(base_backup, command, password)
+
+    base_backup.finish_task(status, description)
+
+
+@shared_task
+def create_base_backup(host_id: int, delay: int = 0):
+    # Started again after the offset of its periodic task (see create_backup)
+    if delay:
+        create_base_backup.apply_async(args=[host_id], countdown=delay)
+        return
+
+    host = Host.objects.get(id=host_id)
+
+    # Create the base backup object
+    base_backup = BaseBackup.objects.create(
+        host=host
+    )
+
+    if not host.user:
+        base_backup.finish_task(STATUS.FAILED, 'User not set in host')
+        return
+    if not host.password:
+        base_backup.finish_task(STATUS.FAILED, 'Password not set in host')
+        return
+
+    # Start the base backup
+    perform_base_backup.delay(base_backup.id, host.user, host.password)
+
+    # The base backups are only useful along with the WAL after them
+    if host.wal_archiving:
+        start_wal_receiver(host, host.user, host.password)
+
+
+@shared_task
+def ensure_wal_receivers():
+    for host in Host.objects.filter(wal_archiving=True):
+        if not host.user or not host.password:
+            continue
+
+        try:
+            start_wal_receiver(host, host.user, host.password)
+        except Exception:
+            continue  # Try again in the next run
+
+
+# Receivers started by this worker process, by host (polled so the ones that stopped are reaped)
+_wal_receivers = {}
+
+
+def is_wal_receiver(pid: int) -> bool:
+    # The pid may be of a receiver that stopped (a zombie, until the worker process that started it polls it) or of
+    # another process that reused it
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            state = file.read().rsplit(')', 1)[1].split()[0]
+        with open(f'/proc/{pid}/cmdline', 'rb') as file:
+            command = file.read().split(b'\0')
+    except (OSError, IndexError):
+        return False
+    return state != 'Z' and os.path.basename(command[0]) == b'pg_receivewal'
+
+
+def start_wal_receiver(host: Host, user: str, password: str):
+    wal_path = host.wal_path()
+    os.makedirs(wal_path, exist_ok=True)
+
+    for process in _wal_receivers.values():
+        process.poll()
+
+    # Verify if the receiver started by this node (by any of its worker processes) is still running
+    pid_path = os.path.join(wal_path, f'pg_receivewal.{socket.gethostname()}.pid')
+    try:
+        with open(pid_path) as file:
+            if is_wal_receiver(int(file.read())):
+                return
+    except (OSError, ValueError):
+        pass
+
+    options = [
+        '-h', host.ip,
+        '-p', str(host.port),
+        '-U', user,
+        '--slot', settings.BACKUP_REPLICATION_SLOT,
+    ]
+    environment = {**os.environ, 'PGPASSWORD': password}
+
+    # The replication slot makes the host keep the WAL not streamed yet, and allows only one receiver at a time
+    # (so a receiver started by another node just exits)
+    subprocess.run(['pg_receivewal', *options, '--create-slot', '--if-not-exists'], env=environment, check=True, capture_output=True)
+
+    # Start the receiver detached from the worker, it keeps streaming (and reconnecting) until it is stopped
+    with open(os.path.join(wal_path, 'pg_receivewal.log'), 'ab') as log:
+        process = subprocess.Popen(
+            ['pg_receivewal', *options, '--directory', wal_path],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log, env=environment, start_new_session=True,
+        )
+
+    _wal_receivers[host.id] = process
+    with open(pid_path, 'w') as file:
+        file.write(str(process.pid))
+
+
+@shared_task(acks_late=True, time_limit=settings.BACKUP_TASK_TIME_LIMIT, soft_time_limit=settings.BACKUP_TASK_SOFT_TIME_LIMIT)
+def perform_point_in_time_restore(restore_id: int):
+    restore = PointInTimeRestore.objects.get(id=restore_id)  # Get the restore object
+
+    successfully_started = restore.start_task()
+
+    # Verify if it was successfully started
+    if not successfully_started:
+        return
+
+    # Use the latest base backup finished before the target time
+    base_backup = BaseBackup.objects.filter(
+        host=restore.host,
+        status=STATUS.SUCCESS.value,
+        dt_end__lte=restore.target_time,
+    ).order_by('-dt_end').first()
+
+    if not base_backup:
+        restore.finish_task(STATUS.FAILED, 'No base backup finished before the target time')
+        return
+
+    data_directory = restore.data_directory
+    try:
+        # The data directory must be empty and only accessible by its owner
+        os.makedirs(data_directory, exist_ok=True)
+        if os.listdir(data_directory):
+            raise ValueError(f'Data directory is not empty: {data_directory}')
+        os.chmod(data_directory, 0o700)
+    except Exception as e:
+        # Set the status and description after a fail
+        restore.finish_task(STATUS.FAILED, str(e), base_backup=base_backup)
+        return
+
+    # Extract the base backup and the WAL streamed along with it (the base backups taken with the WAL fetched have it
+    # inside base.tar.gz)
+    archives = [('base.tar.gz', data_directory)]
+    if os.path.exists(os.path.join(base_backup.complete_path(), 'pg_wal.tar.gz')):
+        archives.append(('pg_wal.tar.gz', os.path.join(data_directory, 'pg_wal')))
+    for archive, destination in archives:
+        os.makedirs(destination, exist_ok=True)
+        command = ['tar', '-xzf', os.path.join(base_backup.complete_path(), archive), '-C', destination]
+        status, description = run_command(restore, command, '')
+
+        if status == STATUS.FAILED:
+            restore.finish_task(status, description, base_backup=base_backup)
+            return
+
+    os.makedirs(os.path.join(data_directory, 'pg_wal'), exist_ok=True)
+
+    # Configure the recovery, replaying the archived WAL until the target time
+    # (the segment pg_receivewal is still writing has the .partial suffix)
+    wal_path = restore.host.wal_path()
+    with open(os.path.join(data_directory, 'recovery.signal'), 'w'):
+        pass
+    with open(os.path.join(data_directory, 'postgresql.auto.conf'), 'a') as file:
+        file.write(f"restore_command = 'cp \"{wal_path}/%f\" \"%p\" || cp \"{wal_path}/%f.partial\" \"%p\"'\n")
+        file.write(f"recovery_target_time = '{restore.target_time.isoformat()}'\n")
+        file.write("recovery_target_action = 'promote'\n")
+
+    restore.finish_task(
+        STATUS.SUCCESS,
+        f'Data directory prepared from {base_backup}, start it as the postgres user with "pg_ctl -D {data_directory} start" to recover until {restore.target_time}',
+        base_backup=base_backup,
+    )
@@ -1,3 +1,1195 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+import fakeredis
+import psycopg2
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import ProtectedError
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django_celery_beat.models import CrontabSchedule, PeriodicTask
+from django.utils import timezone
+
+from backup_manager import connections, locks, streams
+from backup_manager.encryption import EncryptingWriter, DecryptingReader, decrypt_range, decrypt_into, key_id
+from backup_manager.management.commands.benchmark import Command as BenchmarkCommand
+from backup_manager.models import Project, Environment, Host, Database, Backup, Restore, STATUS, BackupProfile, \
+    PeriodicDatabaseBackup, PeriodicTaskModel, FORMAT, COMPRESSION, BackupPart, SECTION, EnvironmentBackupRun, \
+    DatabaseCopy, BaseBackup, PointInTimeRestore
+from backup_manager.progress import Progress
+from backup_manager.storages import LocalStorage, S3Storage
+from backup_manager.tasks import split_tables, table_options, estimate_durations, predict_duration, find_unchanged, \
+    restore_archive, pg_command, major_version, perform_backup, perform_backup_part, perform_restore, perform_copy, \
+    time_limit, is_wal_receiver, run_pipeline, dump, get_snapshot, wait_parts, finish_environment_backup, encryption_key, \
+    archive_compression_options, decompress_command, backup_slots, write_manifest, restore_file, perform_base_backup, \
+    perform_point_in_time_restore
 
 # Create your tests here.
+
+
+class DatabaseTestCase(TestCase):
+    # A database in a host, project and environment of its own (nothing listens in the port of the host)
+
+    def setUp(self):
+        self.host = Host.objects.create(name='host', ip='127.0.0.1', port=1)
+        self.project = Project.objects.create(name='project')
+        self.environment = Environment.objects.create(name='environment')
+        self.database = self.create_database('database')
+
+    def create_database(self, name: str, **fields) -> Database:
+        return Database.objects.create(name=name, host=self.host, project=self.project, environment=self.environment, **fields)
+
+    def use_storage(self) -> LocalStorage:
+        # Storage of the backups in a temporary folder, removed after the test
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(BACKUP_STORAGE_ROOT=directory))
+        return LocalStorage(directory)
+
+
+class AdminQueryCountTest(TestCase):
+    # The number of queries of the admin pages must not grow with the number of rows shown
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(self.user)
+        self.rows = 0
+
+    def create_rows(self, count: int):
+        for _ in range(count):
+            self.rows += 1
+            host = Host.objects.create(name=f'host_{self.rows}', ip='127.0.0.1', port=5432)
+            project = Project.objects.create(name=f'project_{self.rows}')
+            environment = Environment.objects.create(name=f'environment_{self.rows}')
+            database = Database.objects.create(name=f'database_{self.rows}', host=host, project=project, environment=environment)
+            backup = Backup.objects.create(database=database, dt_create=timezone.now())
+            backup.set_status(STATUS.SUCCESS.value)
+            backup.save()
+            Restore.objects.create(origin_backup=backup, destination_database=database)
+
+    def count_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url: str):
+        self.create_rows(1)
+        self.count_queries(url)  # The first request also loads the theme of the admin
+        queries = self.count_queries(url)
+
+        self.create_rows(20)
+        self.assertEqual(self.count_queries(url), queries)
+
+    def test_backup_changelist(self):
+        self.assertConstantQueries('/admin/backup_manager/backup/')
+
+    def test_restore_changelist(self):
+        self.assertConstantQueries('/admin/backup_manager/restore/')
+
+    def test_database_changelist(self):
+        self.assertConstantQueries('/admin/backup_manager/database/')
+
+    def test_backup_autocomplete(self):
+        self.assertConstantQueries('/admin/autocomplete/?app_label=backup_manager&model_name=restore&field_name=origin_backup')
+
+    def test_database_autocomplete(self):
+        self.assertConstantQueries('/admin/autocomplete/?app_label=backup_manager&model_name=backup&field_name=database')
+
+
+class ProgressTest(SimpleTestCase):
+    # The progress is parsed from the verbose output of pg_dump and pg_restore
+
+    def test_sequential_dump(self):
+        dump_progress = Progress(None, {'public.small': 100, 'public.big': 300})
+        dump_progress.on_line('pg_dump: dumping contents of table "public.small"\n')
+        dump_progress.on_line('pg_dump: dumping contents of table "public.big"\n')
+
+        state = dump_progress.state()
+        self.assertEqual(state['percent'], 25.0)
+        self.assertEqual(state['table'], 'public.big')
+        self.assertEqual(state['tables_done'], 1)
+
+    def test_parallel_restore(self):
+        restore_progress = Progress(None, {'public.small': 100, 'public.big': 300}, parallel=True)
+        restore_progress.on_line('pg_restore: launching item 3389 TABLE DATA public big\n')
+        restore_progress.on_line('pg_restore: launching item 3390 TABLE DATA public small\n')
+        restore_progress.on_line('pg_restore: finished item 3389 TABLE DATA public big\n')
+
+        state = restore_progress.state()
+        self.assertEqual(state['percent'], 75.0)
+        self.assertEqual(state['table'], 'public.small')
+
+    @override_settings(BACKUP_PROGRESS_INTERVAL=60)
+    def test_report_throttled(self):
+        task = mock.Mock()
+        dump_progress = Progress(task, {'public.small': 100, 'public.big': 300})
+        dump_progress.on_line('pg_dump: dumping contents of table "public.small"\n')
+        dump_progress.on_line('pg_dump: dumping contents of table "public.big"\n')
+        dump_progress.set_step('restoring')
+
+        # The first line is reported, the second one is within the interval and the step is forced
+        self.assertEqual(task.update_state.call_count, 2)
+        self.assertEqual(task.update_state.call_args.kwargs['state'], 'PROGRESS')
+        self.assertEqual(task.update_state.call_args.kwargs['meta']['step'], 'restoring')
+
+    @override_settings(BACKUP_PROGRESS_INTERVAL=None)
+    def test_report_disabled(self):
+        task = mock.Mock()
+        Progress(task, {'public.small': 100}).set_step('restoring')
+        task.update_state.assert_not_called()
+
+
+class BackupProfileTest(SimpleTestCase):
+    # The profiles use the patterns of pg_dump, so the tables they dump are known before dumping
+
+    def test_patterns(self):
+        profile = BackupProfile(include_tables='public.*\n"Audit".*', exclude_tables='public.tmp_*', exclude_table_data='*_log')
+
+        self.assertTrue(profile.includes_data('public.orders'))
+        self.assertTrue(profile.includes_table('public.access_log'))
+        self.assertFalse(profile.includes_data('public.access_log'))
+        self.assertFalse(profile.includes_table('public.tmp_import'))
+        self.assertTrue(profile.includes_table('Audit.events'))
+        self.assertFalse(profile.includes_table('audit.events'))
+        self.assertFalse(profile.includes_table('sales.orders'))
+
+    def test_dump_options(self):
+        profile = BackupProfile(schema_only=True, exclude_table_data='public.audit_*')
+
+        self.assertEqual(profile.dump_options(), ['--schema-only', '--exclude-table-data', 'public.audit_*'])
+        self.assertEqual(profile.dump_options(schema_only=False), ['--exclude-table-data', 'public.audit_*'])
+        self.assertFalse(profile.includes_data('public.orders'))
+
+
+class DirectoryDumpTest(DatabaseTestCase):
+    # The directory format is dumped by pg_dump itself with parallel jobs, and its files are checksummed afterwards
+
+    def test_parallel_dump(self):
+        storage = self.use_storage()
+        backup = Backup.objects.create(database=self.database, format=FORMAT.DIRECTORY.value, jobs=4, compression=COMPRESSION.NONE.value)
+
+        # The arguments given to the dump are written into a file of the directory
+        command = ['sh', '-c', 'mkdir -p "$4" && echo "$@" > "$4/toc.dat"', 'sh']
+        status, _, checksum, size, files = dump(backup, command, '')
+
+        path = storage.path(backup.storage_key())
+        self.assertEqual(status, STATUS.SUCCESS)
+        self.assertEqual(storage.read_bytes(os.path.join(backup.storage_key(), 'toc.dat')), f'--jobs 4 --file {path} --compress 0\n'.encode())
+        self.assertEqual(list(files), ['toc.dat'])
+        self.assertEqual((checksum, size), (streams.combined_checksum(files), files['toc.dat']['size']))
+
+    def test_at_least_one_job(self):
+        # pg_dump refuses --jobs 0
+        self.database.backup_jobs = 0
+        with self.assertRaises(ValidationError) as context:
+            self.database.full_clean()
+        self.assertEqual(list(context.exception.message_dict), ['backup_jobs'])
+
+        backup = Backup(database=self.database, format=FORMAT.DIRECTORY.value, jobs=0)
+        with self.assertRaises(ValidationError) as context:
+            backup.full_clean(exclude=['path'])  # Set when saved
+        self.assertEqual(list(context.exception.message_dict), ['jobs'])
+
+    def test_compression_options(self):
+        self.assertEqual(archive_compression_options(COMPRESSION.NONE.value), ['--compress', '0'])
+        self.assertEqual(archive_compression_options(COMPRESSION.GZIP.value, 9), ['--compress', '9'])
+        self.assertEqual(archive_compression_options(COMPRESSION.ZSTD.value), ['--compress', 'zstd'])
+
+
+class CompressedDumpTest(DatabaseTestCase):
+    # The plain dumps are streamed through the compressor into the storage, and decompressed on the way back
+
+    def test_gzip_stream(self):
+        storage = self.use_storage()
+        backup = Backup.objects.create(database=self.database, format=FORMAT.PLAIN.value, compression=COMPRESSION.GZIP.value, compression_level=1)
+
+        status, _, checksum, size, _ = dump(backup, ['printf', 'SELECT 1 ;'], '')
+
+        stored = storage.read_bytes(backup.storage_key())
+        self.assertEqual(status, STATUS.SUCCESS)
+        self.assertTrue(backup.storage_key().endswith('.sql.gz'))
+        self.assertEqual(subprocess.run(decompress_command(COMPRESSION.GZIP.value), input=stored, capture_output=True).stdout, b'SELECT 1 ;')
+        self.assertEqual((checksum, size), (hashlib.sha256(stored).hexdigest(), len(stored)))
+
+
+@override_settings(BACKUP_OUTPUT_LINES=10)
+class OutputCaptureTest(DatabaseTestCase):
+    # Only the last lines of the output are kept in the description, the full output goes to the log
+
+    def test_truncated_output(self):
+        self.use_storage()
+        backup = Backup.objects.create(database=self.database)
+
+        status, description = run_pipeline(backup, [['sh', '-c', 'seq 1 1000 >&2; exit 1']], '')
+
+        self.assertEqual(status, STATUS.FAILED)
+        self.assertTrue(description.startswith(f'[Output truncated (1000 lines), full log in {backup.log_path()}]\n'))
+        self.assertEqual(description.splitlines()[1:], [str(line) for line in range(991, 1001)])
+        with open(backup.log_path()) as log:
+            self.assertEqual(log.read().splitlines(), [str(line) for line in range(1, 1001)])
+
+
+class HostSlotsTest(DatabaseTestCase):
+    # A backup waits for a free slot in its host (and in all the hosts) before starting
+
+    def test_slots(self):
+        Host.objects.filter(id=self.host.id).update(max_concurrent_backups=2)
+        self.host.refresh_from_db()
+
+        with override_settings(BACKUP_MAX_CONCURRENT=5, BACKUP_STORAGE_BANDWIDTH=None):
+            self.assertEqual(backup_slots(self.host), {f'backup_manager:slots:host:{self.host.id}': 2, 'backup_manager:slots:global': 5})
+        with override_settings(BACKUP_MAX_CONCURRENT=None, BACKUP_STORAGE_BANDWIDTH=None):
+            self.assertEqual(backup_slots(Host(name='other', ip='127.0.0.1', port=1)), {})
+
+    def test_retried_without_slot(self):
+        backup = Backup.objects.create(database=self.database)
+
+        with mock.patch('backup_manager.tasks.locks.acquire', return_value=False), \
+                mock.patch('backup_manager.tasks.run_backup') as run_backup, \
+                mock.patch.object(perform_backup, 'retry', return_value=RuntimeError('retry')) as retry:
+            with self.assertRaisesMessage(RuntimeError, 'retry'):
+                perform_backup(backup.id, 'user', 'password')
+
+        retry.assert_called_once_with(countdown=settings.BACKUP_SLOT_RETRY_DELAY)
+        run_backup.assert_not_called()
+        self.assertEqual(Backup.objects.get(id=backup.id).status, STATUS.PENDING.value)
+
+
+class ManifestTest(DatabaseTestCase):
+    # The checksum of a backup is computed while it is stored, written into its manifest and verified by the restores
+
+    def setUp(self):
+        super().setUp()
+        self.storage = self.use_storage()
+        self.backup = Backup.objects.create(database=self.database, format=FORMAT.PLAIN.value, compression=COMPRESSION.NONE.value)
+        status, description, checksum, size, _ = dump(self.backup, ['printf', 'SELECT 1 ;'], '')
+        self.backup.finish_task(status, description, checksum=checksum, size=size)
+
+    def test_manifest(self):
+        write_manifest(self.backup, tables={'public.orders': 8192})
+
+        manifest = json.loads(self.storage.read_bytes(self.backup.manifest_key()))
+        self.assertEqual(manifest['checksum'], hashlib.sha256(b'SELECT 1 ;').hexdigest())
+        self.assertEqual((manifest['algorithm'], manifest['size'], manifest['tables']), ('sha256', 10, {'public.orders': 8192}))
+
+    def test_corrupted_backup(self):
+        self.storage.write_bytes(self.backup.storage_key(), b'SELECT 2 ;')
+        restore = Restore(origin_backup=self.backup, destination_database=self.database)
+        replayed = os.path.join(self.storage.root, 'replayed')
+
+        # A local backup is verified before psql replays it
+        with mock.patch('backup_manager.tasks.psql_command', return_value=['sh', '-c', f'cat > {replayed}']):
+            status, description = restore_file(restore, self.backup, self.host, 'database', 'user', 'password', '16.2', 1, True, Progress(None))
+
+        self.assertEqual(status, STATUS.FAILED)
+        self.assertTrue(description.startswith('Checksum mismatch'))
+        self.assertFalse(os.path.exists(replayed))
+
+    def test_corrupted_remote_backup(self):
+        client = FakeS3Client()
+        client.objects[self.backup.storage_key()] = b'SELECT 2 ;'
+        restore = Restore(origin_backup=self.backup, destination_database=self.database)
+
+        # A remote one is only verified while streamed, so the description tells it was replayed
+        with mock.patch('backup_manager.storages.get_storage', return_value=S3StorageTest.create_storage(client)), \
+                mock.patch('backup_manager.tasks.psql_command', return_value=['sh', '-c', 'cat > /dev/null']):
+            status, description = restore_file(restore, self.backup, self.host, 'database', 'user', 'password', '16.2', 1, True, Progress(None))
+
+        self.assertEqual(status, STATUS.FAILED)
+        self.assertIn('already replayed', description)
+
+
+class DatabaseCopyTest(DatabaseTestCase):
+    # A copy pipes the output of pg_dump straight into psql, without a backup file in between
+
+    def test_piped(self):
+        storage = self.use_storage()
+        copy = DatabaseCopy.objects.create(origin_database=self.database, destination_database=self.create_database('destination'))
+        output_path = os.path.join(storage.root, 'psql_input')
+
+        with mock.patch('backup_manager.tasks.get_pg_version', return_value='16.2'), \
+                mock.patch('backup_manager.tasks.get_table_stats', return_value=({'public.orders': 8192}, 10, 16384)), \
+                mock.patch('backup_manager.tasks.recreate_database') as recreate_database, \
+                mock.patch('backup_manager.tasks.dump_command', return_value=['printf', 'SELECT 1 ;']), \
+                mock.patch('backup_manager.tasks.psql_command', return_value=['sh', '-c', 'cat > "$0"', output_path]):
+            perform_copy(copy.id, 'user', 'password')
+
+        recreate_database.assert_called_once_with(self.host, 'destination', 'user', 'password')
+        with open(output_path, 'rb') as file:
+            self.assertEqual(file.read(), b'SELECT 1 ;')
+        copy = DatabaseCopy.objects.get(id=copy.id)
+        self.assertEqual((copy.status, copy.size), (STATUS.SUCCESS.value, 8192))
+        self.assertEqual(sorted(os.listdir(storage.root)), ['_copies', 'psql_input'])  # Only the log, no backup file
+
+
+class RestoreArchiveTest(DatabaseTestCase):
+    # All the sections of an archive are restored, the errors pg_restore went on after don't fail the restore
+
+    def setUp(self):
+        super().setUp()
+        self.backup = Backup.objects.create(database=self.database, format=FORMAT.CUSTOM.value)
+
+    def restore(self, results: dict) -> (STATUS, str, list):
+        commands = []
+
+        def run_command(obj, command, password, on_line=None):
+            commands.append(command)
+            return results.get(command[command.index('--section') + 1], (STATUS.SUCCESS, ''))
+
+        with mock.patch('backup_manager.tasks.run_command', run_command):
+            status, description = restore_archive(self.backup, self.backup, 'backup.dump', self.host, 'database', 'user', 'password', '16.2', 1, Progress(None))
+        return status, description, commands
+
+    def test_ignored_errors(self):
+        output = 'pg_restore: error: could not execute query: ERROR:  role "app" does not exist\npg_restore: warning: errors ignored on restore: 1\n'
+        status, description, commands = self.restore({'pre-data': (STATUS.FAILED, output)})
+
+        self.assertEqual([command[command.index('--section') + 1] for command in commands], ['pre-data', 'data', 'post-data'])
+        self.assertEqual(status, STATUS.SUCCESS)
+        self.assertIn('role "app" does not exist', description)
+        self.assertNotIn('-V', commands[0])
+
+    def test_failed_section(self):
+        status, _, commands = self.restore({'pre-data': (STATUS.FAILED, 'pg_restore: error: connection to server failed\n')})
+
+        self.assertEqual(len(commands), 3)
+        self.assertEqual(status, STATUS.FAILED)
+
+    def test_client_version(self):
+        self.assertEqual((major_version('16.2'), major_version('9.6.24'), major_version('17beta1')), ('16', '9.6', '17'))
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, '16', 'bin'))
+            open(os.path.join(directory, '16', 'bin', 'pg_restore'), 'w').close()
+
+            with override_settings(BACKUP_PG_BIN=os.path.join(directory, '{version}', 'bin')):
+                self.assertEqual(pg_command('pg_restore', '16.2'), os.path.join(directory, '16', 'bin', 'pg_restore'))
+                self.assertEqual(pg_command('pg_restore', '15.6'), 'pg_restore')
+
+
+class SplitTablesTest(SimpleTestCase):
+    # The tables of a split backup are grouped by size, the smallest group also gets everything else
+
+    def test_groups(self):
+        groups = split_tables({'public.a': 500, 'public.b': 300, 'public.c': 200, 'public.d': 100}, 2)
+
+        self.assertEqual(groups, [[600, ['public.a', 'public.d']], [500, None]])
+
+    def test_more_shards_than_tables(self):
+        self.assertEqual(split_tables({'public.a': 500}, 4), [[500, None]])
+        self.assertEqual(split_tables({}, 4), [[0, None]])
+
+    def test_table_options(self):
+        groups = [['public.a', 'my"schema.b'], None]
+
+        self.assertEqual(table_options(groups[0], groups), ['--table', '"public"."a"', '--table', '"my""schema"."b"'])
+        self.assertEqual(table_options(None, groups), ['--exclude-table', '"public"."a"', '--exclude-table', '"my""schema"."b"'])
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    # The connections are kept by the worker and reused by the next tasks, only checked after being idle for long
+
+    def setUp(self):
+        self.host = Host(ip='127.0.0.1', port=1)
+        patcher = mock.patch('backup_manager.connections.psycopg2.connect', side_effect=lambda **params: mock.MagicMock(closed=False))
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(connections.close_pool, self.host, 'database')
+
+    def checkout(self):
+        with connections.connect(self.host, 'database', 'user', 'password') as connection:
+            return connection
+
+    def test_reused(self):
+        first = self.checkout()
+
+        self.assertIs(self.checkout(), first)
+        self.assertIs(self.checkout(), first)
+        self.assertEqual(self.connect.call_count, 1)
+        first.cursor.assert_not_called()  # Not checked, it was idle for a moment
+        first.close.assert_not_called()
+
+    def test_failed_not_reused(self):
+        with self.assertRaises(ValueError):
+            with connections.connect(self.host, 'database', 'user', 'password') as connection:
+                raise ValueError
+
+        connection.close.assert_called_once()
+        self.assertIsNot(self.checkout(), connection)
+
+    @override_settings(BACKUP_POOL_CHECK_AFTER=0)
+    def test_idle_connection_checked(self):
+        first = self.checkout()
+        first.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError
+
+        second = self.checkout()
+        self.assertIsNot(second, first)
+        first.close.assert_called_once()
+        self.assertIs(self.checkout(), second)
+
+
+class TaskTimeLimitTest(SimpleTestCase):
+    # The long tasks have their own time limit, and the slots they hold expire after it
+
+    def test_long_tasks(self):
+        for task in [perform_backup, perform_backup_part, perform_restore, perform_copy]:
+            self.assertEqual(task.time_limit, settings.BACKUP_TASK_TIME_LIMIT)
+            self.assertGreater(task.time_limit, settings.CELERY_TASK_TIME_LIMIT)
+            self.assertLess(task.time_limit, settings.CELERY_BROKER_TRANSPORT_OPTIONS['visibility_timeout'])
+
+    def test_slots_expire_after_the_task(self):
+        client = mock.Mock()
+        client.eval.return_value = 1
+
+        with mock.patch('backup_manager.locks.get_client', return_value=client), mock.patch('time.time', return_value=1000):
+            self.assertTrue(locks.acquire({'slots': 1}, 'token', time_limit(perform_backup)))
+
+        expire_at = client.eval.call_args[0][4]  # Script, number of keys, key, now, expire_at...
+        self.assertEqual(expire_at, 1000 + settings.BACKUP_TASK_TIME_LIMIT + 60)
+
+
+@override_settings(BACKUP_STORAGE_BANDWIDTH=100, BACKUP_STORAGE_BURST=1, BACKUP_STORAGE_SATURATION=0.9,
+                   BACKUP_STORAGE_MIN_CONCURRENT=2, BACKUP_STORAGE_MAX_CONCURRENT=4)
+class StorageBandwidthTest(SimpleTestCase):
+    # The bandwidth of the storage is a token bucket in Redis, and its concurrency is adjusted from the throughput
+
+    def setUp(self):
+        self.client = fakeredis.FakeRedis()
+        patcher = mock.patch('backup_manager.locks.get_client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def consume(self, now, size):
+        with mock.patch('time.time', return_value=now):
+            return locks.consume_bandwidth(size)
+
+    def adjust(self, now):
+        with mock.patch('time.time', return_value=now):
+            return locks.adjust_storage_limit()
+
+    def test_waits_for_the_debt(self):
+        # The bucket starts full, and the requests over it wait until the debt before them is paid
+        self.assertEqual(self.consume(1000, 60), 0)
+        self.assertAlmostEqual(self.consume(1000, 60), 0.2)
+        self.assertAlmostEqual(self.consume(1000, 100), 1.2)
+
+        # Refilled at the rate, up to the capacity (the bandwidth of a burst)
+        self.assertEqual(self.consume(1002, 50), 0)
+        self.assertAlmostEqual(self.consume(1100, 150), 0.5)
+
+        self.assertEqual(int(self.client.get(locks.STORAGE_BYTES_KEY)), 420)
+        with mock.patch('time.time', return_value=1100):
+            self.assertEqual(self.client.ttl(locks.STORAGE_BUCKET_KEY), 2 + 60)  # Until full again, and a margin
+
+    def test_storage_limit(self):
+        self.assertEqual(locks.get_storage_limit(), settings.BACKUP_STORAGE_MAX_CONCURRENT)
+        self.client.set(locks.STORAGE_LIMIT_KEY, 3)
+        self.assertEqual(locks.get_storage_limit(), 3)
+
+    def test_decrease_when_saturated(self):
+        self.assertEqual(self.adjust(1000), 4)  # First measure
+
+        limits = []
+        for now in [1010, 1020, 1030]:
+            self.client.set(locks.STORAGE_BYTES_KEY, 95 * 10)  # Over 90% of the bandwidth
+            limits.append(self.adjust(now))
+
+        self.assertEqual(limits, [3, 2, 2])  # 25% less each time, down to the min
+
+    def test_increase_with_backups_waiting(self):
+        self.client.set(locks.STORAGE_LIMIT_KEY, 2)
+        self.adjust(1000)
+
+        self.client.zadd(locks.STORAGE_SLOTS_KEY, {'expired': 1005, 'a': 2000, 'b': 2000})
+        self.assertEqual(self.adjust(1010), 3)  # One more when all the slots are taken
+        self.assertEqual(self.adjust(1020), 3)  # Not while there are free slots
+
+        self.client.zadd(locks.STORAGE_SLOTS_KEY, {'c': 2000, 'd': 2000})
+        self.assertEqual(self.adjust(1030), 4)
+        self.assertEqual(self.adjust(1040), 4)  # Up to the max
+
+    def test_throttled_file(self):
+        output = io.BytesIO()
+        file = streams.throttled(output)
+        self.assertIsInstance(file, streams.ThrottledFile)
+
+        with mock.patch('time.time', return_value=1000), mock.patch('time.sleep') as sleep:
+            for _ in range(3):
+                file.write(b'x' * 100)
+
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [1.0, 2.0])
+        self.assertEqual(output.getvalue(), b'x' * 300)
+
+        with mock.patch('time.time', return_value=1000), mock.patch('time.sleep') as sleep:
+            self.assertEqual(streams.ThrottledFile(io.BytesIO(b'y' * 50)).read(), b'y' * 50)
+        sleep.assert_called_once_with(2.5)
+
+    def test_throttle_never_fails(self):
+        output = io.BytesIO()
+        with mock.patch('backup_manager.locks.consume_bandwidth', side_effect=ConnectionError), \
+                mock.patch('time.sleep') as sleep:
+            streams.ThrottledFile(output).write(b'data')
+
+        sleep.assert_not_called()
+        self.assertEqual(output.getvalue(), b'data')
+
+    @override_settings(BACKUP_STORAGE_BANDWIDTH=None)
+    def test_without_bandwidth(self):
+        output = io.BytesIO()
+        self.assertIs(streams.throttled(output), output)
+
+
+class PointInTimeRestoreTest(DatabaseTestCase):
+    # The base backups are tar archives of the data directory and of the WAL streamed along, extracted by the restores
+
+    def setUp(self):
+        super().setUp()
+        self.storage = self.use_storage()
+        self.base_backup = BaseBackup.objects.create(host=self.host)
+        BaseBackup.objects.filter(id=self.base_backup.id).update(status=STATUS.SUCCESS.value, dt_end=timezone.now() - timedelta(hours=1))
+
+    def create_archive(self, name: str, files: dict):
+        # Archive laid out like the output of pg_basebackup (the names are relative to the data directory or to pg_wal)
+        os.makedirs(self.base_backup.complete_path(), exist_ok=True)
+        with tarfile.open(os.path.join(self.base_backup.complete_path(), name), 'w:gz') as archive:
+            for file_name, data in files.items():
+                info = tarfile.TarInfo(file_name)
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    archive.addfile(info)
+                else:
+                    info.size = len(data)
+                    archive.addfile(info, io.BytesIO(data))
+
+    def restore(self) -> PointInTimeRestore:
+        data_directory = os.path.join(self.storage.root, 'recovered')
+        restore = PointInTimeRestore.objects.create(host=self.host, target_time=timezone.now(), data_directory=data_directory)
+        perform_point_in_time_restore(restore.id)
+        return PointInTimeRestore.objects.get(id=restore.id)
+
+    def test_base_backup_streams_the_wal(self):
+        with mock.patch('backup_manager.tasks.run_command', return_value=(STATUS.SUCCESS, '')) as run_command:
+            perform_base_backup(BaseBackup.objects.create(host=self.host).id, 'user', 'password')
+
+        command = run_command.call_args[0][1]
+        self.assertEqual(command[command.index('--wal-method') + 1], 'stream')
+
+    def test_restore(self):
+        self.create_archive('base.tar.gz', {'PG_VERSION': b'16\n', 'global': None, 'global/pg_control': b'control', 'pg_wal': None})
+        self.create_archive('pg_wal.tar.gz', {'000000010000000000000002': b'wal', 'archive_status': None})
+
+        restore = self.restore()
+
+        self.assertEqual(restore.status, STATUS.SUCCESS.value, restore.description)
+        self.assertEqual(restore.base_backup_id, self.base_backup.id)
+        with open(os.path.join(restore.data_directory, 'pg_wal', '000000010000000000000002'), 'rb') as file:
+            self.assertEqual(file.read(), b'wal')
+        self.assertTrue(os.path.exists(os.path.join(restore.data_directory, 'recovery.signal')))
+        with open(os.path.join(restore.data_directory, 'postgresql.auto.conf')) as file:
+            self.assertIn("recovery_target_action = 'promote'", file.read())
+
+    def test_restore_with_the_wal_fetched(self):
+        # Taken with the WAL fetched into base.tar.gz, without pg_wal.tar.gz
+        self.create_archive('base.tar.gz', {'PG_VERSION': b'16\n', 'pg_wal': None, 'pg_wal/000000010000000000000002': b'wal'})
+
+        restore = self.restore()
+
+        self.assertEqual(restore.status, STATUS.SUCCESS.value, restore.description)
+        self.assertTrue(os.path.exists(os.path.join(restore.data_directory, 'pg_wal', '000000010000000000000002')))
+
+
+class WalReceiverTest(SimpleTestCase):
+    # A receiver is only running while its process is alive (not a zombie) and is still pg_receivewal
+
+    def start(self, command: list) -> subprocess.Popen:
+        process = subprocess.Popen(command)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        return process
+
+    def test_running(self):
+        with tempfile.TemporaryDirectory() as directory:
+            receiver = os.path.join(directory, 'pg_receivewal')
+            os.symlink(shutil.which('sleep'), receiver)
+
+            process = self.start([receiver, '10'])
+            time.sleep(0.5)  # Until the command is executed (the forked process is still python)
+
+            self.assertTrue(is_wal_receiver(process.pid))
+
+    def test_other_process(self):
+        self.assertFalse(is_wal_receiver(self.start(['sleep', '10']).pid))
+
+    def test_zombie(self):
+        with tempfile.TemporaryDirectory() as directory:
+            receiver = os.path.join(directory, 'pg_receivewal')
+            os.symlink(shutil.which('true'), receiver)
+            process = self.start([receiver])
+            time.sleep(0.5)  # It exits, but it is not reaped
+
+            self.assertFalse(is_wal_receiver(process.pid))
+
+
+class TaskMetricsTest(DatabaseTestCase):
+    # The peak memory is the one of the commands of the task, and the metrics are gauges over the window
+
+    def test_peak_rss_of_the_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backup = Backup(database=self.database)
+            with mock.patch.object(backup, 'log_path', return_value=os.path.join(directory, 'backup.log')):
+                with override_settings(BACKUP_MEMORY_POLL_INTERVAL=0.1):
+                    status, _ = run_pipeline(backup, [['sleep', '0.5']], '')
+
+        self.assertEqual(status, STATUS.SUCCESS)
+        self.assertGreater(backup.peak_rss, 0)
+        self.assertLess(backup.peak_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)  # Not the worker
+
+    def test_window_gauges(self):
+        now = timezone.now()
+        for minutes in [10, 20, 30]:
+            backup = Backup.objects.create(database=self.database)
+            Backup.objects.filter(id=backup.id).update(status=STATUS.SUCCESS.value, dt_start=now - timedelta(minutes=minutes), dt_end=now)
+
+        response = self.client.get('/metrics')
+        lines = response.content.decode().splitlines()
+
+        self.assertIn('# TYPE backup_manager_backup_duration_seconds gauge', lines)
+        self.assertNotIn('histogram', response.content.decode())
+        labels = 'host="host",project="project",environment="environment"'
+        self.assertIn(f'backup_manager_backup_duration_seconds{{{labels},quantile="0.5"}} 1200.0', lines)
+        self.assertIn(f'backup_manager_backup_duration_seconds{{{labels},quantile="1"}} 1800.0', lines)
+        self.assertIn(f'backup_manager_backup_duration_seconds_samples{{{labels}}} 3', lines)
+
+
+class TaskStatusTest(DatabaseTestCase):
+    # The status transitions are single conditional updates of the columns that change
+
+    def setUp(self):
+        super().setUp()
+        self.backup = Backup.objects.create(database=self.database)
+
+    def test_start_once(self):
+        other = Backup.objects.get(id=self.backup.id)  # Same backup loaded by another worker
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.backup.start_task())
+        self.assertFalse(other.start_task())
+        self.assertEqual(Backup.objects.get(id=self.backup.id).status, STATUS.STARTED.value)
+
+    def test_finish_writes_only_the_results(self):
+        self.backup.start_task()
+        self.backup.name = 'changed'
+
+        with self.assertNumQueries(1):
+            self.backup.finish_task(STATUS.SUCCESS, 'done', size=1024)
+
+        backup = Backup.objects.get(id=self.backup.id)
+        self.assertEqual((backup.status, backup.description, backup.size), (STATUS.SUCCESS.value, 'done', 1024))
+        self.assertNotEqual(backup.name, 'changed')
+
+    def test_reporting_progress_is_running(self):
+        self.backup.set_task('task')
+
+        # A task reporting its progress isn't revoked
+        with mock.patch('backup_manager.models.AsyncResult') as async_result:
+            async_result.return_value.state = 'PROGRESS'
+            with self.assertRaises(ProtectedError):
+                self.backup.delete()
+            with self.assertRaises(ValidationError):
+                self.backup.clean()
+        async_result.return_value.revoke.assert_not_called()
+        self.assertTrue(Backup.objects.filter(id=self.backup.id).exists())
+
+    def test_waiting_is_revoked(self):
+        self.backup.set_task('task')
+
+        with mock.patch('backup_manager.models.AsyncResult') as async_result:
+            async_result.return_value.state = 'PENDING'
+            self.backup.delete()
+        async_result.return_value.revoke.assert_called_once()
+        self.assertFalse(Backup.objects.filter(id=self.backup.id).exists())
+
+
+class UnchangedBackupTest(DatabaseTestCase):
+    # A backup of an unchanged database points to the latest one holding its dump
+
+    def create_backup(self, fingerprint: str, **fields) -> Backup:
+        backup = Backup.objects.create(database=self.database, fingerprint=fingerprint, **fields)
+        backup.set_status(STATUS.SUCCESS.value)
+        backup.dt_start = backup.dt_end = timezone.now()
+        backup.save()
+        return backup
+
+    def test_points_to_the_dump(self):
+        original = self.create_backup('a')
+        unchanged = self.create_backup('a', unchanged_from=original)
+        backup = Backup.objects.create(database=self.database)
+
+        self.assertEqual(find_unchanged(backup, 'a'), original)
+        self.assertIsNone(find_unchanged(backup, 'b'))
+        self.assertIsNone(find_unchanged(backup, None))
+        self.assertEqual(unchanged.storage_key(), original.storage_key())
+        self.assertIsNone(unchanged.transferred_bytes())
+
+    def test_changed_since(self):
+        self.create_backup('a')
+        self.create_backup('b')
+
+        self.assertIsNone(find_unchanged(Backup.objects.create(database=self.database), 'a'))
+
+
+class SplitBackupTest(DatabaseTestCase):
+    # The parts of a split backup take the slots of the host, and the backup stops waiting for them at a deadline
+
+    def setUp(self):
+        super().setUp()
+        Host.objects.filter(id=self.host.id).update(max_concurrent_backups=1)
+        self.backup = Backup.objects.create(database=self.database, shards=2)
+        self.parts = [BackupPart.objects.create(backup=self.backup, number=i, section=SECTION.DATA.value, task_id=f'task_{i}') for i in range(2)]
+
+    def test_parts_take_the_slots(self):
+        with mock.patch('backup_manager.tasks.locks.acquire', return_value=False) as acquire, \
+                mock.patch.object(perform_backup_part, 'retry', return_value=RuntimeError('retry')):
+            with self.assertRaisesMessage(RuntimeError, 'retry'):
+                perform_backup_part(self.parts[0].id, 'user', 'password', '16.2', 'snapshot')
+        self.assertEqual(acquire.call_args[0][0], {f'backup_manager:slots:host:{self.host.id}': 1})
+
+        # The split backup itself only waits for its parts
+        with mock.patch('backup_manager.tasks.locks.acquire', return_value=True) as acquire, mock.patch('backup_manager.tasks.run_backup'):
+            perform_backup(self.backup.id, 'user', 'password')
+        self.assertEqual(acquire.call_args[0][0], {})
+
+    @override_settings(BACKUP_PARTS_TIMEOUT=0)
+    def test_deadline(self):
+        BackupPart.objects.filter(id=self.parts[0].id).update(status=STATUS.SUCCESS.value)
+
+        with mock.patch('backup_manager.tasks.AsyncResult') as async_result:
+            wait_parts(self.backup, Progress(None))
+
+        async_result.assert_called_once_with('task_1')
+        async_result.return_value.revoke.assert_called_once_with(terminate=True)
+        part = BackupPart.objects.get(id=self.parts[1].id)
+        self.assertEqual((part.status, part.description), (STATUS.FAILED.value, 'Not dumped within 0 seconds'))
+
+    def test_first_failure_stops_the_others(self):
+        BackupPart.objects.filter(id=self.parts[0].id).update(status=STATUS.FAILED.value)
+
+        with mock.patch('backup_manager.tasks.AsyncResult'):
+            wait_parts(self.backup, Progress(None))
+
+        self.assertEqual(BackupPart.objects.get(id=self.parts[1].id).status, STATUS.FAILED.value)
+
+
+class SnapshotTest(DatabaseTestCase):
+    # The restores in the host of the snapshot of a backup are cloned from it, unless they choose the tables
+
+    def setUp(self):
+        super().setUp()
+        self.backup = Backup.objects.create(database=self.database)
+        Database.objects.filter(id=self.database.id).update(keep_snapshot=True, snapshot_backup=self.backup)
+        self.backup.database.refresh_from_db()
+        self.destination = self.create_database('destination')
+
+    def test_cloned(self):
+        self.assertEqual(get_snapshot(self.backup, self.destination), self.database.snapshot_name())
+
+    def test_profile_replayed(self):
+        profile = BackupProfile.objects.create(name='profile', include_tables='public.orders')
+        self.assertIsNone(get_snapshot(self.backup, self.destination, profile))
+
+    def test_restore_cloned(self):
+        restore = Restore.objects.create(origin_backup=self.backup, destination_database=self.destination)
+
+        with mock.patch('backup_manager.tasks.recreate_database') as recreate_database, mock.patch('backup_manager.tasks.restore_backup') as restore_backup:
+            perform_restore(restore.id, 'user', 'password', False, False)
+
+        recreate_database.assert_called_once_with(self.host, 'destination', 'user', 'password', template=self.database.snapshot_name())
+        restore_backup.assert_not_called()
+        restore = Restore.objects.get(id=restore.id)
+        self.assertEqual((restore.status, restore.description), (STATUS.SUCCESS.value, f'Cloned from the snapshot database {self.database.snapshot_name()}'))
+
+
+class FakeS3Client:
+    # Keeps the objects in memory, refusing the upload of the parts numbered in fail_parts
+    def __init__(self, fail_parts: tuple = ()):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.fail_parts = fail_parts
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads) + len(self.aborted))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber in self.fail_parts:
+            raise OSError('part refused')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted.append(Key)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[Key])}
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[Key]
+        if Range:
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            data = data[start:end + 1]
+        return {'Body': io.BytesIO(data)}
+
+
+@override_settings(BACKUP_S3_PART_SIZE=4, BACKUP_S3_MAX_IN_FLIGHT=2)
+class S3StorageTest(DatabaseTestCase):
+    # The multipart uploads are completed only with all their parts, and aborted otherwise
+
+    @staticmethod
+    def create_storage(client: FakeS3Client) -> S3Storage:
+        with mock.patch.dict(sys.modules, {'boto3': mock.Mock(client=mock.Mock(return_value=client))}):
+            return S3Storage('bucket')
+
+    def test_upload(self):
+        client = FakeS3Client()
+        with self.create_storage(client).open_write('key') as writer:
+            writer.write(b'0123456789')
+
+        self.assertEqual(client.objects, {'key': b'0123456789'})
+        self.assertEqual((client.uploads, client.aborted), ({}, []))
+
+    def test_ranged_read(self):
+        client = FakeS3Client()
+        client.objects['key'] = os.urandom(4 * 5 + 3)  # 6 ranges, the last one shorter
+
+        with self.create_storage(client).open_read('key') as reader:
+            chunks = [reader.read(3), reader.read(6), reader.read(1), reader.read()]
+            self.assertEqual(reader.read(3), b'')
+
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 6, 1, 13])
+        self.assertEqual(b''.join(chunks), client.objects['key'])
+
+    def test_failed_part_aborts(self):
+        client = FakeS3Client(fail_parts=(3,))
+        with self.assertRaises(OSError):
+            with self.create_storage(client).open_write('key') as writer:
+                writer.write(b'0123456789')
+
+        self.assertEqual(client.objects, {})
+        self.assertEqual((client.uploads, client.aborted), ({}, ['key']))
+
+    def test_failed_dump_aborts(self):
+        client = FakeS3Client()
+        backup = Backup.objects.create(database=self.database, name='backup', format=FORMAT.PLAIN.value, compression=COMPRESSION.NONE.value)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(BACKUP_STORAGE_ROOT=directory):
+            with mock.patch('backup_manager.storages.get_storage', return_value=self.create_storage(client)):
+                status, _, checksum, _, _ = dump(backup, ['sh', '-c', 'head -c 1234 /dev/zero; exit 1'], '')
+
+        self.assertEqual((status, checksum), (STATUS.FAILED, None))
+        self.assertEqual(client.objects, {})
+        self.assertEqual((client.uploads, client.aborted), ({}, [backup.storage_key()]))
+
+
+@override_settings(BACKUP_ENCRYPTION_THREADS=2)
+class EncryptionTest(SimpleTestCase):
+    # The backups are encrypted in chunks, which can be decrypted in order or only the ones of a range
+
+    def setUp(self):
+        self.key = os.urandom(32)
+        self.data = os.urandom(10 * 100 + 37)
+
+    def encrypt(self, data: bytes) -> bytes:
+        output = io.BytesIO()
+        writer = EncryptingWriter(output, self.key, chunk_size=100)
+        for i in range(0, len(data), 33):
+            writer.write(data[i:i + 33])
+        writer.close()
+        return output.getvalue()
+
+    def test_round_trip(self):
+        for data in [self.data, self.data[:300], b'']:
+            reader = DecryptingReader(io.BytesIO(self.encrypt(data)), self.key)
+            self.assertEqual(b''.join(iter(lambda: reader.read(77), b'')), data)
+
+    def test_truncated(self):
+        encrypted = self.encrypt(self.data[:300])
+        reader = DecryptingReader(io.BytesIO(encrypted[:-116]), self.key)  # Without the last chunk
+
+        with self.assertRaises(ValueError):
+            while reader.read():
+                pass
+
+    def test_range(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = LocalStorage(directory)
+            storage.write_bytes('backup', self.encrypt(self.data))
+
+            self.assertEqual(decrypt_range(storage, 'backup', self.key, 250, 300), self.data[250:550])
+            self.assertEqual(decrypt_range(storage, 'backup', self.key, 1000, 100), self.data[1000:])
+
+    @override_settings(BACKUP_S3_PART_SIZE=250)
+    def test_decrypt_into(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = LocalStorage(os.path.join(directory, 'storage'))
+            storage.write_bytes('backup/toc.dat', self.encrypt(self.data[:100]))
+            storage.write_bytes('backup/3389.dat', self.encrypt(self.data))
+
+            # Read from the storage in ranges of 250 bytes, straight into the destination
+            decrypt_into(storage, 'backup', self.key, os.path.join(directory, 'decrypted'), is_directory=True)
+
+            with open(os.path.join(directory, 'decrypted', 'toc.dat'), 'rb') as file:
+                self.assertEqual(file.read(), self.data[:100])
+            with open(os.path.join(directory, 'decrypted', '3389.dat'), 'rb') as file:
+                self.assertEqual(file.read(), self.data)
+
+
+class EncryptionKeyTest(DatabaseTestCase):
+    # The backups remember the key they were encrypted with, which can't change while they exist
+
+    def setUp(self):
+        super().setUp()
+        self.key = os.urandom(32).hex()
+        Environment.objects.filter(id=self.environment.id).update(encryption_key=self.key)
+        self.environment.refresh_from_db()
+        self.database.refresh_from_db()
+        self.backup = Backup.objects.create(database=self.database)
+
+    def test_key_id(self):
+        self.assertTrue(self.backup.encrypted)
+        self.assertEqual(self.backup.encryption_key_id, key_id(bytes.fromhex(self.key)))
+        self.assertEqual(encryption_key(self.backup), bytes.fromhex(self.key))
+
+        # A backup encrypted with another key isn't decrypted with the current one
+        self.backup.encryption_key_id = key_id(os.urandom(32))
+        with self.assertRaisesMessage(ValueError, 'another key'):
+            encryption_key(self.backup)
+
+    def test_rotation_refused(self):
+        self.environment.encryption_key = os.urandom(32).hex()
+        self.environment.clean()  # Nothing depends on the key yet
+
+        Backup.objects.filter(id=self.backup.id).update(status=STATUS.SUCCESS.value)
+        with self.assertRaisesMessage(ValidationError, '1 backups are encrypted with the current key'):
+            self.environment.clean()
+
+    @override_settings(BACKUP_ENCRYPTION_CHUNK_SIZE=1024)
+    def test_threads_stopped(self):
+        # The threads of the encryption are stopped even when the stream is not read or written to its end
+        self.use_storage()
+        backup = Backup.objects.create(database=self.database, format=FORMAT.PLAIN.value, compression=COMPRESSION.NONE.value)
+        created = []
+
+        def track(cls):
+            def create(*args):
+                created.append(cls(*args))
+                return created[-1]
+            return create
+
+        with mock.patch('backup_manager.tasks.encryption.EncryptingWriter', side_effect=track(EncryptingWriter)):
+            status, *_ = dump(backup, ['sh', '-c', 'head -c 100000 /dev/zero; exit 1'], '')
+            self.assertEqual(status, STATUS.FAILED)
+            status, _, checksum, size, _ = dump(backup, ['head', '-c', '1000000', '/dev/zero'], '')
+            backup.finish_task(status, '', checksum=checksum, size=size)
+
+        restore = Restore(origin_backup=backup, destination_database=self.database)
+        with mock.patch('backup_manager.tasks.encryption.DecryptingReader', side_effect=track(DecryptingReader)), \
+                mock.patch('backup_manager.tasks.psql_command', return_value=['true']):  # Exits without reading
+            restore_file(restore, backup, self.host, 'database', 'user', 'password', '16.2', 1, True, Progress(None))
+
+        self.assertEqual(len(created), 3)
+        for stream in created:
+            with self.assertRaises(RuntimeError):
+                stream.executor.submit(int)
+
+
+class EnvironmentScheduleTest(DatabaseTestCase):
+    # The backups of an environment run are dispatched longest first, and its end is predicted from their estimates
+    # (nothing listens in the host, so the sizes of the databases are unknown)
+
+    def setUp(self):
+        super().setUp()
+        self.databases = [self.database] + [self.create_database(f'database_{i}') for i in range(1, 3)]
+
+    def test_estimate_from_history(self):
+        now = timezone.now()
+        for minutes in [10, 30, 20]:
+            backup = Backup.objects.create(database=self.databases[0])
+            backup.set_status(STATUS.SUCCESS.value)
+            backup.dt_start, backup.dt_end = now - timedelta(minutes=minutes), now
+            backup.save()
+
+        credentials = {database.id: ('user', 'password') for database in self.databases}
+        self.assertEqual(estimate_durations(self.databases, credentials), {self.databases[0].id: 20 * 60})
+
+    def test_estimate_from_latest_history(self):
+        now = timezone.now()
+        for days, minutes in enumerate([10, 30, 20, 600]):
+            backup = Backup.objects.create(database=self.databases[0])
+            Backup.objects.filter(id=backup.id).update(status=STATUS.SUCCESS.value, dt_start=now - timedelta(days=days, minutes=minutes), dt_end=now - timedelta(days=days))
+
+        # Only the 3 latest backups are read, not the oldest and slowest one
+        credentials = {database.id: ('user', 'password') for database in self.databases}
+        with override_settings(BACKUP_ESTIMATE_HISTORY=3), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(estimate_durations(self.databases, credentials), {self.databases[0].id: 20 * 60})
+        self.assertEqual(len([query for query in queries if 'tb_backup' in query['sql']]), 1)
+
+    def test_predict_duration(self):
+        backups = [Backup(database=self.databases[0], estimated_duration=duration) for duration in [60, 40, 30, 20, 10]]
+
+        with override_settings(BACKUP_WORKER_SLOTS=2, BACKUP_MAX_CONCURRENT=None):
+            self.assertEqual(predict_duration(backups), 80)  # [60, 20] and [40, 30, 10]
+
+        self.host.max_concurrent_backups = 1
+        with override_settings(BACKUP_WORKER_SLOTS=2, BACKUP_MAX_CONCURRENT=None):
+            self.assertEqual(predict_duration(backups), 160)
+
+
+class EnvironmentRunTest(DatabaseTestCase):
+    # The run of an environment is finished once, when all its backups are (even after the task of one of them failed)
+
+    def setUp(self):
+        super().setUp()
+        self.run = EnvironmentBackupRun.objects.create(environment=self.environment)
+        self.run.start_task()
+        self.backups = [Backup.objects.create(database=self.database, environment_run=self.run, task_id=f'task_{i}') for i in range(2)]
+
+    def test_failed_backup_recorded(self):
+        with mock.patch('backup_manager.tasks.locks.acquire', return_value=True), \
+                mock.patch('backup_manager.tasks.run_backup', side_effect=RuntimeError('boom')):
+            perform_backup(self.backups[0].id, 'user', 'password')
+
+        backup = Backup.objects.get(id=self.backups[0].id)
+        self.assertEqual((backup.status, backup.description), (STATUS.FAILED.value, 'boom'))
+
+    def test_waits_for_the_running_backups(self):
+        # The first backup was killed, the second one is still running
+        Backup.objects.filter(id__in=[backup.id for backup in self.backups]).update(status=STATUS.STARTED.value, dt_start=timezone.now())
+
+        with mock.patch('backup_manager.tasks.AsyncResult') as async_result, \
+                mock.patch.object(finish_environment_backup, 'retry', return_value=RuntimeError('retry')):
+            async_result.side_effect = lambda task_id: mock.Mock(ready=mock.Mock(return_value=task_id == 'task_0'))
+            with self.assertRaisesMessage(RuntimeError, 'retry'):
+                finish_environment_backup(self.run.id)
+
+        self.assertEqual(Backup.objects.get(id=self.backups[0].id).status, STATUS.FAILED.value)
+        self.assertFalse(EnvironmentBackupRun.objects.get(id=self.run.id).is_finished())
+
+        # The second one ends, so the run is counted
+        Backup.objects.filter(id=self.backups[1].id).update(status=STATUS.SUCCESS.value)
+        finish_environment_backup(self.run.id)
+
+        run = EnvironmentBackupRun.objects.get(id=self.run.id)
+        self.assertEqual((run.status, run.backup_count, run.failed_count), (STATUS.FAILED.value, 2, 1))
+
+
+class PeriodicSpreadTest(DatabaseTestCase):
+    # The periodic tasks of the same schedule start at fixed offsets inside their spread window
+
+    def setUp(self):
+        super().setUp()
+        self.databases = [self.database, self.create_database('database_1')]
+        self.crontab = CrontabSchedule.objects.create(minute='0', hour='0')
+
+    def create_periodic_backup(self, database: Database, spread_window: int) -> PeriodicDatabaseBackup:
+        periodic_backup = PeriodicDatabaseBackup(database=database, spread_window=spread_window, periodic_task=PeriodicTask(crontab=self.crontab))
+        periodic_backup.save()
+        return periodic_backup
+
+    def test_offsets(self):
+        periodic_backups = [self.create_periodic_backup(database, 3600) for database in self.databases]
+        delays = [json.loads(periodic_backup.periodic_task.kwargs)['delay'] for periodic_backup in periodic_backups]
+
+        self.assertTrue(all(0 <= delay < 3600 for delay in delays))
+        self.assertNotEqual(delays[0], delays[1])
+        self.assertEqual(PeriodicDatabaseBackup(database=self.databases[0], spread_window=3600).spread_offset(), delays[0])
+
+    def test_default_key(self):
+        # The tasks without a target of their own are spread by their name
+        periodic_backup = PeriodicDatabaseBackup(name='task', spread_window=3600)
+        self.assertEqual(PeriodicTaskModel.spread_key(periodic_backup), 'periodicdatabasebackup:task')
+
+    def test_without_window(self):
+        periodic_backup = self.create_periodic_backup(self.databases[0], 0)
+
+        self.assertEqual(json.loads(periodic_backup.periodic_task.kwargs), {})
+
+    def test_admin_next_start(self):
+        self.create_periodic_backup(self.databases[0], 3600)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+        response = self.client.get('/admin/backup_manager/periodicdatabasebackup/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'column-next_start')
+
+
+class BenchmarkTest(DatabaseTestCase):
+    # The options are checked before starting the throwaway cluster
+
+    def test_invalid_options(self):
+        with self.assertRaisesMessage(CommandError, 'Invalid format: x'):
+            call_command('benchmark', '--formats', 'p,x')
+        with self.assertRaisesMessage(CommandError, 'Invalid compression: rar'):
+            call_command('benchmark', '--compressions', 'gz,rar')
+
+    def test_missing_binaries(self):
+        with mock.patch('shutil.which', return_value=None), self.assertRaisesMessage(CommandError, 'initdb not found'):
+            call_command('benchmark')
+
+    def test_task_result(self):
+        start = timezone.now()
+        backup = Backup.objects.create(database=self.database, status=STATUS.SUCCESS.value, dt_start=start,
+                                       dt_end=start + timedelta(seconds=4), throughput=250.0, peak_rss=1024)
+        self.assertEqual(BenchmarkCommand().task_result(backup, size=1000), {
+            'status': 'SUCCESS', 'duration': 4.0, 'throughput': 250.0, 'peak_rss': 1024, 'size': 1000, 'description': None,
+        })
+
+        # Only the failures keep their description
+        backup.status, backup.description = STATUS.FAILED.value, 'pg_dump: error'
+        result = BenchmarkCommand().task_result(backup)
+        self.assertEqual((result['status'], result['description']), ('FAILED', 'pg_dump: error'))
+
+
+@skipUnless(shutil.which('initdb') and os.geteuid() != 0, 'Needs the PostgreSQL server binaries and a user other than root')
+class BenchmarkSmokeTest(SimpleTestCase):
+    # The smallest benchmark, in a throwaway cluster (the test database is only swapped out and back)
+    databases = {'default'}
+
+    def test_plain_backup_and_restore(self):
+        output = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'results.json')
+        call_command('benchmark', '--tables', '1', '--rows', '10', '--formats', 'p', '--compressions', 'n', '--jobs', '1',
+                     '--output', output, stderr=io.StringIO())
+
+        with open(output) as file:
+            results = json.load(file)
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(set(results[0]), {'format', 'jobs', 'compression', 'compression_level', 'run', 'backup', 'restore'})
+        self.assertEqual(set(results[0]['backup']), {'status', 'duration', 'throughput', 'peak_rss', 'size', 'description'})
+        self.assertEqual(set(results[0]['restore']), {'status', 'duration', 'throughput', 'peak_rss', 'description'})
+        self.assertEqual((results[0]['backup']['status'], results[0]['restore']['status']), ('SUCCESS', 'SUCCESS'))
@@ -1,3 +1,94 @@
-from django.shortcuts import render
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.http import HttpResponse
+from django.utils import timezone
+
+from backup_manager.models import Backup, Restore
+
 
 # Create your views here.
+
+# Quantiles of the tasks in the window exported for each measure
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def format_labels(labels: tuple) -> str:
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels]
+    return ','.join(f'{name}="{value}"' for name, value in escaped)
+
+
+def quantile(values: list, q: float) -> float:
+    # Nearest rank of the sorted values
+    return values[max(round(q * len(values)) - 1, 0)]
+
+
+def window_gauges(name: str, help_text: str, samples: dict) -> list:
+    # Quantiles, max and number of the samples of each group of labels in the window, as gauges: the tasks leave the
+    # window as they age, so the values go down too (they are not counters, rate() doesn't apply)
+    lines = [f'# HELP {name} {help_text} (quantiles of the tasks finished in the window)', f'# TYPE {name} gauge']
+    for labels, values in samples.items():
+        values = sorted(values)
+        for q in QUANTILES:
+            lines.append(f'{name}{{{format_labels(labels + (("quantile", q),))}}} {quantile(values, q)}')
+        lines.append(f'{name}{{{format_labels(labels + (("quantile", 1),))}}} {values[-1]}')
+
+    lines += [f'# HELP {name}_samples Tasks finished in the window the quantiles of {name} are computed from', f'# TYPE {name}_samples gauge']
+    lines += [f'{name}_samples{{{format_labels(labels)}}} {len(values)}' for labels, values in samples.items()]
+    return lines
+
+
+def task_metrics(kind: str, tasks: list) -> list:
+    # Group the finished tasks by host, project and environment
+    totals = defaultdict(int)
+    durations = defaultdict(list)
+    queue_waits = defaultdict(list)
+    throughputs = defaultdict(list)
+    peak_rss = defaultdict(list)
+
+    for task in tasks:
+        labels = (('host', task['host']), ('project', task['project']), ('environment', task['environment']))
+        totals[labels + (('status', task['status']),)] += 1
+
+        if task['dt_start'] and task['dt_end']:
+            durations[labels].append((task['dt_end'] - task['dt_start']).total_seconds())
+        if task['dt_start']:
+            queue_waits[labels].append(max((task['dt_start'] - task['dt_create']).total_seconds(), 0))
+        if task['throughput']:
+            throughputs[labels].append(task['throughput'])
+        if task['peak_rss']:
+            peak_rss[labels].append(task['peak_rss'])
+
+    prefix = f'backup_manager_{kind}'
+    lines = [f'# HELP {prefix}_tasks {kind.capitalize()}s finished in the window, by status', f'# TYPE {prefix}_tasks gauge']
+    lines += [f'{prefix}_tasks{{{format_labels(labels)}}} {total}' for labels, total in totals.items()]
+    lines += window_gauges(f'{prefix}_duration_seconds', f'Duration of the {kind}s', durations)
+    lines += window_gauges(f'{prefix}_queue_wait_seconds', f'Time the {kind}s waited before starting', queue_waits)
+    lines += window_gauges(f'{prefix}_throughput_bytes_per_second', f'Throughput of the {kind}s', throughputs)
+    lines += window_gauges(f'{prefix}_peak_rss_bytes', f'Peak memory of the largest command of the {kind}s', peak_rss)
+    return lines
+
+
+def metrics(request):
+    # Aggregates the tasks finished in the window, in the Prometheus text format
+    since = timezone.now() - timedelta(seconds=settings.BACKUP_METRICS_WINDOW)
+    fields = ('status', 'dt_create', 'dt_start', 'dt_end', 'throughput', 'peak_rss')
+
+    backups = Backup.objects.filter(dt_end__gte=since).values(
+        *fields,
+        host=F('database__host__name'),
+        project=F('database__project__name'),
+        environment=F('database__environment__name'),
+    )
+    restores = Restore.objects.filter(dt_end__gte=since).values(
+        *fields,
+        host=F('destination_database__host__name'),
+        project=F('destination_database__project__name'),
+        environment=F('destination_database__environment__name'),
+    )
+
+    lines = task_metrics('backup', backups) + task_metrics('restore', restores)
+
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
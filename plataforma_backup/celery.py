@@ -3,6 +3,7 @@ from __future__ import absolute_import, unicode_literals
 import os
 
 from celery import Celery
+from kombu import Queue
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'plataforma_backup.settings')
 
@@ -10,6 +11,14 @@ app = Celery('plataforma_backup')
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+# Queues used in the routing of the tasks (CELERY_TASK_ROUTES)
+app.conf.task_queues = (
+    Queue('orchestration'),
+    Queue('backup'),
+    Queue('backup_part'),
+    Queue('restore'),
+)
+
 app.autodiscover_tasks()
 
 
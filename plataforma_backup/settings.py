@@ -144,7 +144,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Celery Configuration Options
 CELERY_TIMEZONE = 'America/Sao_Paulo'
 CELERY_TASK_TRACK_STARTED = True
-CELERY_TASK_TIME_LIMIT = 30 * 60
+CELERY_TASK_TIME_LIMIT = 30 * 60  # Short tasks, the long ones have their own limits (BACKUP_TASK_TIME_LIMIT)
 
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -155,5 +155,80 @@ CELERY_RESULT_SERIALIZER = 'json'
 # Optional: Configure concurrency (number of workers and concurrency level)
 # CELERY_WORKER_CONCURRENCY = 4  # Number of worker processes
 
+# Queues (declared in plataforma_backup/celery.py), so each kind of task can have its own pool of workers
+# orchestration: short bookkeeping tasks | backup: pg_dump | backup_part: pg_dump of the parts of split backups | restore: psql/pg_restore
+CELERY_TASK_DEFAULT_QUEUE = 'orchestration'
+CELERY_TASK_ROUTES = {
+    'backup_manager.tasks.create_backup': {'queue': 'orchestration'},
+    'backup_manager.tasks.backup_environment': {'queue': 'orchestration'},
+    'backup_manager.tasks.finish_environment_backup': {'queue': 'orchestration'},
+    'backup_manager.tasks.perform_backup': {'queue': 'backup'},
+    'backup_manager.tasks.perform_backup_part': {'queue': 'backup_part'},  # Not the same queue, the backup waits for its parts
+    'backup_manager.tasks.perform_restore': {'queue': 'restore'},
+    'backup_manager.tasks.refresh_snapshot': {'queue': 'restore'},
+    'backup_manager.tasks.perform_copy': {'queue': 'restore'},
+    'backup_manager.tasks.create_base_backup': {'queue': 'orchestration'},
+    'backup_manager.tasks.ensure_wal_receivers': {'queue': 'orchestration'},
+    'backup_manager.tasks.adjust_storage_concurrency': {'queue': 'orchestration'},
+    'backup_manager.tasks.perform_base_backup': {'queue': 'backup'},
+    'backup_manager.tasks.perform_point_in_time_restore': {'queue': 'restore'},
+}
+
+# Long tasks are acknowledged only after finishing, and each worker process reserves one task at a time,
+# so a short task is never stuck behind a long one reserved by a busy process
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Redis redelivers the unacknowledged tasks after this timeout, it must be longer than the longest task (and countdown)
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 12 * 60 * 60}
+# Seconds the backups, restores and copies can run (the soft limit stops their commands and fails them, the hard one
+# kills the worker process), shorter than the visibility timeout so they are not delivered again while running
+BACKUP_TASK_TIME_LIMIT = 11 * 60 * 60
+BACKUP_TASK_SOFT_TIME_LIMIT = BACKUP_TASK_TIME_LIMIT - 5 * 60
+
 # Celery Beat configuration
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    # Restart the WAL receivers of the hosts that stopped streaming
+    'ensure-wal-receivers': {
+        'task': 'backup_manager.tasks.ensure_wal_receivers',
+        'schedule': 60.0,
+    },
+    # Adapt the number of backups writing into the storage to its throughput (only with BACKUP_STORAGE_BANDWIDTH set)
+    'adjust-storage-concurrency': {
+        'task': 'backup_manager.tasks.adjust_storage_concurrency',
+        'schedule': 30.0,
+    },
+}
+
+
+# Backup Manager Configuration Options
+BACKUP_OUTPUT_LINES = 200  # Last lines of the output of each command kept in memory (the full output goes to a log beside the backup)
+BACKUP_DESCRIPTION_MAX_LENGTH = 10000  # Max length of the description of backups and restores
+BACKUP_MAX_CONCURRENT = None  # Max number of backups running at the same time in all hosts (None for no limit, the limit of each host is set in the host)
+BACKUP_WORKER_SLOTS = 4  # Backups the workers of the backup queue run at the same time (their total --concurrency), used to predict the end of the environment runs
+BACKUP_ESTIMATE_HISTORY = 5  # Latest successful backups of each database whose speed estimates the duration of the next one
+BACKUP_SLOT_RETRY_DELAY = 30  # Seconds a backup waits before trying again to get a free slot
+BACKUP_LOCK_URL = CELERY_BROKER_URL  # Redis shared by the workers to hold the slots
+BACKUP_CONNECT_TIMEOUT = 10  # Seconds to wait when connecting to a host
+BACKUP_POOL_SIZE = 4  # Max idle connections kept by each worker process per host, database and user, reused by the next tasks
+BACKUP_POOL_CHECK_AFTER = 5 * 60  # Seconds a connection can be idle before being checked (SELECT 1) when reused
+BACKUP_VERSION_CACHE_TTL = 60 * 60  # Seconds the version of a host is cached by each worker process
+BACKUP_PG_BIN = None  # Folder of the clients (pg_dump, pg_restore, psql) of each major version of the servers, e.g. '/usr/lib/postgresql/{version}/bin' (the ones in the PATH are used for the versions not installed) | None to always use the ones in the PATH
+BACKUP_MAINTENANCE_DATABASE = 'postgres'  # Database used to drop and create other databases
+BACKUP_STORAGE_ROOT = '/mnt/netapp01/postgres'  # Where the backups are stored (and the logs, also of the backups in S3 storages)
+BACKUP_STAGING_ROOT = None  # Local folder where the backups in S3 storages are staged when a command needs files (None for the temp folder)
+BACKUP_S3_PART_SIZE = 64 * 1024 * 1024  # Bytes of each part uploaded (and of each range downloaded) from the S3 storages
+BACKUP_S3_MAX_IN_FLIGHT = 4  # Max parts uploaded (or ranges downloaded) at the same time by each backup or restore
+BACKUP_ENCRYPTION_CHUNK_SIZE = 1024 * 1024  # Bytes of each chunk encrypted separately (read back from the backups, so it can be changed)
+BACKUP_ENCRYPTION_THREADS = 4  # Threads encrypting (or decrypting) the chunks of each backup or restore
+BACKUP_REPLICATION_SLOT = 'plataforma_backup'  # Replication slot used to stream the WAL of the hosts
+BACKUP_METRICS_WINDOW = 7 * 24 * 60 * 60  # Seconds of finished backups and restores aggregated in /metrics
+BACKUP_MEMORY_POLL_INTERVAL = 1  # Seconds between the reads of the peak memory of the commands run by the tasks
+BACKUP_PROGRESS_INTERVAL = 5  # Min seconds between the progress reports of a running backup or restore (None to not report it)
+BACKUP_PART_POLL_INTERVAL = 5  # Seconds between the checks of a split backup for its parts finished
+BACKUP_PARTS_TIMEOUT = BACKUP_TASK_SOFT_TIME_LIMIT - 5 * 60  # Seconds a split backup waits for its parts, the ones not dumped by then are stopped and the backup fails (before its own time limit)
+BACKUP_RUN_CHECK_INTERVAL = 60  # Seconds between the checks of an environment run for its backups finished, after the task of one of them failed
+BACKUP_STORAGE_BANDWIDTH = None  # Max bytes per second written into (and read from) the storage by all the workers (None for no limit)
+BACKUP_STORAGE_BURST = 1  # Seconds of bandwidth that can be used at once after the storage was idle
+BACKUP_STORAGE_SATURATION = 0.9  # Fraction of the bandwidth above which the storage is considered saturated
+BACKUP_STORAGE_MIN_CONCURRENT = 1  # Min and max number of backups writing into the storage at the same time,
+BACKUP_STORAGE_MAX_CONCURRENT = 16  # adapted between them from its throughput (only with a bandwidth set)